@@ -0,0 +1,270 @@
+# benchmarks/bench_tpo.py - Offline TPO performance benchmarks on a simulated Ollama server
+"""
+Measures the TPO engine end to end without any model installed: every role
+talks to a local SimOllamaServer that charges latency, prefill/decode time
+per token, model-load penalties and a limited number of parallel slots.
+
+    python benchmarks/bench_tpo.py                                  # report -> results/bench/bench_tpo.json
+    python benchmarks/bench_tpo.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_tpo.py --check benchmarks/baseline.json # exit 1 on regression
+
+Absolute numbers depend only on the simulator profile, so a baseline saved on
+one laptop is comparable on another; --tolerance absorbs scheduling noise.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from collect_tpo_trajectories import collect_tpo_trajectories, load_prompts_from_txt  # noqa: E402
+from config_loader import load_all_configs  # noqa: E402
+from evaluator import Evaluator  # noqa: E402
+from models import TPO_Models  # noqa: E402
+from sim_ollama import SimOllamaServer  # noqa: E402
+from tpo_core import TPO_Engine  # noqa: E402
+from utils import percentile  # noqa: E402
+
+# Simulated server: a small GPU box serving 4 requests at a time
+SIM_PROFILE: Dict[str, Any] = {
+    "reply": None,
+    "latency_s": 0.01,
+    "jitter": 0.2,
+    "tokens_per_s": 2000.0,
+    "prefill_tokens_per_s": 20000.0,
+    "load_time_s": 0.05,
+    "max_loaded_models": 0,
+    "parallel": 4,
+    "output_tokens": 48,
+    "seed": 0,
+}
+
+# metric -> +1 if higher is better, -1 if lower is better
+METRICS = {
+    "run_tpo.latency_p50_s": -1,
+    "run_tpo.latency_p90_s": -1,
+    "run_tpo.calls_per_prompt": -1,
+    "run_tpo.prefill_tokens_per_prompt": -1,
+    "arun_tpo.prefill_tokens_per_prompt": -1,
+    "arun_tpo.prompts_per_min@1": +1,
+    "arun_tpo.prompts_per_min@4": +1,
+    "arun_tpo.prompts_per_min@8": +1,
+    "collect.prompts_per_min@1": +1,
+    "collect.prompts_per_min@4": +1,
+    "eval.examples_per_min": +1,
+    "eval.tpo_latency_p50_s": -1,
+}
+
+
+def sim_configs(url: str, max_concurrency: int) -> Dict[str, Dict[str, Any]]:
+    """Repo configs with every role routed to the simulator and the cache off."""
+    configs = copy.deepcopy(load_all_configs(ROOT))
+    models_yaml = configs["models.yaml"]
+    models_yaml["endpoints"] = {"sim": {"host": url, "max_concurrency": max_concurrency}}
+    models_yaml["cache"] = {"enabled": False}
+    for cfg in models_yaml["models"].values():
+        cfg.pop("hosts", None)
+        cfg.pop("keep_alive", None)
+    return configs
+
+
+@contextlib.contextmanager
+def sim_engine(profile: Dict[str, Any]):
+    """(engine, server) pair on a fresh simulator, engine output silenced."""
+    with SimOllamaServer(**profile) as srv:
+        configs = sim_configs(srv.url, max_concurrency=2 * max(profile.get("parallel", 0), 1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            models = TPO_Models(ROOT, configs=configs)
+            engine = TPO_Engine(ROOT, configs=configs, models=models)
+        yield engine, srv
+
+
+def _quiet(fn: Callable, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def bench_run_tpo(profile: Dict[str, Any], prompts: List[str]) -> Dict[str, Any]:
+    """Sequential run_tpo: per-prompt latency and LLM calls."""
+    with sim_engine(profile) as (engine, srv):
+        latencies, calls, prefill, saved = [], [], [], []
+        for q in prompts:
+            start = time.perf_counter()
+            result = _quiet(engine.run_tpo_budgeted, q)
+            latencies.append(time.perf_counter() - start)
+            calls.append(result["llm_calls"])
+            prefill.append(result["prefill_tokens"])
+            saved.append(result["prefill_saved"])
+        return {
+            "prompts": len(prompts),
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p90_s": percentile(latencies, 90),
+            "calls_per_prompt": sum(calls) / len(calls),
+            "prefill_tokens_per_prompt": sum(prefill) / len(prefill),
+            "prefill_saved_per_prompt": sum(saved) / len(saved),
+            "server": srv.stats(),
+        }
+
+
+def bench_arun_tpo(profile: Dict[str, Any], prompts: List[str], levels: List[int]) -> Dict[str, Any]:
+    """arun_tpo throughput with `level` prompts in flight."""
+    out: Dict[str, Any] = {}
+    for level in levels:
+        with sim_engine(profile) as (engine, srv):
+            async def run() -> None:
+                sem = asyncio.Semaphore(level)
+
+                async def one(q: str) -> None:
+                    async with sem:
+                        await engine.arun_tpo_budgeted(q)
+
+                await asyncio.gather(*(one(q) for q in prompts))
+
+            start = time.perf_counter()
+            _quiet(asyncio.run, run())
+            elapsed = time.perf_counter() - start
+            out[f"prompts_per_min@{level}"] = len(prompts) / elapsed * 60
+            out[f"server_max_in_flight@{level}"] = srv.max_in_flight
+            out.setdefault("prefill_tokens_per_prompt", srv.prefill_tokens / len(prompts))
+    base = out.get(f"prompts_per_min@{levels[0]}")
+    if base:
+        out["speedup"] = {str(lv): out[f"prompts_per_min@{lv}"] / base for lv in levels}
+    return out
+
+
+def bench_collect(profile: Dict[str, Any], prompts: List[str], workers: List[int],
+                  tmp_dir: str) -> Dict[str, Any]:
+    """collect_tpo_trajectories throughput per worker count."""
+    out: Dict[str, Any] = {}
+    for w in workers:
+        with sim_engine(profile) as (engine, srv):
+            path = os.path.join(tmp_dir, f"collect_w{w}.jsonl")
+            summary = _quiet(collect_tpo_trajectories, engine, prompts, path, overwrite=True, workers=w)
+            out[f"prompts_per_min@{w}"] = summary["prompts_per_min"]
+            out[f"failed@{w}"] = summary["failed"]
+    return out
+
+
+def bench_eval(profile: Dict[str, Any], prompts: List[str], concurrency: int,
+               tmp_dir: str) -> Dict[str, Any]:
+    """Evaluator (one TPO run per example, step 0 as the baseline) on a synthetic dataset."""
+    dataset = os.path.join(tmp_dir, "bench_eval.jsonl")
+    with open(dataset, "w", encoding="utf-8") as f:
+        for i, q in enumerate(prompts):
+            f.write(json.dumps({"id": str(i), "prompt": q}) + "\n")
+    with sim_engine(profile) as (engine, srv):
+        evaluator = Evaluator(engine, out_dir=os.path.join(tmp_dir, "eval"), concurrency=concurrency)
+        summary = _quiet(asyncio.run, evaluator.aevaluate_dataset(dataset))
+    return {
+        "examples_per_min": summary["examples_per_min"],
+        "tpo_latency_p50_s": summary["tpo_latency_p50_s"],
+        "tpo_latency_p90_s": summary["tpo_latency_p90_s"],
+        "llm_calls_per_example": summary["llm_calls_per_example"],
+        "errors": summary["errors"],
+    }
+
+
+def bench_prompts(n: int, path: Optional[str] = None) -> List[str]:
+    """`n` distinct prompts, cycling through data/prompts.txt."""
+    base = load_prompts_from_txt(path or os.path.join(ROOT, "data", "prompts.txt"))
+    return [f"{base[i % len(base)]} (#{i})" for i in range(n)]
+
+
+def flatten(report: Dict[str, Any]) -> Dict[str, float]:
+    metrics = {}
+    for section, values in report.items():
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            name = f"{section}.{key}"
+            if name in METRICS and isinstance(value, (int, float)):
+                metrics[name] = float(value)
+    return metrics
+
+
+def check_regressions(current: Dict[str, float], baseline: Dict[str, float],
+                      tolerance: float) -> List[str]:
+    """Metrics worse than the baseline by more than `tolerance` (relative)."""
+    failures = []
+    for name, direction in METRICS.items():
+        if name not in current or name not in baseline or not baseline[name]:
+            continue
+        change = (current[name] - baseline[name]) / abs(baseline[name])
+        if change * direction < -tolerance:
+            failures.append(f"{name}: {baseline[name]:.3f} -> {current[name]:.3f} ({change:+.0%})")
+    return failures
+
+
+def run_all(n_prompts: int = 8, levels: Optional[List[int]] = None,
+            workers: Optional[List[int]] = None, profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    profile = {**SIM_PROFILE, **(profile or {})}
+    levels = levels or [1, 2, 4, 8]
+    workers = workers or [1, 4]
+    prompts = bench_prompts(n_prompts)
+    report: Dict[str, Any] = {"profile": profile, "n_prompts": n_prompts}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, fn in [
+            ("run_tpo", lambda: bench_run_tpo(profile, prompts[: max(2, n_prompts // 2)])),
+            ("arun_tpo", lambda: bench_arun_tpo(profile, prompts, levels)),
+            ("collect", lambda: bench_collect(profile, prompts, workers, tmp_dir)),
+            ("eval", lambda: bench_eval(profile, prompts, 4, tmp_dir)),
+        ]:
+            start = time.perf_counter()
+            report[name] = fn()
+            print(f"⏱️ {name}: {time.perf_counter() - start:.1f}s")
+    report["metrics"] = flatten(report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline TPO benchmarks (simulated Ollama)")
+    parser.add_argument("--n-prompts", type=int, default=8)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="arun_tpo prompts in flight")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                        help="collect_tpo_trajectories worker counts")
+    parser.add_argument("--output", default=os.path.join(ROOT, "results", "bench", "bench_tpo.json"))
+    parser.add_argument("--save-baseline", help="also write the metrics to this baseline file")
+    parser.add_argument("--check", help="baseline JSON; exit 1 if any metric regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    report = run_all(args.n_prompts, args.levels, args.workers)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print("\n📊 Benchmark metrics:")
+    for name, value in report["metrics"].items():
+        print(f"  {name:32s} {value:10.3f}")
+    print(f"💾 Report: {args.output}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report["metrics"], f, indent=2)
+        print(f"💾 Baseline: {args.save_baseline}")
+
+    if args.check:
+        with open(args.check, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        failures = check_regressions(report["metrics"], baseline, args.tolerance)
+        if failures:
+            print(f"❌ {len(failures)} regression(s) beyond {args.tolerance:.0%}:")
+            for line in failures:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"✅ No regressions beyond {args.tolerance:.0%} vs {args.check}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# src/analysis.py - Paired bootstrap statistics and per-step score curves for benchmark results
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_BOOT = 10000
+_CHUNK_CELLS = 4_000_000  # resample indices materialized at once (32 MB as int64)
+
+
+def bootstrap_means(values: np.ndarray, n_boot: int = DEFAULT_BOOT, seed: int = 0) -> np.ndarray:
+    """
+    Means of `n_boot` resamples (with replacement) of the rows of `values`
+    (shape (n,) or (n, k)); returns shape (n_boot,) or (n_boot, k). Every
+    column is resampled with the same row draws, so paired statistics stay
+    paired. Each chunk of resamples becomes a count matrix via one bincount
+    and the means one matrix product.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    flat = x.ndim == 1
+    x = x.reshape(len(x), -1)
+    n = len(x)
+    if n == 0:
+        return np.full((n_boot,) if flat else (n_boot, x.shape[1]), np.nan)
+    rng = np.random.default_rng(seed)
+    chunk = max(1, min(n_boot, _CHUNK_CELLS // n))
+    out = np.empty((n_boot, x.shape[1]))
+    for start in range(0, n_boot, chunk):
+        b = min(chunk, n_boot - start)
+        idx = rng.integers(0, n, size=(b, n), dtype=np.int64)
+        idx += np.arange(b, dtype=np.int64)[:, None] * n
+        counts = np.bincount(idx.ravel(), minlength=b * n).reshape(b, n)
+        out[start:start + b] = counts @ x / n
+    return out[:, 0] if flat else out
+
+
+def interval(samples: np.ndarray, ci: float = 0.95) -> Tuple[np.ndarray, np.ndarray]:
+    """Percentile interval over the first axis."""
+    alpha = (1.0 - ci) / 2
+    lo, hi = np.quantile(samples, [alpha, 1.0 - alpha], axis=0)
+    return lo, hi
+
+
+class _Column:
+    """Growable float64 buffer (amortized doubling) for incremental records."""
+
+    def __init__(self, width: int = 1):
+        self._data = np.empty((256, width))
+        self.n = 0
+
+    def append(self, row: Iterable[float]) -> int:
+        if self.n == len(self._data):
+            self._data = np.concatenate([self._data, np.empty_like(self._data)])
+        self._data[self.n] = row
+        self.n += 1
+        return self.n - 1
+
+    def set(self, i: int, row: Iterable[float]) -> None:
+        self._data[i] = row
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[:self.n]
+
+
+class PairedScores:
+    """
+    Baseline vs TPO scores per example, fed one record at a time (evaluator
+    result records by default). Records with an error or a missing score are
+    ignored; a later record for an id already seen replaces it, so re-read or
+    resumed result files count each example once.
+    """
+
+    def __init__(self, baseline_key: str = "baseline_score", tpo_key: str = "tpo_score"):
+        self.baseline_key = baseline_key
+        self.tpo_key = tpo_key
+        self._rows = _Column(2)
+        self._index: Dict[str, int] = {}
+
+    def add(self, record: Dict[str, Any]) -> bool:
+        base, tpo = record.get(self.baseline_key), record.get(self.tpo_key)
+        if "error" in record or base is None or tpo is None:
+            return False
+        key = str(record.get("id", len(self._index)))
+        row = (float(base), float(tpo))
+        if key in self._index:
+            self._rows.set(self._index[key], row)
+        else:
+            self._index[key] = self._rows.append(row)
+        return True
+
+    def update(self, records: Iterable[Dict[str, Any]]) -> int:
+        return sum(self.add(r) for r in records)
+
+    def __len__(self) -> int:
+        return self._rows.n
+
+    @property
+    def baseline(self) -> np.ndarray:
+        return self._rows.values[:, 0]
+
+    @property
+    def tpo(self) -> np.ndarray:
+        return self._rows.values[:, 1]
+
+    def summary(self, n_boot: int = DEFAULT_BOOT, ci: float = 0.95, seed: int = 0) -> Dict[str, Any]:
+        """
+        Means with bootstrap CIs for baseline, TPO, their paired delta and the
+        win rate (ties count half), plus a two-sided bootstrap p-value for
+        delta != 0. Plain floats, ready for json.dump; all zero without records.
+        """
+        n = len(self)
+        delta = self.tpo - self.baseline
+        wins = np.where(delta > 0, 1.0, np.where(delta == 0, 0.5, 0.0))
+        cols = np.column_stack([self.baseline, self.tpo, delta, wins])
+        means = lo = hi = np.zeros(4)
+        p = 1.0
+        if n:
+            boot = bootstrap_means(cols, n_boot, seed)
+            means = cols.mean(axis=0)
+            lo, hi = interval(boot, ci)
+            if delta.any():
+                p = 2 * min(np.mean(boot[:, 2] <= 0), np.mean(boot[:, 2] >= 0))
+        out: Dict[str, Any] = {"n": n, "n_boot": n_boot, "ci": ci}
+        for j, name in enumerate(["baseline", "tpo", "delta", "win_rate"]):
+            key = name if name == "win_rate" else f"{name}_mean"
+            out[key] = float(means[j])
+            out[f"{name}_ci"] = [float(lo[j]), float(hi[j])]
+        out["delta_std"] = float(delta.std(ddof=1)) if n > 1 else 0.0
+        out["p_value"] = float(min(1.0, p))
+        return out
+
+
+class StepCurves:
+    """
+    Per-step score curves over TPO runs, fed one record at a time: records
+    with a "trajectory" of scored candidates (collect_tpo_trajectories into a
+    trajectory store) or with "step_scores" (evaluator). Per run and step:
+    the best score so far (the answer TPO would return if stopped there;
+    carried forward after an early stop) and the mean score of that step's
+    candidates.
+    """
+
+    def __init__(self):
+        self.best: List[np.ndarray] = []
+        self.step_mean: List[np.ndarray] = []
+
+    @staticmethod
+    def _run(record: Dict[str, Any]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if "step_scores" in record:  # evaluator records
+            pairs = [(step, x) for step, xs in enumerate(record["step_scores"]) for x in xs if x is not None]
+        else:
+            pairs = [(c["step"], c["score"]) for c in (record.get("trajectory") or {}).get("candidates", [])
+                     if c.get("score") is not None]
+        if not pairs:
+            return None
+        steps = np.array([p[0] for p in pairs], dtype=np.int64)
+        scores = np.array([p[1] for p in pairs], dtype=np.float64)
+        depth = int(steps.max()) + 1
+        step_best = np.full(depth, -np.inf)
+        np.maximum.at(step_best, steps, scores)
+        totals = np.bincount(steps, weights=scores, minlength=depth)
+        counts = np.bincount(steps, minlength=depth)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = totals / counts  # NaN for a step whose candidates were all pruned
+        return np.maximum.accumulate(step_best), mean
+
+    def add(self, record: Dict[str, Any]) -> bool:
+        run = self._run(record)
+        if run is None:
+            return False
+        self.best.append(run[0])
+        self.step_mean.append(run[1])
+        return True
+
+    def update(self, records: Iterable[Dict[str, Any]]) -> int:
+        return sum(self.add(r) for r in records)
+
+    def __len__(self) -> int:
+        return len(self.best)
+
+    def matrices(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(runs, steps) best-so-far (forward-filled) and step-mean (NaN-padded) arrays."""
+        depth = max(len(b) for b in self.best)
+        best = np.empty((len(self.best), depth))
+        mean = np.full((len(self.best), depth), np.nan)
+        for i, (b, m) in enumerate(zip(self.best, self.step_mean)):
+            best[i, :len(b)] = b
+            best[i, len(b):] = b[-1]
+            mean[i, :len(m)] = m
+        return best, mean
+
+    def summary(self, n_boot: int = DEFAULT_BOOT, ci: float = 0.95, seed: int = 0) -> Dict[str, Any]:
+        if not self.best:
+            return {"n": 0}
+        best, mean = self.matrices()
+        gain = best - best[:, :1]
+        boot = bootstrap_means(np.hstack([best, gain]), n_boot, seed)
+        lo, hi = interval(boot, ci)
+        depth = best.shape[1]
+        reached = (~np.isnan(mean)).sum(axis=0)
+        with np.errstate(invalid="ignore"):
+            step_mean = np.where(reached > 0, np.nansum(mean, axis=0) / np.maximum(reached, 1), np.nan)
+        return {
+            "n": len(self.best),
+            "n_boot": n_boot,
+            "ci": ci,
+            "steps": list(range(depth)),
+            "runs_reaching_step": reached.tolist(),
+            "best_so_far": best.mean(axis=0).tolist(),
+            "best_so_far_ci": [lo[:depth].tolist(), hi[:depth].tolist()],
+            "gain_over_step0": gain.mean(axis=0).tolist(),
+            "gain_over_step0_ci": [lo[depth:].tolist(), hi[depth:].tolist()],
+            "step_mean": [None if np.isnan(v) else float(v) for v in step_mean],
+        }
+
+
+def read_new_records(path: str, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    JSON records from complete lines after byte `offset`, and the offset to
+    resume from; a line still being written is left for the next call.
+    """
+    records = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records, offset
+
+
+def iter_trajectories(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a trajectory store directory or a JSONL file."""
+    if os.path.isdir(path):
+        from trajectory_store import TrajectoryReader
+        reader = TrajectoryReader(path)
+        try:
+            yield from reader
+        finally:
+            reader.close()
+    else:
+        yield from read_new_records(path)[0]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Bootstrap statistics for evaluator results and TPO trajectories")
+    parser.add_argument("results", nargs="*", help="<dataset>.results.jsonl files from evaluator.py")
+    parser.add_argument("--trajectories", nargs="*", default=[],
+                        help="trajectory store directories or JSONL files for per-step curves")
+    parser.add_argument("--n-boot", type=int, default=DEFAULT_BOOT)
+    parser.add_argument("--ci", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    report: Dict[str, Any] = {"results": {}, "curves": {}}
+    for path in args.results:
+        paired = PairedScores()
+        paired.update(read_new_records(path)[0])
+        s = paired.summary(args.n_boot, args.ci, args.seed)
+        report["results"][os.path.basename(path)] = s
+        if s["n"]:
+            print(f"📊 {os.path.basename(path)}: n={s['n']} Δ={s['delta_mean']:+.3f} "
+                  f"[{s['delta_ci'][0]:+.3f}, {s['delta_ci'][1]:+.3f}] win={s['win_rate']:.2f} p={s['p_value']:.3g}")
+    for path in args.trajectories:
+        curves = StepCurves()
+        curves.update(iter_trajectories(path))
+        report["curves"][os.path.basename(os.path.normpath(path))] = curves.summary(args.n_boot, args.ci, args.seed)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"💾 {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
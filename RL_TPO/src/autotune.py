@@ -0,0 +1,390 @@
+# src/autotune.py - Probe the local Ollama host and write a tuned TPO/Ollama config overlay
+import itertools
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+import ollama
+import yaml
+
+from config_loader import OVERLAY_FILE, load_all_configs
+
+TPO_ROLES = ("policy", "rm_primary", "loss_critic", "gradient_gen")
+PROBE_TEXT = (
+    "Explain step by step how a household solar panel system turns sunlight into "
+    "usable electricity, covering the panels, the inverter, the battery and the grid "
+    "connection, and finish with three practical tips for a first-time buyer."
+)
+_QUANT_RE = re.compile(r"-(q\d\w*|fp16|f16|f32|bf16)$", re.IGNORECASE)
+
+
+def model_family(tag: str) -> str:
+    """Tag without its quantization suffix: llama3.1:8b-instruct-q4_K_M -> llama3.1:8b-instruct."""
+    return _QUANT_RE.sub("", tag)
+
+
+def host_memory_gb() -> Optional[float]:
+    """Total RAM of this machine, if it can be read."""
+    try:
+        import psutil
+        return psutil.virtual_memory().total / 1024 ** 3
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    return None
+
+
+def tpo_workload(configs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, int]]:
+    """
+    Per-prompt work of each TPO role for one run of N samples and D steps with
+    pointwise scoring (TPO_Engine.run_tpo): calls, how many of them can run
+    side by side, and prompt / output tokens per call. Outputs are taken at
+    max_tokens, so this is a worst case; only the ratios between plans matter.
+    """
+    tpo = configs["tpo_config.yaml"]
+    models = configs["models.yaml"]["models"]
+    n, d = tpo.get("n_samples", 5), tpo.get("n_steps", 2)
+    query, system = 64, 48
+    answer = models["policy"].get("max_tokens", 512)
+    loss = models["loss_critic"].get("max_tokens", 512)
+    grad = models["gradient_gen"].get("max_tokens", 256)
+    return {
+        "policy": {"calls": n * (d + 1), "parallel": n, "prompt": system + query + grad, "output": answer},
+        "rm_primary": {"calls": n * (d + 1), "parallel": n, "prompt": system + query + answer,
+                       "output": models["rm_primary"].get("score_max_tokens", 16)},
+        "loss_critic": {"calls": d, "parallel": 1, "prompt": system + query + 2 * answer, "output": loss},
+        "gradient_gen": {"calls": d, "parallel": 1, "prompt": system + loss, "output": grad},
+    }
+
+
+class HostProbe:
+    """
+    Short measured workloads against one Ollama server. Loading a model first
+    evicts everything resident, so run it on an otherwise idle box.
+    """
+
+    def __init__(self, host: Optional[str] = None, num_predict: int = 64):
+        self.host = host
+        self.client = ollama.Client(host=host)
+        self.num_predict = num_predict
+        self._nonce = itertools.count()
+
+    def unload_all(self) -> None:
+        for m in self.client.ps().models:
+            self.client.chat(model=m.model, messages=[], keep_alive=0)
+
+    def load(self, tag: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        """Cold load with `options`: load time and resident size."""
+        self.unload_all()
+        start = time.perf_counter()
+        resp = self.client.chat(model=tag, messages=[], options=options)
+        load_s = (resp.get("load_duration") or 0) / 1e9 or time.perf_counter() - start
+        size = next((m.size for m in self.client.ps().models if m.model == tag), None)
+        return {"load_s": load_s, "size_gb": size / 1024 ** 3 if size else None}
+
+    def generate(self, tag: str, options: Dict[str, Any], concurrency: int = 1,
+                 requests: Optional[int] = None) -> Dict[str, Any]:
+        """
+        `requests` calls (default: `concurrency`), `concurrency` at a time;
+        prompts differ so no KV prefix is reused.
+        """
+        requests = requests or concurrency
+        def one(_):
+            prompt = f"[{next(self._nonce)}] {PROBE_TEXT}"
+            return self.client.chat(
+                model=tag, messages=[{"role": "user", "content": prompt}],
+                options=dict(options, num_predict=self.num_predict, temperature=0.7),
+            )
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as ex:
+            resps = list(ex.map(one, range(requests)))
+        wall = time.perf_counter() - start
+
+        def rate(count_key: str, duration_key: str) -> Optional[float]:
+            tokens = sum(r.get(count_key) or 0 for r in resps)
+            seconds = sum(r.get(duration_key) or 0 for r in resps) / 1e9
+            return tokens / seconds if tokens and seconds > 0 else None
+
+        return {
+            "decode_tps": rate("eval_count", "eval_duration"),
+            "prefill_tps": rate("prompt_eval_count", "prompt_eval_duration"),
+            "prompt_tokens": sum(r.get("prompt_eval_count") or 0 for r in resps) / requests,
+            "output_tokens": sum(r.get("eval_count") or 0 for r in resps) / requests,
+            "latency_s": wall * concurrency / requests,
+            "calls_per_s": requests / wall,
+        }
+
+
+class AutoTuner:
+    """
+    Measures every TPO role's model tag under each (num_ctx, num_thread)
+    setting, then the request concurrency it sustains, and turns that into a
+    plan: per tag the fastest setting whose context fits its roles and whose
+    size fits `memory_gb`, per role the concurrency past which throughput
+    stops growing. Plans are compared by estimated prompts/min, including the
+    model loads paid when the role tags do not all fit in memory at once.
+    Roles of one model family using different quantizations are candidates
+    for sharing a single tag (`sharing_options`).
+    """
+
+    def __init__(self, configs: Dict[str, Dict[str, Any]], probe: HostProbe,
+                 memory_gb: Optional[float] = None, threads: Optional[Iterable[int]] = None,
+                 contexts: Iterable[int] = (2048, 4096, 8192), concurrency: Iterable[int] = (1, 2, 4),
+                 extra_tags: Iterable[str] = ()):
+        cpus = os.cpu_count() or 1
+        self.configs = configs
+        self.probe = probe
+        self.memory_gb = memory_gb
+        self.threads = sorted(set(threads or {max(1, cpus // 2), cpus}))
+        self.contexts = sorted(set(contexts))
+        self.concurrency = sorted(set(concurrency) | {1})
+        self.extra_tags = list(extra_tags)
+        self.work = tpo_workload(configs)
+        self.measured: Dict[str, Dict[str, Any]] = {}
+
+    def role_tags(self) -> Dict[str, str]:
+        models = self.configs["models.yaml"]["models"]
+        return {role: models[role]["tag"] for role in TPO_ROLES}
+
+    def required_ctx(self, role: str) -> int:
+        return self.work[role]["prompt"] + self.work[role]["output"]
+
+    # ---- measurement
+
+    def measure(self) -> Dict[str, Dict[str, Any]]:
+        tags = sorted(set(self.role_tags().values()) | set(self.extra_tags))
+        for tag in tags:
+            settings = []
+            for num_ctx, num_thread in itertools.product(self.contexts, self.threads):
+                options = {"num_ctx": num_ctx, "num_thread": num_thread}
+                s = dict(options, **self.probe.load(tag, options), **self.probe.generate(tag, options))
+                settings.append(s)
+                size = f"{s['size_gb']:.1f}GB" if s["size_gb"] else "?GB"
+                decode = f"{s['decode_tps']:.1f}" if s["decode_tps"] else "?"
+                print(f"  {tag} ctx={num_ctx} threads={num_thread}: {decode} tok/s, "
+                      f"load {s['load_s']:.1f}s, {size}")
+            best = max(settings, key=lambda s: s["calls_per_s"])
+            options = {"num_ctx": best["num_ctx"], "num_thread": best["num_thread"]}
+            # Same number of calls at every level, enough to keep the largest one busy twice
+            n = 2 * self.concurrency[-1]
+            rates = {k: self.probe.generate(tag, options, k, n)["calls_per_s"] for k in self.concurrency}
+            speedup = {k: rate / rates[1] for k, rate in rates.items()}
+            print(f"  {tag} concurrency speedup: "
+                  + ", ".join(f"x{k}={v:.2f}" for k, v in speedup.items()))
+            self.measured[tag] = {"settings": settings, "speedup": speedup}
+        self.probe.unload_all()
+        return self.measured
+
+    # ---- planning
+
+    def _fits(self, s: Dict[str, Any]) -> bool:
+        return self.memory_gb is None or s["size_gb"] is None or s["size_gb"] <= self.memory_gb
+
+    def setting_for(self, tag: str, roles: List[str]) -> Optional[Dict[str, Any]]:
+        """Fastest measured setting of `tag` that fits memory and the longest prompt of `roles`."""
+        fitting = [s for s in self.measured[tag]["settings"] if self._fits(s)]
+        need = max(self.required_ctx(r) for r in roles)
+        enough = [s for s in fitting if s["num_ctx"] >= need]
+        if enough:
+            return max(enough, key=lambda s: (s["calls_per_s"], -s["num_ctx"]))
+        # Nothing long enough fits: the largest context that does (long prompts get truncated)
+        return max(fitting, key=lambda s: (s["num_ctx"], s["calls_per_s"])) if fitting else None
+
+    def best_concurrency(self, tag: str, parallel: int) -> int:
+        """Smallest concurrency within 10% of the best measured speedup (at most `parallel`)."""
+        speedup = {k: v for k, v in self.measured[tag]["speedup"].items() if k <= max(1, parallel)}
+        top = max(speedup.values())
+        return min(k for k, v in speedup.items() if v >= 0.9 * top)
+
+    def _call_s(self, s: Dict[str, Any], prompt: int, output: int) -> float:
+        """Seconds for one call, extrapolated from the probe's token rates and fixed overhead."""
+        prefill = prompt / s["prefill_tps"] if s["prefill_tps"] else 0.0
+        decode = output / s["decode_tps"] if s["decode_tps"] else 0.0
+        probe_tokens = ((s["prompt_tokens"] / s["prefill_tps"] if s["prefill_tps"] else 0.0)
+                        + (s["output_tokens"] / s["decode_tps"] if s["decode_tps"] else 0.0))
+        return max(0.0, s["latency_s"] - probe_tokens) + prefill + decode
+
+    def estimate(self, assignment: Dict[str, str]) -> Dict[str, Any]:
+        """Estimated TPO throughput with role -> tag `assignment`."""
+        by_tag: Dict[str, List[str]] = {}
+        for role, tag in assignment.items():
+            by_tag.setdefault(tag, []).append(role)
+        settings = {tag: self.setting_for(tag, roles) for tag, roles in by_tag.items()}
+        too_big = sorted(tag for tag, s in settings.items() if s is None)
+        if too_big:
+            return {"feasible": False, "too_big": too_big}
+
+        concurrency, role_s = {}, {}
+        for role, tag in assignment.items():
+            w = self.work[role]
+            k = self.best_concurrency(tag, w["parallel"])
+            concurrency[role] = k
+            role_s[role] = w["calls"] * self._call_s(settings[tag], w["prompt"], w["output"]) \
+                / self.measured[tag]["speedup"][k]
+
+        memory = sum(s["size_gb"] or 0.0 for s in settings.values())
+        resident = self.memory_gb is None or memory <= self.memory_gb
+        swap_s = 0.0
+        if not resident:
+            # run_tpo order per prompt: policy, RM, then loss, gradient, policy, RM per step
+            steps = self.configs["tpo_config.yaml"].get("n_steps", 2)
+            order = ["policy", "rm_primary"] + ["loss_critic", "gradient_gen", "policy", "rm_primary"] * steps
+            tags = [assignment[r] for r in order]
+            loads = [t for i, t in enumerate(tags) if i == 0 or t != tags[i - 1]]
+            swap_s = sum(settings[t]["load_s"] for t in loads)
+        seconds = sum(role_s.values()) + swap_s
+        return {
+            "feasible": True,
+            "seconds_per_prompt": seconds,
+            "prompts_per_min": 60.0 / seconds if seconds > 0 else float("inf"),
+            "swap_s_per_prompt": swap_s,
+            "resident": resident,
+            "memory_gb": memory,
+            "role_s": role_s,
+            "concurrency": concurrency,
+            "settings": {tag: {k: s[k] for k in ("num_ctx", "num_thread", "size_gb", "load_s")}
+                         for tag, s in settings.items()},
+        }
+
+    def sharing_options(self, assignment: Dict[str, str]) -> List[Dict[str, Any]]:
+        """Plans where roles of one model family share one measured tag, best first."""
+        families: Dict[str, List[str]] = {}
+        for role, tag in assignment.items():
+            families.setdefault(model_family(tag), []).append(role)
+        options = []
+        for family, roles in families.items():
+            if len(roles) < 2 or len({assignment[r] for r in roles}) < 2:
+                continue
+            for tag in sorted(t for t in self.measured if model_family(t) == family):
+                est = self.estimate(dict(assignment, **{r: tag for r in roles}))
+                if est["feasible"]:
+                    options.append({"roles": roles, "tag": tag, **{
+                        k: est[k] for k in ("prompts_per_min", "resident", "memory_gb", "swap_s_per_prompt")
+                    }})
+        return sorted(options, key=lambda o: -o["prompts_per_min"])
+
+    def overlay(self, assignment: Dict[str, str], plan: Dict[str, Any]) -> Dict[str, Any]:
+        """config_loader overlay: per-role runtime options (and tags), per-role concurrency."""
+        base = self.role_tags()
+        models = {}
+        for role, tag in assignment.items():
+            s = plan["settings"][tag]
+            entry: Dict[str, Any] = {"num_ctx": s["num_ctx"], "num_thread": s["num_thread"]}
+            if tag != base[role]:
+                entry["tag"] = tag
+            if plan["resident"]:
+                entry["keep_alive"] = "30m"  # everything fits: never reload between stages
+            models[role] = entry
+        return {"models.yaml": {"models": models}, "tpo_config.yaml": {"concurrency": plan["concurrency"]}}
+
+    def run(self, share: bool = False) -> Dict[str, Any]:
+        """Measure, plan and return the report (with the overlay to write under "overlay")."""
+        self.measure()
+        current_tags = self.role_tags()
+        current = self.estimate(current_tags)
+        suggestions = self.sharing_options(current_tags)
+        assignment = dict(current_tags)
+        if share and suggestions and (
+                not current["feasible"] or suggestions[0]["prompts_per_min"] > current["prompts_per_min"]):
+            assignment.update({r: suggestions[0]["tag"] for r in suggestions[0]["roles"]})
+        plan = self.estimate(assignment)
+        return {
+            "host": self.probe.host,
+            "memory_gb": self.memory_gb,
+            "workload": self.work,
+            "measurements": self.measured,
+            "current": current,
+            "suggestions": suggestions,
+            "assignment": assignment,
+            "plan": plan,
+            "overlay": self.overlay(assignment, plan) if plan["feasible"] else None,
+        }
+
+
+def write_overlay(path: str, overlay: Dict[str, Any], report: Dict[str, Any]) -> None:
+    plan = report["plan"]
+    header = [
+        "# Generated by `python src/autotune.py`; merged over the YAMLs in this directory",
+        f"# host={report['host'] or 'default'} memory_gb={report['memory_gb']} "
+        f"est_prompts_per_min={plan['prompts_per_min']:.2f} resident={plan['resident']}",
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(header) + "\n")
+        yaml.safe_dump(overlay, f, sort_keys=False)
+
+
+def main():
+    import argparse
+
+    def ints(text: str) -> List[int]:
+        return [int(x) for x in text.split(",") if x]
+
+    parser = argparse.ArgumentParser(description="Benchmark this Ollama host and write a tuned config overlay")
+    parser.add_argument("--project-root", default=os.path.join(os.path.dirname(__file__), ".."))
+    parser.add_argument("--host", help="Ollama server (default: first endpoint in models.yaml)")
+    parser.add_argument("--memory-gb", type=float,
+                        help="memory ceiling for resident models (default: 80%% of RAM)")
+    parser.add_argument("--threads", type=ints, help="num_thread values to try (default: half and all cores)")
+    parser.add_argument("--ctx", type=ints, default=[2048, 4096, 8192], help="num_ctx values to try")
+    parser.add_argument("--concurrency", type=ints, default=[1, 2, 4], help="request concurrency to try")
+    parser.add_argument("--num-predict", type=int, default=64, help="tokens generated per probe call")
+    parser.add_argument("--extra-tags", default="", help="comma-separated tags to consider for sharing")
+    parser.add_argument("--share", action="store_true", help="apply the best tag-sharing suggestion")
+    parser.add_argument("--report", help="write the full JSON report here")
+    parser.add_argument("--dry-run", action="store_true", help="do not write config/tuned.yaml")
+    args = parser.parse_args()
+
+    configs = load_all_configs(args.project_root, overlay=False)
+    host = args.host
+    if host is None:
+        endpoints = configs["models.yaml"].get("endpoints") or {}
+        host = next(iter(endpoints.values()), {}).get("host") if endpoints else None
+    memory_gb = args.memory_gb
+    if memory_gb is None and host_memory_gb() is not None:
+        memory_gb = round(0.8 * host_memory_gb(), 1)
+
+    tuner = AutoTuner(configs, HostProbe(host, args.num_predict), memory_gb=memory_gb,
+                      threads=args.threads, contexts=args.ctx, concurrency=args.concurrency,
+                      extra_tags=[t for t in args.extra_tags.split(",") if t])
+    print(f"Autotune: host={host or 'default'}, memory ceiling={memory_gb} GB, "
+          f"threads={tuner.threads}, ctx={tuner.contexts}, concurrency={tuner.concurrency}")
+    report = tuner.run(share=args.share)
+
+    current, plan = report["current"], report["plan"]
+    if current["feasible"]:
+        print(f"Current tags: {current['prompts_per_min']:.2f} prompts/min (est.), "
+              f"{current['memory_gb']:.1f} GB, resident={current['resident']}")
+    else:
+        print(f"Current tags do not fit in {memory_gb} GB: {current['too_big']}")
+    for s in report["suggestions"][:3]:
+        print(f"💡 Share {s['tag']} for {', '.join(s['roles'])}: {s['prompts_per_min']:.2f} prompts/min, "
+              f"{s['memory_gb']:.1f} GB, resident={s['resident']}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if not plan["feasible"]:
+        print(f"❌ No feasible plan: {plan['too_big']} exceed {memory_gb} GB at every probed setting")
+        return
+    print(f"Tuned plan: {plan['prompts_per_min']:.2f} prompts/min (est.), concurrency {plan['concurrency']}")
+    if not plan["resident"]:
+        print("   Models do not all fit: prefer batch_engine.BatchTPO (collect --batch-size) to limit swaps")
+    if args.dry_run:
+        print(yaml.safe_dump(report["overlay"], sort_keys=False))
+        return
+    path = os.path.join(args.project_root, "config", OVERLAY_FILE)
+    write_overlay(path, report["overlay"], report)
+    print(f"✅ Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
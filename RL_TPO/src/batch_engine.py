@@ -0,0 +1,243 @@
+# src/batch_engine.py - Stage-by-stage TPO over many prompts (model-affinity scheduling)
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from budget import TPOBudget
+from candidate_pool import CandidatePool
+from models import track_usage
+from scoring import CascadeScorer
+from tpo_core import TPO_Engine
+
+
+class BatchTPO:
+    """
+    Runs TPO for a batch of prompts one stage at a time: sample all, score all,
+    critique all, gradient all, update all, score all, ... Each stage uses a
+    single role, so the server keeps one model resident for the whole stage
+    instead of swapping policy -> RM -> critic -> gradient per prompt.
+
+    With `unload_between_stages` the previous model is evicted (keep_alive=0)
+    before a stage that needs a different tag, so small-RAM hosts never hold
+    two models at once. Convergence settings from the `budget` section of
+    tpo_config.yaml drop finished prompts from later stages; wall-clock and
+    token limits are per-query concepts and are not applied here.
+    With `trajectory`, results carry the full run history like
+    TPO_Engine.run_tpo_budgeted(trajectory=True).
+    A prompt whose call fails in any stage gets an {"query", "error"} result
+    and drops out of later stages; the rest of the batch is unaffected.
+    """
+
+    def __init__(self, engine: TPO_Engine, unload_between_stages: bool = False,
+                 trajectory: bool = False):
+        self.engine = engine
+        self.unload_between_stages = unload_between_stages
+        self.trajectory = trajectory
+        self.stage_log: List[Dict[str, Any]] = []
+        self.report: Dict[str, Any] = {}
+        self._resident: Optional[str] = None
+
+    def _role(self, name: str):
+        return getattr(self.engine.models, name)
+
+    async def _stage(self, name: str, role_name: str, states: List[Dict[str, Any]],
+                     call: Callable[[Dict[str, Any]], Awaitable], key: str) -> List[Dict[str, Any]]:
+        """
+        Runs call(st) for every prompt state concurrently and stores each result
+        under st[key]. A prompt whose call raises (e.g. a timeout after retries)
+        gets st["error"] and is left out of the returned states, so later
+        stages skip it while the rest of the batch carries on.
+        """
+        if not states:
+            return []
+        role = self._role(role_name)
+        if self.unload_between_stages and self._resident and self._resident != role.tag:
+            prev = next(r for r in self.engine.models.roles().values() if r.tag == self._resident)
+            await asyncio.to_thread(prev.unload)
+        self._resident = role.tag
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(call(st) for st in states), return_exceptions=True)
+        ok = []
+        for st, res in zip(states, results):
+            if isinstance(res, Exception):
+                st["error"] = f"{type(res).__name__}: {res}"
+            elif isinstance(res, BaseException):
+                raise res
+            else:
+                st[key] = res
+                ok.append(st)
+        self.stage_log.append({
+            "stage": name,
+            "role": role_name,
+            "tag": role.tag,
+            "prompts": len(states),
+            "failed": len(states) - len(ok),
+            "elapsed_s": time.perf_counter() - start,
+        })
+        failed = f", {len(states) - len(ok)} failed" if len(ok) < len(states) else ""
+        print(f"  [{name}] {role.tag}: {len(states)} prompts in {self.stage_log[-1]['elapsed_s']:.1f}s{failed}")
+        return ok
+
+    async def _prune(self, states: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        e = self.engine
+        if e.diversity is None:
+            for st in states:
+                st["fresh"] = st["pool"].dedup(st["fresh"])
+            return states
+        return await self._stage("prune", e.diversity.embedder.name, states,
+                                 lambda st: e.aprune_candidates(st["pool"], st["fresh"]), "fresh")
+
+    async def _score(self, states: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        One "score" stage, or with cascade scoring a "score_cheap" stage (cheap
+        RM on every set) followed by a "score" stage (full RM on the promoted
+        candidates), so each stage still keeps one model resident.
+        """
+        e = self.engine
+        if not isinstance(e.scorer, CascadeScorer):
+            return await self._stage("score", e.score_role, states,
+                                     lambda st: e.ascore_responses(st["query"], st["fresh"]), "scores")
+        cascade = e.scorer
+        states = await self._stage("score_cheap", cascade.cheap.rm.name, states,
+                                   lambda st: cascade.acheap(st["query"], st["fresh"]), "cheap")
+        for st in states:
+            st["promote"] = cascade.to_promote(st["cheap"], len(st["fresh"]))
+        states = await self._stage("score", e.score_role, states,
+                                   lambda st: cascade.afull(st["query"], st["fresh"], st["promote"]), "full")
+        for st in states:
+            full, rest = st["full"]
+            st["scores"] = cascade.combine(len(st["fresh"]), st["cheap"], st["promote"], full, rest)
+        return states
+
+    def _score_tags(self) -> List[str]:
+        e = self.engine
+        tags = [self._role(e.score_role).tag]
+        if isinstance(e.scorer, CascadeScorer):
+            tags.insert(0, e.scorer.cheap.rm.tag)
+        if e.diversity is not None:
+            tags.insert(0, e.diversity.embedder.tag)
+        return tags
+
+    def naive_model_switches(self, steps_run: List[int]) -> int:
+        """Model loads if each prompt had run its whole loop before the next one (run_tpo order)."""
+        m = self.engine.models
+        score = self._score_tags()
+        iteration = [m.loss_critic.tag, m.gradient_gen.tag, m.policy.tag] + score
+        sequence = []
+        for steps in steps_run:
+            sequence += [m.policy.tag] + score + iteration * steps
+        return _switches(sequence)
+
+    def run(self, queries: List[str]) -> List[Dict[str, Any]]:
+        return asyncio.run(self.arun(queries))
+
+    async def arun(self, queries: List[str]) -> List[Dict[str, Any]]:
+        e = self.engine
+        cfg = e.budget_cfg
+        self.stage_log = []
+        start = time.perf_counter()
+        print(f"Batch TPO: {len(queries)} prompts, N={e.n_samples}, D={e.n_steps}")
+
+        with track_usage() as usage:
+            states = [{
+                "query": q,
+                "pool": CandidatePool(e.max_cache_size),
+                "budget": TPOBudget(
+                    usage,
+                    target_score=cfg.get("target_score"),
+                    min_gap=cfg.get("min_gap"),
+                    patience=cfg.get("patience"),
+                    min_improvement=cfg.get("min_improvement", 0.0) or 0.0,
+                ),
+                "stop_reason": "completed",
+                "steps_run": 0,
+                "error": None,
+                "traj": {"candidates": [], "steps": []} if self.trajectory else None,
+            } for q in queries]
+
+            live = await self._stage("sample", "policy", states, lambda st: e.asample_candidates(st["query"]), "fresh")
+            live = await self._score(await self._prune(live))
+            for st in live:
+                e._add_scored(st["pool"], st["fresh"], st["scores"], 0)
+                e._log_candidates(st["traj"], st["fresh"], st["scores"], 0)
+                if not st["pool"]:
+                    st["error"] = "Reward model returned no parsable scores"
+
+            for step in range(e.n_steps):
+                active = []
+                for st in states:
+                    if st["error"] or st["stop_reason"] != "completed":
+                        continue
+                    pool = st["pool"]
+                    reason = st["budget"].converged(pool.best.score, pool.best.score, pool.worst.score)
+                    if reason:
+                        st["stop_reason"] = reason
+                    else:
+                        active.append(st)
+                if not active:
+                    break
+                print(f"\n--- Batch iteration {step+1}/{e.n_steps}: {len(active)} active ---")
+
+                for st in active:
+                    st["pair"] = (st["pool"].best, st["pool"].worst)
+                active = await self._stage("loss", "loss_critic", active, lambda st: e.acompute_textual_loss(
+                    st["query"], st["pair"][0].text, st["pair"][1].text), "loss")
+                active = await self._stage("gradient", "gradient_gen", active,
+                                           lambda st: e.acompute_textual_gradient(st["loss"]), "grad")
+                active = await self._stage("update", "policy", active,
+                                           lambda st: e.aupdate_responses(st["query"], st["grad"]), "fresh")
+                active = await self._score(await self._prune(active))
+                for st in active:
+                    chosen, rejected = st["pair"]
+                    e._add_scored(st["pool"], st["fresh"], st["scores"], step + 1, gradient_id=step)
+                    e._log_candidates(st["traj"], st["fresh"], st["scores"], step + 1)
+                    e._log_step(st["traj"], step + 1, chosen.text, chosen.score,
+                                rejected.text, rejected.score, st["loss"], st["grad"])
+                    st["steps_run"] += 1
+
+        results = []
+        for st in states:
+            if st["error"]:
+                results.append({"query": st["query"], "error": st["error"]})
+                continue
+            res = {
+                "query": st["query"],
+                "response": st["pool"].best.text,
+                "score": st["pool"].best.score,
+                "stop_reason": st["stop_reason"],
+                "steps_run": st["steps_run"],
+            }
+            if st["traj"] is not None:
+                res["trajectory"] = st["traj"]
+            results.append(res)
+
+        batched = _switches([s["tag"] for s in self.stage_log])
+        naive = self.naive_model_switches([st["steps_run"] for st in states])
+        self.report = {
+            "prompts": len(queries),
+            "stages": len(self.stage_log),
+            "elapsed_s": time.perf_counter() - start,
+            "llm_calls": usage.calls,
+            "model_switches": batched,
+            "naive_model_switches": naive,
+            "model_loads_avoided": naive - batched,
+            "measured_model_loads": usage.model_loads,
+            "measured_load_s": usage.load_s,
+        }
+        print(
+            f"✅ Batch TPO done: {batched} model switches vs {naive} in per-prompt order "
+            f"({naive - batched} loads avoided); server reported {usage.model_loads} loads "
+            f"/ {usage.load_s:.1f}s loading"
+        )
+        return results
+
+
+def _switches(tags: List[str]) -> int:
+    """Model loads for a call sequence: first load + every change of tag."""
+    loads, prev = 0, None
+    for tag in tags:
+        if tag != prev:
+            loads += 1
+            prev = tag
+    return loads
@@ -0,0 +1,76 @@
+# src/budget.py - Wall-clock / token budgets and early stopping for anytime TPO
+import time
+from typing import Dict, Any, List, Optional
+
+from models import Usage
+
+
+class TPOBudget:
+    """
+    Decides when an anytime TPO run should stop.
+
+    Hard limits (checked between stages): `deadline_s` seconds since the run
+    started and `token_budget` prompt+completion tokens. Convergence (checked
+    after each scored step): best score reached `target_score`, chosen/rejected
+    gap below `min_gap`, or best score improved by less than `min_improvement`
+    over the last `patience` steps.
+    """
+
+    def __init__(
+        self,
+        usage: Usage,
+        deadline_s: Optional[float] = None,
+        token_budget: Optional[int] = None,
+        target_score: Optional[float] = None,
+        min_gap: Optional[float] = None,
+        patience: Optional[int] = None,
+        min_improvement: float = 0.0,
+    ):
+        self.usage = usage
+        self.deadline_s = deadline_s
+        self.token_budget = token_budget
+        self.target_score = target_score
+        self.min_gap = min_gap
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.start = time.monotonic()
+        self.best_history: List[float] = []
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any], usage: Usage, **overrides) -> "TPOBudget":
+        params = {
+            key: cfg.get(key)
+            for key in ("deadline_s", "token_budget", "target_score", "min_gap", "patience")
+        }
+        params["min_improvement"] = cfg.get("min_improvement", 0.0) or 0.0
+        params.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(usage, **params)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline_s is None:
+            return None
+        return max(self.deadline_s - self.elapsed(), 0.0)
+
+    def exhausted(self) -> Optional[str]:
+        """Stop reason if a hard limit is hit, else None."""
+        if self.deadline_s is not None and self.elapsed() >= self.deadline_s:
+            return "deadline"
+        if self.token_budget is not None and self.usage.total_tokens >= self.token_budget:
+            return "token_budget"
+        return None
+
+    def converged(self, best: float, chosen: float, rejected: float) -> Optional[str]:
+        """Record this step's best score; stop reason if the run has converged."""
+        self.best_history.append(best)
+        if self.target_score is not None and best >= self.target_score:
+            return "target_score"
+        if self.min_gap is not None and chosen - rejected < self.min_gap:
+            return "small_gap"
+        if self.patience and len(self.best_history) > self.patience:
+            window = self.best_history[-(self.patience + 1):]
+            if window[-1] - window[0] < self.min_improvement:
+                return "plateau"
+        return None
@@ -0,0 +1,131 @@
+# src/cache.py - Persistent content-addressed cache for LLM responses
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+
+class ResponseCache:
+    """
+    On-disk response cache backed by a single SQLite file.
+
+    Keys are sha256 digests of (model tag, messages, sampling options), so any
+    change to the prompt or sampling settings is a miss. The total size of stored
+    responses is capped at `max_bytes`; the least recently used entries are evicted
+    first. Safe to share between threads and between processes (WAL mode).
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        out_dir = os.path.dirname(path)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)"
+        )
+        self._db.commit()
+        self._total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": messages, "options": options},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        # Re-read the true total: other processes may share this file.
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        )
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self.evictions += len(stale)
+        self._total = total
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self._total = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
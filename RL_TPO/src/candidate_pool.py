@@ -0,0 +1,109 @@
+# src/candidate_pool.py - Bounded, deduplicating candidate pool for the TPO loop
+import hashlib
+import heapq
+import itertools
+import re
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+_WS_RE = re.compile(r"\s+")
+
+
+class Candidate:
+    __slots__ = ("text", "score", "step", "meta", "seq")
+
+    def __init__(self, text: str, score: float, step: int, meta: Dict[str, Any], seq: int):
+        self.text = text
+        self.score = score
+        self.step = step
+        self.meta = meta
+        self.seq = seq
+
+    def __lt__(self, other: "Candidate") -> bool:
+        # Heap order: lower score first; among equal scores the older one
+        return (self.score, self.seq) < (other.score, other.seq)
+
+    def __repr__(self) -> str:
+        return f"Candidate(score={self.score:.2f}, step={self.step}, text={self.text[:40]!r})"
+
+
+class CandidatePool:
+    """
+    Scored TPO candidates, capped at `capacity` by evicting the lowest score.
+
+    A min-heap gives O(log n) insert/evict and O(1) access to the rejected
+    (lowest) candidate; the chosen (highest) candidate is tracked on insert.
+    Responses are deduplicated on a hash of their normalized text (case and
+    whitespace folded) *before* scoring, so repeats never reach the RM.
+    Candidates keep a reference to their text plus free-form metadata.
+    """
+
+    def __init__(self, capacity: int = 50):
+        self.capacity = max(1, int(capacity))
+        self._heap: List[Candidate] = []
+        self._best: Optional[Candidate] = None
+        self._seen: Set[bytes] = set()
+        self._seq = itertools.count()
+        self.embeddings: List[List[float]] = []  # vectors of kept texts (diversity.DiversityFilter)
+        self.duplicates = 0
+        self.evicted = 0
+
+    @staticmethod
+    def fingerprint(text: str) -> bytes:
+        normalized = _WS_RE.sub(" ", text).strip().lower()
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+    def dedup(self, texts: List[str]) -> List[str]:
+        """
+        Texts not seen before (in this pool or earlier in `texts`). They are
+        registered as seen, so a later identical sample is also skipped even if
+        this one fails to score or is evicted.
+        """
+        fresh = []
+        for text in texts:
+            key = self.fingerprint(text)
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            fresh.append(text)
+        return fresh
+
+    def add(self, text: str, score: float, step: int = 0, **meta: Any) -> Candidate:
+        cand = Candidate(text, float(score), step, meta, next(self._seq))
+        heapq.heappush(self._heap, cand)
+        if self._best is None or cand.score >= self._best.score:
+            self._best = cand  # newest wins ties, so best != worst when len > 1
+        if len(self._heap) > self.capacity:
+            # The popped minimum is never the best: ties resolve oldest-first
+            heapq.heappop(self._heap)
+            self.evicted += 1
+        return cand
+
+    @property
+    def best(self) -> Candidate:
+        """Chosen candidate (highest score)."""
+        if self._best is None:
+            raise IndexError("empty candidate pool")
+        return self._best
+
+    @property
+    def worst(self) -> Candidate:
+        """Rejected candidate (lowest score)."""
+        if not self._heap:
+            raise IndexError("empty candidate pool")
+        return self._heap[0]
+
+    def top(self, k: int) -> List[Candidate]:
+        return heapq.nlargest(k, self._heap)
+
+    def bottom(self, k: int) -> List[Candidate]:
+        return heapq.nsmallest(k, self._heap)
+
+    def mean_score(self) -> float:
+        return sum(c.score for c in self._heap) / len(self._heap) if self._heap else 0.0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[Candidate]:
+        return iter(self._heap)
@@ -0,0 +1,465 @@
+# src/client_pool.py - Multi-host Ollama client pool with per-role routing and resilience
+import asyncio
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import ollama
+
+
+def retryable(exc: BaseException) -> bool:
+    """Worth another attempt: timeouts, transport failures and 5xx / 429 replies."""
+    if isinstance(exc, ollama.ResponseError):
+        return exc.status_code >= 500 or exc.status_code == 429
+    return isinstance(exc, (TimeoutError, ConnectionError, httpx.TransportError))
+
+
+class ResiliencePolicy:
+    """
+    How one role's requests survive slow or failing servers (`resilience` in
+    models.yaml, per role over the top-level defaults).
+
+    timeout_s bounds each attempt; a retryable failure is retried up to
+    `retries` times after backoff_s * 2**i seconds (capped, with jitter).
+    With `hedge`, an attempt still running after the role's observed
+    `hedge_quantile` latency (once `hedge_min_samples` calls are recorded) is
+    duplicated on another healthy replica and the first reply wins.
+    """
+
+    def __init__(self, timeout_s: Optional[float] = None, retries: int = 0,
+                 backoff_s: float = 0.5, max_backoff_s: float = 8.0, hedge: bool = False,
+                 hedge_quantile: float = 0.95, hedge_min_samples: int = 20,
+                 hedge_min_s: float = 0.0):
+        self.timeout_s = timeout_s
+        self.retries = max(0, int(retries))
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = max(1, int(hedge_min_samples))
+        self.hedge_min_s = hedge_min_s
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]]) -> "ResiliencePolicy":
+        cfg = cfg or {}
+        return cls(
+            timeout_s=cfg.get("timeout_s"),
+            retries=cfg.get("retries", 0),
+            backoff_s=cfg.get("backoff_s", 0.5),
+            max_backoff_s=cfg.get("max_backoff_s", 8.0),
+            hedge=cfg.get("hedge", False),
+            hedge_quantile=cfg.get("hedge_quantile", 0.95),
+            hedge_min_samples=cfg.get("hedge_min_samples", 20),
+            hedge_min_s=cfg.get("hedge_min_s", 0.0),
+        )
+
+    @property
+    def supervised(self) -> bool:
+        """Attempts need a watcher (deadline or hedge timer) instead of a plain call."""
+        return self.timeout_s is not None or self.hedge
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.max_backoff_s, self.backoff_s * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class Endpoint:
+    """
+    One Ollama server. Holds a persistent client (httpx keeps the connections
+    alive between calls) and caps the requests in flight to it across all roles.
+
+    Circuit breaker: after `breaker_failures` consecutive retryable failures
+    the endpoint leaves rotation for `breaker_cooldown_s`; the next request
+    after that is a trial, and one more failure reopens it at once.
+    `timeout_s` is the client's own HTTP timeout. Sync attempts under a
+    deadline use a client capped at that deadline (client_for), so one the
+    pool gave up on frees its thread and slot about when the deadline fires.
+    """
+
+    def __init__(self, name: str, host: Optional[str] = None, max_concurrency: int = 4,
+                 breaker_failures: int = 5, breaker_cooldown_s: float = 30.0,
+                 timeout_s: Optional[float] = None):
+        self.name = name
+        self.host = host
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown_s = breaker_cooldown_s
+        self.timeout_s = timeout_s
+        self.client = ollama.Client(host=host, timeout=timeout_s)
+        self._clients = {timeout_s: self.client}
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0  # consecutive
+        self.trips = 0
+        self._open_until = 0.0
+        self._breaker_lock = threading.Lock()
+        self._count_lock = threading.Lock()  # pools of several roles share the endpoint
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._async_state = weakref.WeakKeyDictionary()
+
+    def client_for(self, timeout_s: Optional[float]) -> "ollama.Client":
+        """The sync client whose HTTP timeout is the tighter of `timeout_s` and the endpoint's."""
+        if timeout_s is None or (self.timeout_s is not None and self.timeout_s <= timeout_s):
+            return self.client
+        with self._count_lock:
+            client = self._clients.get(timeout_s)
+            if client is None:
+                client = self._clients[timeout_s] = ollama.Client(host=self.host, timeout=timeout_s)
+            return client
+
+    def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        state = self._async_state.get(loop)
+        if state is None:
+            state = (ollama.AsyncClient(host=self.host, timeout=self.timeout_s),
+                     asyncio.Semaphore(self.max_concurrency))
+            self._async_state[loop] = state
+        return state
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """False while the breaker is open."""
+        return (time.monotonic() if now is None else now) >= self._open_until
+
+    def _acquire(self) -> None:
+        with self._count_lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def _release(self) -> None:
+        with self._count_lock:
+            self.outstanding -= 1
+
+    def _succeeded(self) -> None:
+        with self._breaker_lock:
+            self.failures = 0
+
+    def _failed(self) -> None:
+        with self._breaker_lock:
+            self.failures += 1
+            if self.breaker_failures and self.failures >= self.breaker_failures:
+                self._open_until = time.monotonic() + self.breaker_cooldown_s
+                self.trips += 1
+
+    def __repr__(self) -> str:
+        return f"Endpoint({self.name!r}, {self.host!r}, outstanding={self.outstanding})"
+
+
+class _Attempt:
+    """
+    One request on one endpoint. Its clock starts once it holds one of the
+    endpoint's slots (`started`), so time queued behind the concurrency cap
+    is neither latency nor a stall. A deadline that gives up on it marks it
+    `abandoned`: a running attempt counts as one failure of the endpoint then
+    and not again however it ends; a queued one is dropped without counting.
+    """
+
+    def __init__(self, ep: Endpoint):
+        self.ep = ep
+        self.started: Optional[float] = None  # time.monotonic() when the slot was granted
+        self.abandoned = False
+        self.finished = False
+
+
+class ClientPool:
+    """
+    Replicas serving one role. Each call goes to the healthy endpoint with the
+    fewest outstanding requests (counted across every role sharing that
+    endpoint); if every breaker is open, the one closest to its retry time.
+    Deadlines, retries and hedging follow the role's ResiliencePolicy.
+    """
+
+    QUEUE_POLL_S = 0.01  # how often a try whose first attempt is still queued checks again
+    ABANDON_GRACE_S = 0.25  # a sync attempt's HTTP timeout trails the deadline by this much
+
+    def __init__(self, endpoints: List[Endpoint], policy: Optional[ResiliencePolicy] = None):
+        if not endpoints:
+            raise ValueError("ClientPool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.policy = policy or ResiliencePolicy()
+        self._lock = threading.Lock()
+        self._rr = 0
+        self._latencies: deque = deque(maxlen=256)  # seconds, successful attempts
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.retries = self.timeouts = self.hedges = self.hedge_wins = 0
+
+    def _acquire(self, exclude: tuple = (), healthy_only: bool = False) -> Optional[Endpoint]:
+        with self._lock:
+            # Least outstanding; rotate the starting point so ties spread out
+            n = len(self.endpoints)
+            order = [self.endpoints[(self._rr + i) % n] for i in range(n)]
+            self._rr = (self._rr + 1) % n
+            now = time.monotonic()
+            order = [e for e in order if e not in exclude]
+            healthy = [e for e in order if e.available(now)]
+            if healthy:
+                ep = min(healthy, key=lambda e: e.outstanding / e.max_concurrency)
+            elif order and not healthy_only:
+                ep = min(order, key=lambda e: e._open_until)
+            else:
+                return None
+        ep._acquire()
+        return ep
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Seconds before an attempt is hedged: the role's observed latency quantile."""
+        p = self.policy
+        if not p.hedge or len(self.endpoints) < 2 or len(self._latencies) < p.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return max(p.hedge_min_s, ordered[min(len(ordered) - 1, int(p.hedge_quantile * len(ordered)))])
+
+    def _begin(self, attempt: _Attempt) -> bool:
+        """Start the clock of an attempt that just got its slot; False if given up while queued."""
+        with self._lock:
+            if attempt.abandoned:
+                return False
+            attempt.started = time.monotonic()
+            return True
+
+    def _done(self, attempt: _Attempt, exc: Optional[BaseException]) -> None:
+        ep = attempt.ep
+        ep._release()
+        with self._lock:
+            attempt.finished = True
+        if attempt.abandoned or attempt.started is None:
+            return  # already counted by _expired, or never sent
+        if exc is None:
+            ep._succeeded()
+            self._latencies.append(time.monotonic() - attempt.started)
+        elif isinstance(exc, Exception) and retryable(exc):
+            ep._failed()
+
+    # ---- one attempt on one endpoint
+
+    def _attempt(self, attempt: _Attempt, method: str, kwargs: Dict[str, Any]) -> Any:
+        exc = None
+        try:
+            with attempt.ep._slots:
+                if not self._begin(attempt):
+                    raise TimeoutError(f"Gave up on {attempt.ep.name} while queued")
+                timeout_s = self.policy.timeout_s
+                client = attempt.ep.client_for(
+                    None if timeout_s is None else timeout_s + self.ABANDON_GRACE_S)
+                return getattr(client, method)(**kwargs)
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            self._done(attempt, exc)
+
+    async def _aattempt(self, attempt: _Attempt, method: str, kwargs: Dict[str, Any]) -> Any:
+        exc = None
+        try:
+            client, slots = attempt.ep._loop_state()
+            async with slots:
+                if not self._begin(attempt):
+                    raise TimeoutError(f"Gave up on {attempt.ep.name} while queued")
+                return await getattr(client, method)(**kwargs)
+        except BaseException as e:
+            exc = e  # CancelledError (hedge loser) does not count against the endpoint
+            raise
+        finally:
+            self._done(attempt, exc)
+
+    # ---- deadline + hedging around the attempts of one try
+
+    def _schedule(self, first: _Attempt, delay: Optional[float]) -> Tuple[
+            Optional[float], Optional[float], Optional[float]]:
+        """
+        (deadline, hedge time, seconds to wait) of a try. Both timers run from
+        when its first attempt got an endpoint slot; until then, poll.
+        """
+        if first.started is None:
+            return None, None, self.QUEUE_POLL_S
+        timeout_s = self.policy.timeout_s
+        deadline = first.started + timeout_s if timeout_s is not None else None
+        hedge_at = first.started + delay if delay is not None else None
+        wake = [t for t in (deadline, hedge_at) if t is not None]
+        return deadline, hedge_at, max(0.0, min(wake) - time.monotonic()) if wake else None
+
+    def _expired(self, running: Dict[Any, _Attempt]) -> TimeoutError:
+        stalled = []
+        with self._lock:
+            for attempt in running.values():
+                if not attempt.finished:
+                    attempt.abandoned = True
+                    if attempt.started is not None:
+                        stalled.append(attempt.ep)
+        for ep in stalled:
+            ep._failed()  # still stalled at the deadline
+        self.timeouts += 1
+        names = ", ".join(attempt.ep.name for attempt in running.values())
+        return TimeoutError(f"No reply from {names} within {self.policy.timeout_s}s")
+
+    def _first(self, tried: List[Endpoint]) -> Endpoint:
+        """Endpoint for a new try: one not used by the failed tries before it, if possible."""
+        ep = self._acquire(exclude=tuple(tried)) or self._acquire()
+        tried.append(ep)
+        return ep
+
+    def _supervised(self, method: str, kwargs: Dict[str, Any], tried: List[Endpoint]) -> Any:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    workers = 2 * sum(ep.max_concurrency for ep in self.endpoints) + 4
+                    self._executor = ThreadPoolExecutor(workers, thread_name_prefix="ollama")
+        delay = self._hedge_delay()
+        first = _Attempt(self._first(tried))
+        running = {self._executor.submit(self._attempt, first, method, kwargs): first}
+        error = None
+        while running:
+            deadline, hedge_at, wait_s = self._schedule(first, delay)
+            done, _ = wait(list(running), wait_s, return_when=FIRST_COMPLETED)
+            for fut in done:
+                attempt = running.pop(fut)
+                if fut.exception() is None:
+                    if attempt is not first:
+                        self.hedge_wins += 1
+                    return fut.result()  # a slower duplicate finishes in the background
+                error = fut.exception()
+            now = time.monotonic()
+            if running and deadline is not None and now >= deadline:
+                raise self._expired(running)
+            if running and hedge_at is not None and now >= hedge_at:
+                delay = None
+                busy = tuple(a.ep for a in running.values())
+                other = self._acquire(exclude=busy + (first.ep,), healthy_only=True)
+                if other is not None:
+                    self.hedges += 1
+                    tried.append(other)
+                    hedge = _Attempt(other)
+                    running[self._executor.submit(self._attempt, hedge, method, kwargs)] = hedge
+        raise error
+
+    async def _asupervised(self, method: str, kwargs: Dict[str, Any], tried: List[Endpoint]) -> Any:
+        delay = self._hedge_delay()
+        first = _Attempt(self._first(tried))
+        running = {asyncio.ensure_future(self._aattempt(first, method, kwargs)): first}
+        error = None
+        try:
+            while running:
+                deadline, hedge_at, wait_s = self._schedule(first, delay)
+                done, _ = await asyncio.wait(list(running), timeout=wait_s,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = running.pop(task)
+                    if task.exception() is None:
+                        if attempt is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                now = time.monotonic()
+                if running and deadline is not None and now >= deadline:
+                    raise self._expired(running)
+                if running and hedge_at is not None and now >= hedge_at:
+                    delay = None
+                    busy = tuple(a.ep for a in running.values())
+                    other = self._acquire(exclude=busy + (first.ep,), healthy_only=True)
+                    if other is not None:
+                        self.hedges += 1
+                        tried.append(other)
+                        hedge = _Attempt(other)
+                        running[asyncio.ensure_future(self._aattempt(hedge, method, kwargs))] = hedge
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+
+    # ---- retries
+
+    def _call(self, method: str, kwargs: Dict[str, Any]) -> Any:
+        tried: List[Endpoint] = []
+        for attempt in range(self.policy.retries + 1):
+            if attempt:
+                self.retries += 1
+                time.sleep(self.policy.backoff(attempt))
+            try:
+                if self.policy.supervised:
+                    return self._supervised(method, kwargs, tried)
+                return self._attempt(_Attempt(self._first(tried)), method, kwargs)
+            except Exception as e:
+                if attempt == self.policy.retries or not retryable(e):
+                    raise
+
+    async def _acall(self, method: str, kwargs: Dict[str, Any]) -> Any:
+        tried: List[Endpoint] = []
+        for attempt in range(self.policy.retries + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(self.policy.backoff(attempt))
+            try:
+                if self.policy.supervised:
+                    return await self._asupervised(method, kwargs, tried)
+                return await self._aattempt(_Attempt(self._first(tried)), method, kwargs)
+            except Exception as e:
+                if attempt == self.policy.retries or not retryable(e):
+                    raise
+
+    def chat(self, **kwargs: Any) -> Any:
+        return self._call("chat", kwargs)
+
+    async def achat(self, **kwargs: Any) -> Any:
+        return await self._acall("chat", kwargs)
+
+    def embed(self, **kwargs: Any) -> Any:
+        return self._call("embed", kwargs)
+
+    async def aembed(self, **kwargs: Any) -> Any:
+        return await self._acall("embed", kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            ep.name: {
+                "host": ep.host,
+                "requests": ep.requests,
+                "outstanding": ep.outstanding,
+                "breaker_open": not ep.available(),
+                "breaker_trips": ep.trips,
+            }
+            for ep in self.endpoints
+        }
+
+    def resilience_stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_after_s": self._hedge_delay(),
+        }
+
+
+def build_client_pools(models_yaml: Dict[str, Any]) -> Dict[str, ClientPool]:
+    """
+    One ClientPool per role from models.yaml. `endpoints:` names the servers;
+    a role lists the ones it may use under `hosts:` (default: every endpoint).
+    Endpoint objects are shared, so their concurrency caps hold across roles.
+    Without an `endpoints:` section everything goes to the default Ollama host
+    (OLLAMA_HOST or localhost:11434). A role's `resilience:` keys override the
+    top-level `resilience:` defaults.
+    """
+    ep_cfg = models_yaml.get("endpoints") or {"default": {}}
+    endpoints = {}
+    for name, cfg in ep_cfg.items():
+        cfg = cfg or {}
+        endpoints[name] = Endpoint(
+            name, cfg.get("host"), cfg.get("max_concurrency", 4),
+            breaker_failures=cfg.get("breaker_failures", 5),
+            breaker_cooldown_s=cfg.get("breaker_cooldown_s", 30.0),
+            timeout_s=cfg.get("timeout_s"),
+        )
+    defaults = models_yaml.get("resilience") or {}
+
+    pools = {}
+    for role, cfg in models_yaml["models"].items():
+        names = cfg.get("hosts") or list(endpoints)
+        unknown = [n for n in names if n not in endpoints]
+        if unknown:
+            raise KeyError(f"Role {role!r} routes to unknown endpoints: {unknown}")
+        policy = ResiliencePolicy.from_config({**defaults, **(cfg.get("resilience") or {})})
+        pools[role] = ClientPool([endpoints[n] for n in names], policy)
+    return pools
@@ -1,9 +1,15 @@
 import os
 import json
-from typing import List, Dict, Tuple
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Set
 
 from tqdm import tqdm
 from tpo_core import TPO_Engine
+from batch_engine import BatchTPO
+from trajectory_store import TrajectoryReader, TrajectoryWriter
+from utils import JsonlAppender
 
 
 def load_prompts_from_txt(path: str) -> List[str]:
@@ -21,15 +27,71 @@ def ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
+def load_done_queries(path: str) -> Set[str]:
+    """Queries that already have a record in an existing output JSONL."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["query"])
+            except (ValueError, KeyError):
+                continue  # torn line from an interrupted run
+    return done
+
+
+def is_store(path: str) -> bool:
+    """Outputs not ending in .jsonl are trajectory store directories."""
+    return not path.endswith(".jsonl")
+
+
+def tpo_record(engine: TPO_Engine, query: str, full: bool) -> Dict:
+    """One TPO run as an output record; `full` adds the trajectory (store format)."""
+    if full:
+        res = engine.run_tpo_budgeted(query, trajectory=True)
+        return {
+            "query": query,
+            "response": res["response"],
+            "reward": float(res["score"]),
+            "steps_run": res["steps_run"],
+            "trajectory": res["trajectory"],
+        }
+    best_resp, best_score = engine.run_tpo(query)
+    return {
+        "query": query,
+        "response": best_resp,
+        "reward": float(best_score),
+    }
+
+
+def batch_record(res: Dict, full: bool) -> Dict:
+    """Output record from a BatchTPO result without an "error"."""
+    record = {"query": res["query"], "response": res["response"], "reward": float(res["score"])}
+    if full:
+        record["steps_run"] = res["steps_run"]
+        record["trajectory"] = res["trajectory"]
+    return record
+
+
 def collect_tpo_trajectories(
     engine: TPO_Engine,
     prompts: List[str],
     output_path: str,
     overwrite: bool = False,
-) -> None:
+    resume: bool = False,
+    workers: int = 1,
+    ordered: bool = True,
+    batch_size: int = 0,
+    unload_between_stages: bool = False,
+) -> Dict[str, float]:
     """
     Run TPO on a list of prompts and save (query, response, reward) records
     to a JSONL file. Each line is a self-contained JSON object.
+    If `output_path` does not end in .jsonl it is a trajectory store directory
+    instead (see trajectory_store.py) and each record also carries the full
+    run under "trajectory": every scored candidate and each step's pair,
+    loss and gradient.
 
     Format per line:
     {
@@ -37,52 +99,164 @@ def collect_tpo_trajectories(
       "response": "best TPO response",
       "reward": float  # final reward score from reward model
     }
+
+    With resume=True an existing output is kept: prompts that already have a
+    record are skipped and new records are appended, so a crashed run can be
+    restarted. `workers` > 1 runs that many prompts concurrently (threads
+    sharing the engine; run_tpo keeps no per-query state on the engine).
+    ordered=True writes records in prompt order, otherwise as they finish.
+    batch_size > 0 instead runs chunks of that many prompts stage by stage
+    through BatchTPO (one model resident per stage; see batch_engine.py).
+
+    Returns a throughput summary.
     """
-    out_dir = os.path.dirname(output_path)
+    store = is_store(output_path)
+    out_dir = os.path.dirname(output_path.rstrip("/\\"))
     if out_dir:
         ensure_dir(out_dir)
 
-    if os.path.exists(output_path) and not overwrite:
+    if os.path.exists(output_path) and not (overwrite or resume):
         raise FileExistsError(
-            f"{output_path} already exists. Set overwrite=True to replace."
+            f"{output_path} already exists. Set overwrite=True to replace "
+            "or resume=True to continue."
         )
+    if overwrite:
+        if store:
+            shutil.rmtree(output_path, ignore_errors=True)
+        else:
+            open(output_path, "w", encoding="utf-8").close()
 
-    total = len(prompts)
-    with open(output_path, "w", encoding="utf-8") as f_out:
-        for q in tqdm(prompts, desc="Collecting TPO trajectories", total=total):
-            try:
-                best_resp, best_score = engine.run_tpo(q)
-                record = {
-                    "query": q,
-                    "response": best_resp,
-                    "reward": float(best_score),
-                }
-                f_out.write(json.dumps(record, ensure_ascii=False) + "\n")
-            except Exception as e:
-                # Skip problematic queries but keep going
-                print(f"[WARN] Error on prompt: {q[:80]}... -> {e}")
+    if store:
+        with TrajectoryReader(output_path) as reader:
+            n_done = len(reader)
+            todo = [q for q in prompts if q not in reader]
+    else:
+        done = load_done_queries(output_path)
+        n_done = len(done)
+        todo = [q for q in prompts if q not in done]
+    if n_done:
+        print(f"Resuming: {n_done} prompts already collected")
+    todo = list(dict.fromkeys(todo))  # also drops duplicate prompts within this run
+    skipped = len(prompts) - len(todo)
+
+    def run_one(q: str) -> Optional[Dict]:
+        try:
+            return tpo_record(engine, q, store)
+        except Exception as e:
+            # Skip problematic queries but keep going
+            print(f"[WARN] Error on prompt: {q[:80]}... -> {e}")
+            return None
+
+    writer = TrajectoryWriter(output_path) if store else JsonlAppender(output_path)
+    calls_start = engine.models.n_calls
+    start = time.time()
+    written = failed = 0
+    progress = tqdm(total=len(todo), desc="Collecting TPO trajectories")
+
+    def emit(record: Optional[Dict]) -> None:
+        nonlocal written, failed
+        if record is None:
+            failed += 1
+        else:
+            writer.append(record) if store else writer.write(record)
+            written += 1
+        progress.update(1)
+        minutes = max(time.time() - start, 1e-9) / 60
+        progress.set_postfix(
+            prompts_min=f"{progress.n / minutes:.1f}",
+            calls_min=f"{(engine.models.n_calls - calls_start) / minutes:.1f}",
+        )
+
+    try:
+        if batch_size > 0:
+            batch = BatchTPO(engine, unload_between_stages=unload_between_stages, trajectory=store)
+            for i in range(0, len(todo), batch_size):
+                for res in batch.run(todo[i:i + batch_size]):
+                    if "error" in res:
+                        print(f"[WARN] Error on prompt: {res['query'][:80]}... -> {res['error']}")
+                        emit(None)
+                    else:
+                        emit(batch_record(res, store))
+        elif workers <= 1:
+            for q in todo:
+                emit(run_one(q))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run_one, q) for q in todo]
+                if ordered:
+                    for fut in futures:
+                        emit(fut.result())
+                else:
+                    for fut in as_completed(futures):
+                        emit(fut.result())
+    finally:
+        progress.close()
+        writer.close()
+
+    elapsed = time.time() - start
+    minutes = max(elapsed, 1e-9) / 60
+    calls = engine.models.n_calls - calls_start
+    summary = {
+        "written": written,
+        "failed": failed,
+        "skipped": skipped,
+        "elapsed_s": elapsed,
+        "llm_calls": calls,
+        "prompts_per_min": (written + failed) / minutes,
+        "llm_calls_per_min": calls / minutes,
+    }
+    print(
+        f"Collected {written} (failed {failed}, skipped {skipped}) in {elapsed:.1f}s | "
+        f"{summary['prompts_per_min']:.2f} prompts/min, "
+        f"{summary['llm_calls_per_min']:.1f} LLM calls/min"
+    )
+    return summary
 
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Collect TPO trajectories")
+    parser.add_argument("--prompts", default=os.path.join("data", "prompts.txt"))
+    parser.add_argument("--output", default=os.path.join("data", "tpo_trajectories.jsonl"),
+                        help="JSONL file, or a directory for a full trajectory store")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="prompts processed concurrently")
+    parser.add_argument("--unordered", action="store_true",
+                        help="write records as they finish instead of in prompt order")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="run this many prompts stage by stage to avoid model swaps")
+    parser.add_argument("--unload-between-stages", action="store_true",
+                        help="with --batch-size: evict each model before the next stage's model loads")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="start from scratch instead of resuming")
+    args = parser.parse_args()
+
     # 1. Initialize your TPO engine (uses your existing config/models)
     engine = TPO_Engine()  # adapt if you require config paths/args
 
     # 2. Load prompts
-    prompts_file = os.path.join("data", "prompts.txt")
-    prompts = load_prompts_from_txt(prompts_file)
-
-    # 3. Output path
-    out_path = os.path.join("data", "tpo_trajectories.jsonl")
+    prompts = load_prompts_from_txt(args.prompts)
 
-    # 4. Collect trajectories
-    collect_tpo_trajectories(
+    # 3. Collect trajectories (resumes from an existing output by default)
+    summary = collect_tpo_trajectories(
         engine=engine,
         prompts=prompts,
-        output_path=out_path,
-        overwrite=True,
+        output_path=args.output,
+        overwrite=args.overwrite,
+        resume=True,
+        workers=args.workers,
+        ordered=not args.unordered,
+        batch_size=args.batch_size,
+        unload_between_stages=args.unload_between_stages,
     )
 
-    print(f"✅ Saved {len(prompts)} trajectories to {out_path}")
+    print(f"✅ Saved {summary['written']} trajectories to {args.output}")
+    if engine.models.cache is not None:
+        print(f"Response cache: {engine.models.cache.stats()}")
+    for role, pool in engine.models.pools.items():
+        stats = pool.resilience_stats()
+        if stats["retries"] or stats["timeouts"] or stats["hedges"]:
+            print(f"Resilience ({role}): {stats}")
 
 
 if __name__ == "__main__":
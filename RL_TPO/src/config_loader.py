@@ -1,12 +1,30 @@
-# src/config_loader.py - Loads all 3 YAMLs
+# src/config_loader.py - Loads all 3 YAMLs (+ the host-specific overlay from autotune.py)
 import yaml
 import os
 from pathlib import Path
 from typing import Dict, Any
 
+OVERLAY_FILE = "tuned.yaml"
 
-def load_all_configs(project_root: str = r"D:\Research\RL_TPO") -> Dict[str, Dict[str, Any]]:
-    """Load models.yaml, tpo_config.yaml, rl_config.yaml"""
+
+def merge_overlay(base: Dict[str, Any], overlay: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of `base` with `overlay` merged in: nested dicts merge, anything else replaces."""
+    merged = dict(base)
+    for key, value in (overlay or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_overlay(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_all_configs(project_root: str = r"D:\Research\RL_TPO",
+                     overlay: bool = True) -> Dict[str, Dict[str, Any]]:
+    """
+    Load models.yaml, tpo_config.yaml, rl_config.yaml. If config/tuned.yaml
+    exists (written by `python src/autotune.py`), its `models.yaml:` /
+    `tpo_config.yaml:` / `rl_config.yaml:` sections are merged over them.
+    """
     configs = {}
     
     config_path = Path(project_root) / "config"
@@ -14,6 +32,13 @@ def load_all_configs(project_root: str = r"D:\Research\RL_TPO") -> Dict[str, Dic
     for yaml_file in ["models.yaml", "tpo_config.yaml", "rl_config.yaml"]:
         with open(config_path / yaml_file) as f:
             configs[yaml_file] = yaml.safe_load(f)
+
+    overlay_path = config_path / OVERLAY_FILE
+    if overlay and overlay_path.exists():
+        with open(overlay_path) as f:
+            tuned = yaml.safe_load(f) or {}
+        for yaml_file in configs:
+            configs[yaml_file] = merge_overlay(configs[yaml_file], tuned.get(yaml_file) or {})
     
     return configs
 
@@ -0,0 +1,133 @@
+# src/diversity.py - Embedding-based near-duplicate pruning and diversity selection of TPO candidates
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from models import OllamaRole
+
+
+def normalize(vectors: Any) -> np.ndarray:
+    x = np.asarray(vectors, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def cosine_matrix(a: Any, b: Optional[Any] = None) -> np.ndarray:
+    """Pairwise cosine similarity of the rows of `a` (and `b`, if given)."""
+    x = normalize(a)
+    return x @ (x if b is None else normalize(b)).T
+
+
+def drop_near_duplicates(sim: np.ndarray, threshold: float,
+                         to_history: Optional[np.ndarray] = None) -> List[int]:
+    """
+    Greedy in input order: keep a row unless its similarity to a row kept
+    before it, or to any history column of `to_history`, exceeds `threshold`.
+    """
+    blocked = (to_history > threshold).any(axis=1) if to_history is not None and to_history.size \
+        else np.zeros(len(sim), dtype=bool)
+    keep: List[int] = []
+    for i in range(len(sim)):
+        if blocked[i] or (keep and sim[i, keep].max() > threshold):
+            continue
+        keep.append(i)
+    return keep
+
+
+def select_diverse(sim: np.ndarray, k: int, closest: Optional[np.ndarray] = None) -> List[int]:
+    """
+    Greedy max-min (farthest point) choice of `k` rows: each pick is the row
+    least similar to everything picked so far. `closest` seeds each row's
+    similarity to already-scored candidates; without it the first pick is the
+    row with the lowest mean similarity to the others.
+    """
+    n = len(sim)
+    if k >= n:
+        return list(range(n))
+    available = np.ones(n, dtype=bool)
+    picked: List[int] = []
+    if closest is None:
+        first = int(np.argmin(sim.mean(axis=1)))
+        picked.append(first)
+        available[first] = False
+        closest = sim[first].copy()
+    else:
+        closest = closest.astype(np.float32).copy()
+    while len(picked) < k:
+        i = int(np.argmin(np.where(available, closest, np.inf)))
+        picked.append(i)
+        available[i] = False
+        closest = np.maximum(closest, sim[i])
+    return sorted(picked)
+
+
+class DiversityFilter:
+    """
+    Optional stage between sampling and scoring (`diversity` in tpo_config.yaml).
+    A step's candidates are embedded in batched /api/embed calls; those more
+    than `threshold` cosine-similar to a candidate kept earlier (this step, or
+    previous steps via `history`) are dropped, and with `select_k` only the k
+    most mutually different of the rest go on to the RM. One embedding call
+    replaces an RM call per dropped candidate.
+    """
+
+    def __init__(self, embedder: OllamaRole, threshold: float = 0.95, select_k: Optional[int] = None):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.select_k = select_k
+        self._lock = threading.Lock()
+        self.seen = self.duplicates = self.deselected = 0
+
+    @classmethod
+    def from_config(cls, models: Any, cfg: Optional[Dict[str, Any]]) -> Optional["DiversityFilter"]:
+        """None unless the `diversity` section is enabled."""
+        cfg = cfg or {}
+        if not cfg.get("enabled", False):
+            return None
+        embedder = getattr(models, cfg.get("role", "embedder"), None)
+        if embedder is None:
+            raise ValueError("diversity.enabled needs an embedding role (`embedder` in models.yaml)")
+        return cls(embedder, cfg.get("threshold", 0.95), cfg.get("select_k"))
+
+    def select(self, vectors: List[List[float]], history: List[List[float]]) -> List[int]:
+        """Indices of `vectors` to score, given the vectors of candidates already kept."""
+        sim = cosine_matrix(vectors)
+        to_history = cosine_matrix(vectors, history) if history else None
+        keep = drop_near_duplicates(sim, self.threshold, to_history)
+        n_unique = len(keep)
+        if self.select_k and len(keep) > self.select_k:
+            closest = to_history[keep].max(axis=1) if to_history is not None else None
+            keep = [keep[i] for i in select_diverse(sim[np.ix_(keep, keep)], self.select_k, closest)]
+        with self._lock:
+            self.seen += len(vectors)
+            self.duplicates += len(vectors) - n_unique
+            self.deselected += n_unique - len(keep)
+        return keep
+
+    def _keep(self, texts: List[str], vectors: List[List[float]], history: List[List[float]]) -> List[str]:
+        keep = self.select(vectors, history)
+        history.extend(vectors[i] for i in keep)
+        return [texts[i] for i in keep]
+
+    def prune(self, texts: List[str], history: List[List[float]]) -> List[str]:
+        """
+        Candidates worth scoring. `history` holds the vectors kept so far for
+        this query (e.g. CandidatePool.embeddings) and is extended in place.
+        """
+        if not texts or (len(texts) == 1 and not history and not self.select_k):
+            return texts
+        return self._keep(texts, self.embedder.embed(texts), history)
+
+    async def aprune(self, texts: List[str], history: List[List[float]]) -> List[str]:
+        if not texts or (len(texts) == 1 and not history and not self.select_k):
+            return texts
+        return self._keep(texts, await self.embedder.aembed(texts), history)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "seen": self.seen,
+            "duplicates": self.duplicates,
+            "deselected": self.deselected,
+            "rm_calls_saved": self.duplicates + self.deselected,
+            "embed_calls": self.embedder.n_calls,
+        }
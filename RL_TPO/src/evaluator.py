@@ -0,0 +1,221 @@
+# src/evaluator.py - In-process concurrent benchmark runner (baseline vs TPO)
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from analysis import PairedScores, StepCurves
+from tpo_core import TPO_Engine
+from utils import JsonlAppender, percentile
+
+DEFAULT_DATASETS = [
+    os.path.join("prompts", "alpacaeval_eval.jsonl"),
+    os.path.join("prompts", "arena_hard.jsonl"),
+    os.path.join("prompts", "hh_rlhf_eval.jsonl"),
+]
+
+
+def iter_examples(path: str, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Stream {"id", "prompt", ...} examples from a JSONL file without loading it."""
+    with open(path, "r", encoding="utf-8") as f:
+        n = 0
+        for i, line in enumerate(f):
+            if limit is not None and n >= limit:
+                return
+            line = line.strip()
+            if not line:
+                continue
+            ex = json.loads(line)
+            ex.setdefault("id", str(i))
+            ex["id"] = str(ex["id"])
+            n += 1
+            yield ex
+
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # torn line from an interrupted run
+    return records
+
+
+class Evaluator:
+    """
+    Runs TPO (arun_tpo_budgeted with history) per example, `concurrency`
+    examples at a time, and reads both arms off that one run: the baseline is
+    the first scored step-0 sample (a plain policy sample, scored by the same
+    RM), and `depth_scores` holds the best score after D = 0..n_steps
+    iterations for the depth ablation curve.
+
+    Per-example records go to <out_dir>/<dataset>.results.jsonl as soon as they
+    finish; rerunning skips ids already there, so interrupted runs resume.
+    """
+
+    def __init__(self, engine: TPO_Engine, out_dir: str = os.path.join("results", "eval"),
+                 concurrency: int = 4):
+        self.engine = engine
+        self.out_dir = out_dir
+        self.concurrency = max(1, int(concurrency))
+
+    def results_path(self, dataset_path: str) -> str:
+        name = os.path.splitext(os.path.basename(dataset_path))[0]
+        return os.path.join(self.out_dir, f"{name}.results.jsonl")
+
+    def depth_scores(self, history: List[Dict[str, Any]]) -> List[float]:
+        """Best score after 0..n_steps iterations; a run that stopped early keeps its last best."""
+        scores = [h["best_score"] for h in history]
+        return scores + [scores[-1]] * (self.engine.n_steps + 1 - len(scores))
+
+    async def _eval_example(self, ex: Dict[str, Any], dataset: str) -> Dict[str, Any]:
+        prompt = ex["prompt"]
+        record: Dict[str, Any] = {"id": ex["id"], "dataset": dataset}
+        try:
+            start = time.perf_counter()
+            tpo = await self.engine.arun_tpo_budgeted(prompt, history=True)
+            tpo_latency = time.perf_counter() - start
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+            return record
+        step0 = tpo["history"][0]
+        base = next(c for c in step0["candidates"] if c["score"] is not None)
+        record.update({
+            "baseline_score": base["score"],
+            "tpo_score": tpo["score"],
+            "delta": tpo["score"] - base["score"],
+            "baseline_latency_s": step0["elapsed_s"],
+            "tpo_latency_s": tpo_latency,
+            "tpo_llm_calls": tpo["llm_calls"],
+            "tpo_tokens": tpo["tokens"],
+            "stop_reason": tpo["stop_reason"],
+            "depth_scores": self.depth_scores(tpo["history"]),
+            "step_scores": [[c["score"] for c in h["candidates"]] for h in tpo["history"]],
+            "baseline_response": base["text"],
+            "tpo_response": tpo["response"],
+        })
+        return record
+
+    async def aevaluate_dataset(self, dataset_path: str, n_examples: Optional[int] = None) -> Dict[str, Any]:
+        os.makedirs(self.out_dir, exist_ok=True)
+        results_path = self.results_path(dataset_path)
+        done: Set[str] = {r["id"] for r in load_results(results_path) if "error" not in r}
+        dataset = os.path.basename(dataset_path)
+        writer = JsonlAppender(results_path)
+        print(f"\n🧪 {dataset_path} (limit={n_examples}, resume: {len(done)} done)")
+
+        start = time.perf_counter()
+        new_records: List[Dict[str, Any]] = []
+        pending: Set[asyncio.Task] = set()
+
+        async def drain(return_when) -> None:
+            nonlocal pending
+            finished, pending = await asyncio.wait(pending, return_when=return_when)
+            for task in finished:
+                record = task.result()
+                writer.write(record)
+                new_records.append(record)
+                if len(new_records) % 10 == 0:
+                    print(f"  {len(new_records)} examples done")
+
+        try:
+            # Keep at most `concurrency` examples in flight while streaming the file
+            for ex in iter_examples(dataset_path, n_examples):
+                if ex["id"] in done:
+                    continue
+                if len(pending) >= self.concurrency:
+                    await drain(asyncio.FIRST_COMPLETED)
+                pending.add(asyncio.create_task(self._eval_example(ex, dataset)))
+            if pending:
+                await drain(asyncio.ALL_COMPLETED)
+        finally:
+            writer.close()
+
+        elapsed = time.perf_counter() - start
+        summary = summarize(load_results(results_path), new_records, elapsed)
+        print(
+            f"📊 {dataset}: Base={summary['baseline_mean']:.2f} TPO={summary['tpo_mean']:.2f} "
+            f"Δ={summary['delta_mean']:+.2f} [{summary['delta_ci'][0]:+.2f}, {summary['delta_ci'][1]:+.2f}] "
+            f"| p50={summary['tpo_latency_p50_s']:.1f}s "
+            f"p90={summary['tpo_latency_p90_s']:.1f}s | {summary['examples_per_min']:.2f} ex/min"
+        )
+        if summary["depth_curve"]["n"]:
+            curve = summary["depth_curve"]["best_so_far"]
+            print("   best by depth: " + "  ".join(f"D={d}: {v:.2f}" for d, v in enumerate(curve)))
+        return summary
+
+    async def aevaluate(self, datasets: List[str], n_examples: Optional[int] = None) -> Dict[str, Any]:
+        results = {}
+        for path in datasets:
+            if not os.path.exists(path):
+                print(f"❌ Missing {path}")
+                continue
+            results[os.path.basename(path)] = await self.aevaluate_dataset(path, n_examples)
+        os.makedirs(self.out_dir, exist_ok=True)
+        with open(os.path.join(self.out_dir, "benchmark_results.json"), "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        return results
+
+    def evaluate(self, datasets: List[str], n_examples: Optional[int] = None) -> Dict[str, Any]:
+        return asyncio.run(self.aevaluate(datasets, n_examples))
+
+
+def _mean(xs: List[float]) -> float:
+    return sum(xs) / len(xs) if xs else 0.0
+
+
+def summarize(records: List[Dict[str, Any]], new_records: List[Dict[str, Any]],
+              elapsed_s: float, n_boot: int = 10000) -> Dict[str, Any]:
+    """
+    Quality over every finished record of the dataset (resumed ones included),
+    with paired bootstrap CIs (analysis.PairedScores) and the best score by
+    TPO depth (analysis.StepCurves); latency and throughput over the examples
+    run in this session.
+    """
+    ok = [r for r in records if "error" not in r and r.get("baseline_score") is not None]
+    fresh = [r for r in new_records if "error" not in r]
+    paired = PairedScores()
+    paired.update(ok)
+    quality = paired.summary(n_boot)
+    curves = StepCurves()
+    curves.update(ok)
+    tpo_lat = [r["tpo_latency_s"] for r in fresh]
+    base_lat = [r["baseline_latency_s"] for r in fresh]
+    minutes = max(elapsed_s, 1e-9) / 60
+    return {
+        **quality,
+        "depth_curve": curves.summary(n_boot),
+        "errors": len({r["id"] for r in records if "error" in r} - {r["id"] for r in ok}),
+        "examples_this_run": len(new_records),
+        "elapsed_s": elapsed_s,
+        "examples_per_min": len(new_records) / minutes,
+        "llm_calls_per_example": _mean([r["tpo_llm_calls"] for r in fresh]),
+        "tpo_latency_p50_s": percentile(tpo_lat, 50),
+        "tpo_latency_p90_s": percentile(tpo_lat, 90),
+        "tpo_latency_p99_s": percentile(tpo_lat, 99),
+        "baseline_latency_p50_s": percentile(base_lat, 50),
+        "baseline_latency_p90_s": percentile(base_lat, 90),
+    }
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="RL-TPO++ benchmark: baseline vs TPO")
+    parser.add_argument("--datasets", nargs="+", default=DEFAULT_DATASETS)
+    parser.add_argument("--n-examples", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="examples in flight")
+    parser.add_argument("--out-dir", default=os.path.join("results", "eval"))
+    args = parser.parse_args()
+
+    evaluator = Evaluator(TPO_Engine(), out_dir=args.out_dir, concurrency=args.concurrency)
+    results = evaluator.evaluate(args.datasets, args.n_examples)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
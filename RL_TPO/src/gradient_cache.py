@@ -0,0 +1,168 @@
+# src/gradient_cache.py - Semantic cache of textual gradients keyed by query embeddings
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from diversity import normalize
+from models import OllamaRole
+
+
+class VectorIndex:
+    """
+    Nearest-neighbour index over unit vectors in one preallocated float32
+    matrix: a search is a single matrix-vector product over the live rows.
+    Exact, and well under a millisecond for a few thousand 768-d entries,
+    which is as large as a per-process gradient cache gets. Slots are reused
+    after eviction, so row ids stay stable for the owner's side tables.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._vectors: Optional[np.ndarray] = None  # allocated on the first add (dim unknown before)
+        self._live = np.zeros(capacity, dtype=bool)
+
+    def __len__(self) -> int:
+        return int(self._live.sum())
+
+    def free_slot(self) -> Optional[int]:
+        free = np.flatnonzero(~self._live)
+        return int(free[0]) if len(free) else None
+
+    def put(self, slot: int, vector: np.ndarray) -> None:
+        if self._vectors is None:
+            self._vectors = np.zeros((self.capacity, len(vector)), dtype=np.float32)
+        self._vectors[slot] = vector
+        self._live[slot] = True
+
+    def remove(self, slot: int) -> None:
+        self._live[slot] = False
+
+    def nearest(self, vector: np.ndarray) -> Tuple[Optional[int], float]:
+        """(slot, cosine similarity) of the closest live vector; (None, -1.0) when empty."""
+        if self._vectors is None or not self._live.any():
+            return None, -1.0
+        sims = np.where(self._live, self._vectors @ vector, -np.inf)
+        slot = int(np.argmax(sims))
+        return slot, float(sims[slot])
+
+
+class GradientCache:
+    """
+    Optional semantic cache of textual gradients (`gradient_cache` in
+    tpo_config.yaml). Each query is embedded once; gradients that raised the
+    best score of a run are stored under its query vector. A later query at
+    least `reuse_threshold` cosine-similar to a cached one skips the first
+    iteration's loss + gradient calls and updates with the cached gradient;
+    one at least `threshold` similar computes its own gradient with the cached
+    one in the prompt as a warm start. Least recently used entries are evicted
+    beyond `max_entries`.
+    """
+
+    def __init__(self, embedder: OllamaRole, threshold: float = 0.85, reuse_threshold: float = 0.95,
+                 max_entries: int = 1000, min_gain: float = 0.0):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.reuse_threshold = reuse_threshold
+        self.max_entries = max_entries
+        self.min_gain = min_gain
+        self.index = VectorIndex(max_entries)
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._tick = 0
+        self._lock = threading.Lock()
+        self.lookups = self.hits = self.warm_starts = 0
+        self.inserts = self.updates = self.evictions = 0
+
+    @classmethod
+    def from_config(cls, models: Any, cfg: Optional[Dict[str, Any]]) -> Optional["GradientCache"]:
+        """None unless the `gradient_cache` section is enabled."""
+        cfg = cfg or {}
+        if not cfg.get("enabled", False):
+            return None
+        embedder = getattr(models, cfg.get("role", "embedder"), None)
+        if embedder is None:
+            raise ValueError("gradient_cache.enabled needs an embedding role (`embedder` in models.yaml)")
+        return cls(embedder, cfg.get("threshold", 0.85), cfg.get("reuse_threshold", 0.95),
+                   cfg.get("max_entries", 1000), cfg.get("min_gain", 0.0))
+
+    def _touch(self, slot: int) -> None:
+        self._tick += 1
+        self._last_used[slot] = self._tick
+
+    def _match(self, query: str, vector: List[float]) -> Dict[str, Any]:
+        """
+        The lookup handed back to the TPO loop: the query's unit vector (for
+        add()), plus the cached gradient and whether to reuse it outright or
+        only warm-start from it (gradient None on a miss).
+        """
+        vec = normalize([vector])[0]
+        with self._lock:
+            self.lookups += 1
+            slot, sim = self.index.nearest(vec)
+            match = {"query": query, "vector": vec, "gradient": None, "similarity": sim, "reuse": False}
+            if slot is None or sim < self.threshold:
+                return match
+            self._touch(slot)
+            entry = self._entries[slot]
+            entry["hits"] += 1
+            match.update(gradient=entry["gradient"], source=entry["query"], reuse=sim >= self.reuse_threshold)
+            if match["reuse"]:
+                self.hits += 1
+            else:
+                self.warm_starts += 1
+        return match
+
+    def lookup(self, query: str) -> Dict[str, Any]:
+        return self._match(query, self.embedder.embed([query])[0])
+
+    async def alookup(self, query: str) -> Dict[str, Any]:
+        return self._match(query, (await self.embedder.aembed([query]))[0])
+
+    def add(self, match: Dict[str, Any], gradient: str, gain: float) -> bool:
+        """
+        Remember `gradient` for the query of `match` if it raised the best
+        score by more than `min_gain`. An entry within `reuse_threshold` of the
+        query is replaced when the new gain is at least as large (so one
+        intent keeps its best gradient) instead of adding a near-copy.
+        """
+        if gain <= self.min_gain:
+            return False
+        vec = match["vector"]
+        entry = {"query": match["query"], "gradient": gradient, "gain": gain, "hits": 0}
+        with self._lock:
+            slot, sim = self.index.nearest(vec)
+            if slot is not None and sim >= self.reuse_threshold:
+                self._touch(slot)
+                if gain < self._entries[slot]["gain"]:
+                    return False
+                entry["hits"] = self._entries[slot]["hits"]
+                self.updates += 1
+            else:
+                slot = self.index.free_slot()
+                if slot is None:
+                    slot = int(np.argmin(self._last_used))
+                    self.index.remove(slot)
+                    self.evictions += 1
+                self.inserts += 1
+                self._touch(slot)
+            self._entries[slot] = entry
+            self.index.put(slot, vec)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        found = self.hits + self.warm_starts
+        return {
+            "entries": len(self.index),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "warm_starts": self.warm_starts,
+            "misses": self.lookups - found,
+            "hit_rate": found / self.lookups if self.lookups else 0.0,
+            "reuse_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "inserts": self.inserts,
+            "updates": self.updates,
+            "evictions": self.evictions,
+            "llm_calls_saved": 2 * self.hits,
+            "embed_calls": self.embedder.n_calls,
+        }
@@ -2,12 +2,21 @@
 import argparse
 from tpo_core import TPO_Engine
 from rl_core import run_rl_tpo
+from evaluator import Evaluator, DEFAULT_DATASETS
+from service import run_service
 
 
 def main():
     parser = argparse.ArgumentParser(description="RL-TPO++")
-    parser.add_argument("--mode", choices=["tpo", "rl", "eval"], default="tpo")
+    parser.add_argument("--mode", choices=["tpo", "rl", "eval", "serve"], default="tpo")
     parser.add_argument("--query", type=str)
+    parser.add_argument("--datasets", nargs="+", default=DEFAULT_DATASETS, help="eval: JSONL files")
+    parser.add_argument("--n-examples", type=int, default=20, help="eval: examples per dataset")
+    parser.add_argument("--concurrency", type=int, default=4, help="eval: examples in flight")
+    parser.add_argument("--out-dir", default="results/eval", help="eval: per-example results + summary")
+    parser.add_argument("--host", help="serve: bind address (default: service.host)")
+    parser.add_argument("--port", type=int, help="serve: TCP port (default: service.port)")
+    parser.add_argument("--socket", help="serve: Unix socket path instead of TCP")
     args = parser.parse_args()
 
     if args.mode == "tpo":
@@ -23,7 +32,11 @@ def main():
         run_rl_tpo()
 
     elif args.mode == "eval":
-        print("Eval mode: run benchmarks (TODO)")
+        evaluator = Evaluator(TPO_Engine(), out_dir=args.out_dir, concurrency=args.concurrency)
+        evaluator.evaluate(args.datasets, args.n_examples)
+
+    elif args.mode == "serve":
+        run_service(TPO_Engine(), args.host, args.port, args.socket)
 
 
 if __name__ == "__main__":
@@ -1,48 +1,464 @@
 # src/models.py - 5-role Ollama wrapper
-import ollama
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 import yaml
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, List, Optional
 from config_loader import load_all_configs
+from cache import ResponseCache
+from client_pool import ClientPool, Endpoint, build_client_pools
+from tracing import record_call
+
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+# Per-role Ollama options passed through from models.yaml
+RUNTIME_OPTIONS = ("num_thread", "num_ctx", "num_gpu", "num_batch")
+
+
+def score_schema(lo: float, hi: float) -> Dict[str, Any]:
+    """JSON schema for Ollama structured outputs: {"score": number in [lo, hi]}."""
+    return {
+        "type": "object",
+        "properties": {"score": {"type": "number", "minimum": lo, "maximum": hi}},
+        "required": ["score"],
+    }
+
+
+def scores_schema(n: int, lo: float, hi: float) -> Dict[str, Any]:
+    """JSON schema for listwise scoring: {"scores": [n numbers in [lo, hi]]}."""
+    return {
+        "type": "object",
+        "properties": {
+            "scores": {
+                "type": "array",
+                "items": {"type": "number", "minimum": lo, "maximum": hi},
+                "minItems": n,
+                "maxItems": n,
+            }
+        },
+        "required": ["scores"],
+    }
+
+
+class Usage:
+    """Server calls and tokens spent by one unit of work (see track_usage)."""
+
+    # load_duration above this means the server (re)loaded the model for the call
+    LOAD_THRESHOLD_S = 0.1
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.model_loads = 0
+        self.load_s = 0.0
+        self.prefill_saved = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, resp: Any, prefill_saved: int = 0) -> None:
+        with self._lock:
+            self.calls += 1
+            self.prefill_saved += prefill_saved
+            self.prompt_tokens += resp.get("prompt_eval_count") or 0
+            self.completion_tokens += resp.get("eval_count") or 0
+            load_s = (resp.get("load_duration") or 0) / 1e9
+            self.load_s += load_s
+            if load_s > self.LOAD_THRESHOLD_S:
+                self.model_loads += 1
+
+
+_current_usage: ContextVar[Optional[Usage]] = ContextVar("tpo_usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[Usage]:
+    """
+    Count every OllamaRole call made inside the block (this thread, and asyncio
+    tasks started from it). Cache hits cost nothing and are not counted.
+    """
+    usage = Usage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def _record_usage(resp: Any, prefill_saved: int = 0) -> None:
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.add(resp, prefill_saved)
 
 
 class OllamaRole:
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        max_concurrency: int = 1,
+        cache: Optional[ResponseCache] = None,
+        pool: Optional[ClientPool] = None,
+    ):
         self.tag = config["tag"]
+        self.name = config.get("name", self.tag)  # role name in traces
         self.temperature = config.get("temperature", 0.7)
         self.top_p = config.get("top_p", 0.95)
         self.max_tokens = config.get("max_tokens", 512)
+        self.score_max_tokens = config.get("score_max_tokens", 16)
+        self.seed = config.get("seed")
+        self.keep_alive = config.get("keep_alive")  # e.g. "10m", 0 = unload after each call
+        self.kind = config.get("kind", "chat")  # "embed" for embedding models (/api/embed)
+        self.embed_batch_size = config.get("embed_batch_size", 32)
+        # Server runtime options (autotune.py); a different num_ctx reloads the model
+        self.runtime_options = {k: config[k] for k in RUNTIME_OPTIONS if config.get(k) is not None}
         self.role_desc = config.get("role", "")
 
-    def generate(self, prompt: str, system: Optional[str] = None) -> str:
+        # Response cache policy: "auto" caches deterministic calls only
+        # (temperature 0 or a pinned seed), "always" / "never" force it.
+        self.cache = cache
+        self.cache_policy = config.get("cache", "auto")
+
+        # Requests actually sent to the server (cache hits excluded)
+        self.n_calls = 0
+        self.score_failures = 0
+        self._calls_lock = threading.Lock()
+
+        # Full prefill length per prompt seen (bounded), to measure KV-cache reuse
+        self.prefill_saved = 0
+        self._prefill_full: "OrderedDict[bytes, int]" = OrderedDict()
+
+        # Ollama server(s) for this role (see `endpoints:` in models.yaml)
+        self.pool = pool if pool is not None else ClientPool([Endpoint("default")])
+
+        # Async path: at most `max_concurrency` requests in flight for this role.
+        # The semaphore is bound to an event loop, so keep one per loop.
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._async_state = weakref.WeakKeyDictionary()
+
+    def _messages(self, prompt: str, system: Optional[str] = None) -> List[Dict[str, str]]:
         messages = []
         if system:
             messages.append({"role": "system", "content": system})
         messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def _options(self, seed: Optional[int] = None) -> Dict[str, Any]:
+        options = {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "num_predict": self.max_tokens,
+            **self.runtime_options,
+        }
+        seed = self.seed if seed is None else seed
+        if seed is not None:
+            options["seed"] = seed
+        return options
+
+    def _cache_key(
+        self,
+        messages: List[Dict[str, str]],
+        options: Dict[str, Any],
+        fmt: Optional[Any] = None,
+    ) -> Optional[str]:
+        if self.cache is None or self.cache_policy == "never":
+            return None
+        if self.cache_policy == "auto" and not (
+            options.get("temperature", 0.0) == 0.0 or options.get("seed") is not None
+        ):
+            return None
+        if fmt is not None:
+            options = dict(options, format=fmt)
+        return self.cache.make_key(self.tag, messages, options)
+
+    def _count_call(self) -> None:
+        with self._calls_lock:
+            self.n_calls += 1
+
+    def _prefill_saved(self, messages: List[Dict[str, str]], resp: Any) -> int:
+        """
+        Prompt tokens the server did not recompute for a prompt sent before:
+        Ollama's prompt_eval_count excludes the prefix reused from its KV cache,
+        so the shortfall against the longest count seen for the same messages
+        is prefill saved. Shared prefixes of different prompts are not counted.
+        """
+        count = resp.get("prompt_eval_count") or 0
+        key = hashlib.blake2b(json.dumps(messages).encode("utf-8"), digest_size=16).digest()
+        with self._calls_lock:
+            full = self._prefill_full.get(key)
+            if full is None or count > full:
+                self._prefill_full[key] = count
+                self._prefill_full.move_to_end(key)
+                if len(self._prefill_full) > 4096:
+                    self._prefill_full.popitem(last=False)
+                return 0
+            self.prefill_saved += full - count
+            return full - count
+
+    def _request_kwargs(self, fmt: Optional[Any] = None) -> Dict[str, Any]:
+        kwargs = {}
+        if fmt is not None:
+            kwargs["format"] = fmt
+        if self.keep_alive is not None:
+            kwargs["keep_alive"] = self.keep_alive
+        return kwargs
+
+    def _chat(
+        self,
+        messages: List[Dict[str, str]],
+        options: Dict[str, Any],
+        fmt: Optional[Any] = None,
+    ) -> str:
+        key = self._cache_key(messages, options, fmt)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_call(self.name, self.tag, cached=True)
+                return cached
 
-        resp = ollama.chat(
-            model=self.tag,
-            messages=messages,
-            options={
-                "temperature": self.temperature,
-                "top_p": self.top_p,
-                "num_predict": self.max_tokens,
-            },
+        self._count_call()
+        kwargs = self._request_kwargs(fmt)
+        start = time.perf_counter()
+        resp = self.pool.chat(model=self.tag, messages=messages, options=options, **kwargs)
+        saved = self._prefill_saved(messages, resp)
+        _record_usage(resp, saved)
+        record_call(self.name, self.tag, resp, latency_s=time.perf_counter() - start,
+                    prefill_saved=saved)
+        content = resp["message"]["content"].strip()
+        if key is not None:
+            self.cache.put(key, content)
+        return content
+
+    def generate(self, prompt: str, system: Optional[str] = None, seed: Optional[int] = None) -> str:
+        """`seed` overrides the role's seed for this call (e.g. one per TPO sample)."""
+        return self._chat(self._messages(prompt, system), self._options(seed))
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_state.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._async_state[loop] = semaphore
+        return semaphore
+
+    async def _achat(
+        self,
+        messages: List[Dict[str, str]],
+        options: Dict[str, Any],
+        fmt: Optional[Any] = None,
+    ) -> str:
+        key = self._cache_key(messages, options, fmt)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                record_call(self.name, self.tag, cached=True)
+                return cached
+
+        kwargs = self._request_kwargs(fmt)
+        queued = time.perf_counter()
+        async with self._semaphore():
+            self._count_call()
+            start = time.perf_counter()
+            resp = await self.pool.achat(model=self.tag, messages=messages, options=options, **kwargs)
+        saved = self._prefill_saved(messages, resp)
+        _record_usage(resp, saved)
+        record_call(self.name, self.tag, resp, latency_s=time.perf_counter() - start,
+                    queue_s=start - queued, prefill_saved=saved)
+        content = resp["message"]["content"].strip()
+        if key is not None:
+            self.cache.put(key, content)
+        return content
+
+    async def agenerate(self, prompt: str, system: Optional[str] = None, seed: Optional[int] = None) -> str:
+        """Async twin of generate(), bounded by the role's concurrency limit."""
+        return await self._achat(self._messages(prompt, system), self._options(seed))
+
+    def unload(self) -> None:
+        """Ask every server of this role to evict the model now (keep_alive=0)."""
+        for ep in self.pool.endpoints:
+            if self.kind == "embed":
+                ep.client.embed(model=self.tag, input=[], keep_alive=0)
+            else:
+                ep.client.chat(model=self.tag, messages=[], keep_alive=0)
+
+    def warm(self) -> None:
+        """Load the model on every server of this role now, kept for `keep_alive`."""
+        kwargs = self._request_kwargs()
+        if self.runtime_options:
+            kwargs["options"] = self.runtime_options  # load with the context size calls will use
+        for ep in self.pool.endpoints:
+            if self.kind == "embed":
+                ep.client.embed(model=self.tag, input=[], **kwargs)
+            else:
+                ep.client.chat(model=self.tag, messages=[], **kwargs)
+
+    # ---- Embeddings (kind: "embed" roles): `embed_batch_size` texts per /api/embed call
+
+    def _embed_kwargs(self) -> Dict[str, Any]:
+        kwargs = self._request_kwargs()
+        if self.runtime_options:
+            kwargs["options"] = self.runtime_options
+        return kwargs
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        size = max(1, int(self.embed_batch_size))
+        return [texts[i:i + size] for i in range(0, len(texts), size)]
+
+    def _embed_done(self, resp: Any, start: float, queued: Optional[float] = None) -> List[List[float]]:
+        _record_usage(resp)
+        record_call(self.name, self.tag, resp, latency_s=time.perf_counter() - start,
+                    queue_s=start - queued if queued is not None else 0.0)
+        return [list(v) for v in resp["embeddings"]]
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """One vector per text."""
+        vectors: List[List[float]] = []
+        for batch in self._batches(texts):
+            self._count_call()
+            start = time.perf_counter()
+            resp = self.pool.embed(model=self.tag, input=batch, **self._embed_kwargs())
+            vectors.extend(self._embed_done(resp, start))
+        return vectors
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        async def one(batch: List[str]) -> List[List[float]]:
+            queued = time.perf_counter()
+            async with self._semaphore():
+                self._count_call()
+                start = time.perf_counter()
+                resp = await self.pool.aembed(model=self.tag, input=batch, **self._embed_kwargs())
+            return self._embed_done(resp, start, queued)
+
+        results = await asyncio.gather(*(one(batch) for batch in self._batches(texts)))
+        return [v for vectors in results for v in vectors]
+
+    # ---- Scoring fast path: the server is constrained to emit {"score": <number>}
+    # (structured outputs) and decoding is capped at `score_max_tokens`.
+
+    def _score_options(self, seed: Optional[int] = None) -> Dict[str, Any]:
+        return dict(self._options(seed), num_predict=self.score_max_tokens)
+
+    def _parse_score(self, text: str, lo: float, hi: float) -> Optional[float]:
+        score = None
+        try:
+            score = float(json.loads(text)["score"])
+        except (ValueError, KeyError, TypeError):
+            # Model/server ignored the schema: take the first number in the text
+            match = _NUMBER_RE.search(text)
+            if match:
+                score = float(match.group())
+        if score is None or math.isnan(score) or not lo <= score <= hi:
+            with self._calls_lock:
+                self.score_failures += 1
+            return None
+        return score
+
+    def score(
+        self, prompt: str, system: Optional[str] = None, lo: float = -10.0, hi: float = 10.0,
+        seed: Optional[int] = None,
+    ) -> Optional[float]:
+        """
+        Numeric score in [lo, hi], or None if the output could not be parsed.
+        `seed` overrides the role's seed (e.g. one per consensus rater).
+        """
+        out = self._chat(self._messages(prompt, system), self._score_options(seed), score_schema(lo, hi))
+        return self._parse_score(out, lo, hi)
+
+    async def ascore(
+        self, prompt: str, system: Optional[str] = None, lo: float = -10.0, hi: float = 10.0,
+        seed: Optional[int] = None,
+    ) -> Optional[float]:
+        out = await self._achat(
+            self._messages(prompt, system), self._score_options(seed), score_schema(lo, hi)
         )
-        return resp["message"]["content"].strip()
+        return self._parse_score(out, lo, hi)
+
+    def _parse_scores(self, text: str, n: int, lo: float, hi: float) -> Optional[List[float]]:
+        try:
+            scores = [float(x) for x in json.loads(text)["scores"]]
+        except (ValueError, KeyError, TypeError):
+            scores = []
+        if len(scores) != n or any(math.isnan(x) or not lo <= x <= hi for x in scores):
+            with self._calls_lock:
+                self.score_failures += 1
+            return None
+        return scores
+
+    def score_list(
+        self, prompt: str, n: int, system: Optional[str] = None, lo: float = -10.0, hi: float = 10.0
+    ) -> Optional[List[float]]:
+        """Listwise twin of score(): n scores from one call, or None on a malformed array."""
+        options = dict(self._options(), num_predict=self.score_max_tokens * n)
+        out = self._chat(self._messages(prompt, system), options, scores_schema(n, lo, hi))
+        return self._parse_scores(out, n, lo, hi)
+
+    async def ascore_list(
+        self, prompt: str, n: int, system: Optional[str] = None, lo: float = -10.0, hi: float = 10.0
+    ) -> Optional[List[float]]:
+        options = dict(self._options(), num_predict=self.score_max_tokens * n)
+        out = await self._achat(self._messages(prompt, system), options, scores_schema(n, lo, hi))
+        return self._parse_scores(out, n, lo, hi)
 
 
 class TPO_Models:
-    def __init__(self, project_root: str = r"D:\Research\RL_TPO"):
-        configs = load_all_configs(project_root)
+    def __init__(self, project_root: str = r"D:\Research\RL_TPO",
+                 configs: Optional[Dict[str, Dict[str, Any]]] = None):
+        # `configs` lets callers (benchmarks, tests) pass pre-loaded/edited YAMLs
+        configs = configs or load_all_configs(project_root)
         models_cfg = configs["models.yaml"]["models"]
-        
-        self.policy = OllamaRole(models_cfg["policy"])
-        self.rm_primary = OllamaRole(models_cfg["rm_primary"])
-        self.loss_critic = OllamaRole(models_cfg["loss_critic"])
-        self.gradient_gen = OllamaRole(models_cfg["gradient_gen"])
-        self.consensus_rm = OllamaRole(models_cfg["consensus_rm"])
-        
-        print("✅ 5 TPO models loaded")
+        concurrency = configs["tpo_config.yaml"].get("concurrency", {}) or {}
+
+        # Shared on-disk response cache (see `cache:` in models.yaml)
+        cache_cfg = configs["models.yaml"].get("cache", {}) or {}
+        self.cache = None
+        if cache_cfg.get("enabled", False):
+            self.cache = ResponseCache(
+                os.path.join(project_root, cache_cfg.get("path", "cache/responses.sqlite")),
+                max_bytes=int(cache_cfg.get("max_mb", 512)) * 1024 * 1024,
+            )
+
+        # Role -> Ollama endpoint routing (see `endpoints:` in models.yaml)
+        self.pools = build_client_pools(configs["models.yaml"])
+
+        def role(name: str) -> OllamaRole:
+            return OllamaRole(dict(models_cfg[name], name=name), concurrency.get(name, 1),
+                              self.cache, self.pools[name])
+
+        self.policy = role("policy")
+        self.rm_primary = role("rm_primary")
+        self.loss_critic = role("loss_critic")
+        self.gradient_gen = role("gradient_gen")
+        self.consensus_rm = role("consensus_rm")
+        # Optional embedding model (diversity.py); absent from older models.yaml files
+        self.embedder = role("embedder") if "embedder" in models_cfg else None
+
+        print(f"✅ {len(self.roles())} TPO models loaded")
+
+    def roles(self) -> Dict[str, OllamaRole]:
+        return {
+            "policy": self.policy,
+            "rm_primary": self.rm_primary,
+            "loss_critic": self.loss_critic,
+            "gradient_gen": self.gradient_gen,
+            "consensus_rm": self.consensus_rm,
+            **({"embedder": self.embedder} if self.embedder is not None else {}),
+        }
+
+    @property
+    def n_calls(self) -> int:
+        return sum(role.n_calls for role in self.roles().values())
 
 
 models = None  # global instance
@@ -1,26 +1,472 @@
-# src/rl_core.py - FIXED RL stub
+# src/rl_core.py - RL-TPO++: distill TPO preferences into the policy (LoRA + DPO loss, CPU-sized)
+"""
+Trains a LoRA adapter on the chosen/rejected pairs TPO leaves behind, so the
+policy learns to answer the way TPO's revisions end up answering.
+
+    python src/rl_core.py --data data/trajectories       # or python src/main.py --mode rl
+
+Built for small CPU boxes:
+  * packing: the chosen/rejected sequences of a micro-batch share rows (block-
+    diagonal causal attention, positions restarting per sequence) instead of
+    being padded to the longest one
+  * the frozen reference model runs once: its log-probs are cached on disk
+    next to the checkpoints and reused by every epoch and by later runs
+  * micro-batches are capped in tokens; gradients accumulate up to
+    ppo_batch_size pairs per optimizer step
+
+torch (and transformers, to load real weights) are only imported when training.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
 from config_loader import load_all_configs
-from models import get_models
-from typing import Dict, Any
+from trajectory_store import TrajectoryReader
+from utils import JsonlAppender
+
+Sequences = List[Tuple[List[int], int]]  # (token ids, prompt length) per sequence
+
+
+def _torch():
+    try:
+        import torch
+    except ImportError as e:
+        raise ImportError("Preference distillation needs PyTorch: pip install torch") from e
+    return torch
+
+
+def distill_settings(rl_cfg: Dict[str, Any]) -> Dict[str, Any]:
+    """Flat trainer settings from rl_config.yaml (top-level RL keys + `distill`)."""
+    distill = rl_cfg.get("distill", {}) or {}
+    return {
+        "base_model": distill.get("base_model", "meta-llama/Llama-3.2-1B-Instruct"),
+        "data": distill.get("data", "data/trajectories"),
+        "output_dir": distill.get("output_dir", "checkpoints/distill"),
+        "log_dir": rl_cfg.get("log_dir", "logs/rl_tpo"),
+        "min_margin": float(distill.get("min_margin", 1.0)),
+        "max_seq_len": int(distill.get("max_seq_len", 1024)),
+        "micro_batch_tokens": int(distill.get("micro_batch_tokens", 4096)),
+        "pack": distill.get("pack", True),
+        "threads": distill.get("threads"),
+        "seed": distill.get("seed", 0),
+        "log_every": distill.get("log_every", 1),
+        # YAML reads "1e-5" as a string
+        "learning_rate": float(rl_cfg.get("learning_rate", 1e-5)),
+        "beta": float(rl_cfg.get("beta_kl", 0.1)),
+        "batch_size": int(rl_cfg.get("ppo_batch_size", 64)),
+        "epochs": int(rl_cfg.get("ppo_epochs", 1)),
+        "lora_rank": int(rl_cfg.get("lora_rank", 16)),
+        "lora_alpha": float(rl_cfg.get("lora_alpha", 32)),
+        "target_modules": list(rl_cfg.get("target_modules") or ["q_proj", "v_proj"]),
+        "checkpoint_interval": int(rl_cfg.get("checkpoint_interval", 5000)),
+    }
+
+
+def load_pairs(path: str, min_margin: float = 0.0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Chosen/rejected pairs from a trajectory store directory or a pairs JSONL."""
+    if os.path.isdir(path):
+        with TrajectoryReader(path) as reader:
+            return list(itertools.islice(reader.pairs(min_margin), limit))
+    pairs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                pair = json.loads(line)
+            except ValueError:
+                continue  # torn line from an interrupted run
+            if pair.get("margin", min_margin) >= min_margin:
+                pairs.append(pair)
+            if limit and len(pairs) >= limit:
+                break
+    return pairs
+
+
+def relabel_pairs(pairs: List[Dict[str, Any]], scorer: Any, min_margin: float = 0.0,
+                  concurrency: int = 8) -> List[Dict[str, Any]]:
+    """
+    Re-score both sides of each pair with `scorer` (the RL reward, e.g. a
+    scoring.ConsensusScorer) and keep the pairs it orders the same way by at
+    least `min_margin`, with its scores and margin attached.
+    """
+    async def run() -> List[Any]:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(pair: Dict[str, Any]) -> Any:
+            async with sem:
+                return await asyncio.gather(scorer.areward(pair["prompt"], pair["chosen"]),
+                                            scorer.areward(pair["prompt"], pair["rejected"]))
+
+        return await asyncio.gather(*(one(pair) for pair in pairs))
+
+    kept = []
+    for pair, (chosen, rejected) in zip(pairs, asyncio.run(run())):
+        if chosen is not None and rejected is not None and chosen - rejected >= min_margin:
+            kept.append(dict(pair, chosen_score=chosen, rejected_score=rejected, margin=chosen - rejected))
+    return kept
+
+
+def _encode_prompt(tokenizer: Any, prompt: str) -> List[int]:
+    if getattr(tokenizer, "chat_template", None):
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+        return tokenizer.encode(text, add_special_tokens=False)
+    return tokenizer.encode(f"{prompt}\n\n", add_special_tokens=False)
+
+
+def encode_pairs(pairs: List[Dict[str, Any]], tokenizer: Any, max_len: int) -> Sequences:
+    """
+    Pair i becomes sequences 2i (prompt + chosen) and 2i + 1 (prompt + rejected).
+    Prompts keep their last max_len // 2 tokens, responses are cut to fit.
+    """
+    eos = getattr(tokenizer, "eos_token_id", None)
+    seqs: Sequences = []
+    for pair in pairs:
+        prompt = _encode_prompt(tokenizer, pair["prompt"])[-(max_len // 2):]
+        for key in ("chosen", "rejected"):
+            response = tokenizer.encode(pair[key], add_special_tokens=False)
+            if eos is not None:
+                response.append(eos)
+            seqs.append(((prompt + response)[:max_len], len(prompt)))
+    return seqs
+
+
+def pack_sequences(lengths: Sequence[int], max_len: int) -> List[List[int]]:
+    """First-fit decreasing: rows of sequence indices holding at most max_len tokens each."""
+    rows: List[List[int]] = []
+    free: List[int] = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for r, space in enumerate(free):
+            if lengths[i] <= space:
+                rows[r].append(i)
+                free[r] -= lengths[i]
+                break
+        else:
+            rows.append([i])
+            free.append(max_len - lengths[i])
+    return rows
+
+
+def token_batches(lengths: Sequence[int], max_tokens: int) -> List[List[int]]:
+    """Consecutive index groups of at most max_tokens (a longer item goes alone)."""
+    batches: List[List[int]] = []
+    total = max_tokens
+    for i, n in enumerate(lengths):
+        if total + n > max_tokens:
+            batches.append([])
+            total = 0
+        batches[-1].append(i)
+        total += n
+    return batches
+
+
+def sequence_logps(model: Any, seqs: Sequences, max_len: int, pack: bool = True):
+    """
+    Summed log-probs of each sequence's response tokens, plus the number of
+    token cells the forward pass computed (rows x width, padding included).
+    Packed rows need a model that accepts a 4D additive attention mask and
+    position_ids (Hugging Face causal LMs do); pack=False pads one sequence per row.
+    """
+    torch = _torch()
+    param = next(model.parameters())
+    lengths = [len(ids) for ids, _ in seqs]
+    rows = pack_sequences(lengths, max_len) if pack else [[i] for i in range(len(seqs))]
+    width = max(sum(lengths[i] for i in row) for row in rows)
+    input_ids = torch.zeros(len(rows), width, dtype=torch.long)
+    positions = torch.zeros(len(rows), width, dtype=torch.long)
+    segment = torch.full((len(rows), width), -1, dtype=torch.long)
+    row_idx, pos_idx, owner = [], [], []
+    for r, row in enumerate(rows):
+        start = 0
+        for i in row:
+            ids, n_prompt = seqs[i]
+            n = len(ids)
+            input_ids[r, start:start + n] = torch.tensor(ids)
+            positions[r, start:start + n] = torch.arange(n)
+            segment[r, start:start + n] = i
+            # logits at position p predict token p + 1: score response tokens only
+            first = start + max(n_prompt, 1) - 1
+            pos_idx.append(torch.arange(first, start + n - 1))
+            row_idx.append(torch.full((start + n - 1 - first,), r, dtype=torch.long))
+            owner.append(torch.full((start + n - 1 - first,), i, dtype=torch.long))
+            start += n
+
+    if pack:
+        same = (segment[:, :, None] == segment[:, None, :]) & (segment[:, :, None] >= 0)
+        causal = torch.ones(width, width, dtype=torch.bool).tril()
+        allowed = (same & causal) | torch.eye(width, dtype=torch.bool)  # padding attends to itself
+        mask = torch.zeros(allowed.shape, dtype=param.dtype).masked_fill(~allowed, torch.finfo(param.dtype).min)
+        kwargs = {"attention_mask": mask[:, None].to(param.device), "position_ids": positions.to(param.device)}
+    else:
+        kwargs = {"attention_mask": (segment >= 0).long().to(param.device)}
+    out = model(input_ids=input_ids.to(param.device), use_cache=False, **kwargs)
+    logits = getattr(out, "logits", out)
+
+    row_idx, pos_idx, owner = (torch.cat(t).to(param.device) for t in (row_idx, pos_idx, owner))
+    targets = input_ids.to(param.device)[row_idx, pos_idx + 1]
+    token_logps = logits[row_idx, pos_idx].float().log_softmax(-1).gather(-1, targets[:, None]).squeeze(-1)
+    logps = torch.zeros(len(seqs), device=param.device).index_add(0, owner, token_logps)
+    return logps, len(rows) * width
 
 
-def run_rl_tpo():
-    """RL-TPO++: PPO on TPO trajectories (stub for now)"""
-    configs = load_all_configs()
+def reference_logps(model: Any, seqs: Sequences, settings: Dict[str, Any],
+                    cache_path: Optional[str] = None, cache_key: str = ""):
+    """
+    Log-probs of the frozen model, computed once (no grad) and cached at
+    `cache_path` under `cache_key`. Returns (logps, cache_hit).
+    """
+    torch = _torch()
+    if cache_path and os.path.exists(cache_path):
+        cached = torch.load(cache_path)
+        if cached.get("key") == cache_key:
+            return cached["logps"], True
+    order = sorted(range(len(seqs)), key=lambda i: -len(seqs[i][0]))
+    out = torch.empty(len(seqs))
+    with torch.no_grad():
+        for batch in token_batches([len(seqs[i][0]) for i in order], settings["micro_batch_tokens"]):
+            idx = [order[j] for j in batch]
+            logps, _ = sequence_logps(model, [seqs[i] for i in idx], settings["max_seq_len"], settings["pack"])
+            out[idx] = logps.float().cpu()
+    if cache_path:
+        torch.save({"key": cache_key, "logps": out}, cache_path)
+    return out, False
+
+
+def _lora_forward(module: Any, inputs: Tuple[Any, ...], output: Any) -> Any:
+    if not module.lora_enabled:
+        return None
+    return output + (inputs[0] @ module.lora_A.t() @ module.lora_B.t()) * module.lora_scale
+
+
+def add_lora(model: Any, rank: int, alpha: float, target_modules: List[str]) -> List[Any]:
+    """
+    Freeze the model and add a rank-`rank` update B @ A to every nn.Linear whose
+    name ends in one of `target_modules` (B starts at zero, so the model is
+    unchanged until trained). Returns the trainable LoRA parameters.
+    """
+    torch = _torch()
+    model.requires_grad_(False)
+    params = []
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear) or name.rsplit(".", 1)[-1] not in target_modules:
+            continue
+        w = module.weight
+        module.lora_A = torch.nn.Parameter(torch.empty(rank, module.in_features, dtype=w.dtype, device=w.device))
+        torch.nn.init.kaiming_uniform_(module.lora_A, a=math.sqrt(5))
+        module.lora_B = torch.nn.Parameter(torch.zeros(module.out_features, rank, dtype=w.dtype, device=w.device))
+        module.lora_scale = alpha / rank
+        module.lora_enabled = True
+        module.register_forward_hook(_lora_forward)
+        params += [module.lora_A, module.lora_B]
+    if not params:
+        raise ValueError(f"No nn.Linear modules named {target_modules} in the model")
+    return params
+
+
+def lora_state_dict(model: Any) -> Dict[str, Any]:
+    return {
+        f"{name}.{p}": getattr(module, p).detach().cpu()
+        for name, module in model.named_modules() if hasattr(module, "lora_A")
+        for p in ("lora_A", "lora_B")
+    }
+
+
+def load_lora(model: Any, path: str) -> None:
+    """Load adapter weights saved by train_distill into a model prepared with add_lora."""
+    torch = _torch()
+    state = torch.load(path)["lora"]
+    for name, module in model.named_modules():
+        if hasattr(module, "lora_A"):
+            module.lora_A.data.copy_(state[f"{name}.lora_A"])
+            module.lora_B.data.copy_(state[f"{name}.lora_B"])
+
+
+def _cache_key(model_name: str, settings: Dict[str, Any], seqs: Sequences) -> str:
+    h = hashlib.sha256(json.dumps([model_name, settings["max_seq_len"]]).encode())
+    for ids, n_prompt in seqs:
+        h.update(json.dumps([n_prompt, ids]).encode())
+    return h.hexdigest()
+
+
+def train_distill(model: Any, tokenizer: Any, pairs: List[Dict[str, Any]], settings: Dict[str, Any],
+                  output_dir: str, model_name: str = "", log_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    DPO on (prompt, chosen, rejected) pairs: the adapter is pushed to raise
+    log p(chosen) - log p(rejected) relative to the frozen model, with
+    settings["beta"] (beta_kl) as the strength of the implicit KL anchor.
+    Checkpoints every checkpoint_interval pairs and at the end; returns a summary.
+    """
+    torch = _torch()
+    if settings["threads"]:
+        torch.set_num_threads(int(settings["threads"]))
+    torch.manual_seed(settings["seed"])
+    os.makedirs(output_dir, exist_ok=True)
+    model.eval()  # no dropout: policy and reference log-probs must be comparable
+
+    seqs = encode_pairs(pairs, tokenizer, settings["max_seq_len"])
+    start = time.perf_counter()
+    ref, ref_hit = reference_logps(model, seqs, settings, os.path.join(output_dir, "ref_logps.pt"),
+                                   _cache_key(model_name, settings, seqs))
+    ref_s = time.perf_counter() - start
+    print(f"📐 Reference log-probs for {len(seqs)} sequences: "
+          f"{'cached' if ref_hit else f'{ref_s:.1f}s'}")
+
+    params = add_lora(model, settings["lora_rank"], settings["lora_alpha"], settings["target_modules"])
+    optimizer = torch.optim.AdamW(params, lr=settings["learning_rate"])
+    log = JsonlAppender(log_path) if log_path else None
+    pair_len = [len(seqs[2 * i][0]) + len(seqs[2 * i + 1][0]) for i in range(len(pairs))]
+    rng = random.Random(settings["seed"])
+    n_params = sum(p.numel() for p in params)
+    print(f"🧠 LoRA r={settings['lora_rank']} on {settings['target_modules']}: {n_params:,} trainable params")
+
+    def save(tag: str) -> str:
+        path = os.path.join(output_dir, f"adapter-{tag}.pt")
+        torch.save({"lora": lora_state_dict(model), "samples": samples, "settings": settings,
+                    "base_model": model_name}, path)
+        return path
+
+    samples = steps = tokens = cells = 0
+    next_checkpoint = settings["checkpoint_interval"]
+    checkpoints: List[str] = []
+    record: Dict[str, Any] = {}
+    start = time.perf_counter()
+    try:
+        for epoch in range(settings["epochs"]):
+            order = list(range(len(pairs)))
+            rng.shuffle(order)
+            for b in range(0, len(order), settings["batch_size"]):
+                batch = sorted(order[b:b + settings["batch_size"]], key=lambda i: -pair_len[i])
+                loss_sum = correct = margin_sum = 0.0
+                for micro in token_batches([pair_len[i] for i in batch], settings["micro_batch_tokens"]):
+                    seq_idx = [k for j in micro for k in (2 * batch[j], 2 * batch[j] + 1)]
+                    logps, n_cells = sequence_logps(model, [seqs[k] for k in seq_idx],
+                                                    settings["max_seq_len"], settings["pack"])
+                    ref_lp = ref[seq_idx].to(logps.device)
+                    rewards = settings["beta"] * (logps - ref_lp)
+                    margins = rewards[0::2] - rewards[1::2]
+                    loss = -torch.nn.functional.logsigmoid(margins).sum() / len(batch)
+                    loss.backward()
+                    loss_sum += loss.item()
+                    correct += (margins > 0).sum().item()
+                    margin_sum += margins.sum().item()
+                    tokens += sum(len(seqs[k][0]) for k in seq_idx)
+                    cells += n_cells
+                torch.nn.utils.clip_grad_norm_(params, 1.0)
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+                steps += 1
+                samples += len(batch)
+
+                elapsed = max(time.perf_counter() - start, 1e-9)
+                record = {
+                    "epoch": epoch, "step": steps, "samples": samples, "loss": loss_sum,
+                    "reward_acc": correct / len(batch), "reward_margin": margin_sum / len(batch),
+                    "samples_per_s": samples / elapsed, "tokens_per_s": tokens / elapsed,
+                    "pack_efficiency": tokens / max(cells, 1),
+                }
+                if log is not None:
+                    log.write(record)
+                if steps % settings["log_every"] == 0:
+                    print(f"[epoch {epoch} step {steps}] loss={loss_sum:.4f} acc={record['reward_acc']:.2f} "
+                          f"{record['samples_per_s']:.2f} samples/s, {record['tokens_per_s']:.0f} tok/s, "
+                          f"packing {record['pack_efficiency']:.0%}")
+                while samples >= next_checkpoint:
+                    checkpoints.append(save(f"{next_checkpoint:07d}"))
+                    print(f"💾 Checkpoint: {checkpoints[-1]}")
+                    next_checkpoint += settings["checkpoint_interval"]
+    finally:
+        if log is not None:
+            log.close()
+
+    elapsed = time.perf_counter() - start
+    adapter = save("final")
+    summary = {
+        "pairs": len(pairs),
+        "steps": steps,
+        "samples": samples,
+        "train_s": elapsed,
+        "ref_s": ref_s,
+        "ref_cache_hit": ref_hit,
+        "samples_per_s": samples / max(elapsed, 1e-9),
+        "tokens_per_s": tokens / max(elapsed, 1e-9),
+        "pack_efficiency": tokens / max(cells, 1),
+        "final_loss": record.get("loss"),
+        "final_reward_acc": record.get("reward_acc"),
+        "checkpoints": checkpoints,
+        "adapter": adapter,
+    }
+    print(f"✅ Distilled {len(pairs)} pairs x {settings['epochs']} epochs in {elapsed:.1f}s "
+          f"({summary['samples_per_s']:.2f} samples/s) -> {adapter}")
+    return summary
+
+
+def load_hf_model(name: str):
+    """Model + tokenizer from the Hugging Face hub or a local directory, on CPU in float32."""
+    torch = _torch()
+    try:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+    except ImportError as e:
+        raise ImportError("Loading base weights needs transformers: pip install transformers") from e
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    model = AutoModelForCausalLM.from_pretrained(name, torch_dtype=torch.float32)
+    return model, tokenizer
+
+
+def run_rl_tpo(project_root: str = r"D:\Research\RL_TPO", data: Optional[str] = None,
+               max_pairs: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """RL-TPO++: distill TPO trajectories into a LoRA adapter for the policy."""
+    configs = load_all_configs(project_root)
     rl_cfg = configs["rl_config.yaml"]
-    
-    # FIXED: safe config access
-    algorithm = rl_cfg.get("algorithm", "ppo")
+
+    algorithm = rl_cfg.get("algorithm", "dpo")
     epochs = rl_cfg.get("ppo_epochs", 4)
-    
+
     print("RL-TPO++ Starting...")
     print(f"Algorithm: {algorithm}, Epochs: {epochs}")
-    print("N trajectories:", rl_cfg.get("n_trajectories", 10000))
-    print("LoRA rank:", rl_cfg.get("lora_rank", 16))
-    print("✅ RL config loaded (PPO stub ready)")
-    print("Next: generate TPO trajectories → PPO training")
-    # TODO: full TRL/PPO implementation
+    if algorithm != "dpo":
+        print(f"❌ algorithm {algorithm!r} is not implemented yet; set algorithm: \"dpo\" in rl_config.yaml")
+        return None
+
+    settings = distill_settings(rl_cfg)
+    resolve = lambda p: p if os.path.isabs(p) else os.path.join(project_root, p)  # noqa: E731
+    data_path = resolve(data or settings["data"])
+    pairs = load_pairs(data_path, settings["min_margin"], max_pairs)
+    if not pairs:
+        print(f"❌ No preference pairs with margin >= {settings['min_margin']} in {data_path}")
+        return None
+    print(f"📥 {len(pairs)} preference pairs from {data_path}")
+
+    reward_model = rl_cfg.get("reward_model")
+    if reward_model == "consensus_rm":
+        from models import TPO_Models
+        from scoring import ConsensusScorer
+        consensus_cfg = dict(configs["tpo_config.yaml"].get("consensus") or {}, role=reward_model)
+        scorer = ConsensusScorer.from_config(TPO_Models(project_root, configs), consensus_cfg,
+                                             raters=rl_cfg.get("n_consensus_raters"))
+        before = len(pairs)
+        pairs = relabel_pairs(pairs, scorer, settings["min_margin"])
+        print(f"🗳️ Consensus reward kept {len(pairs)}/{before} pairs | {scorer.stats()}")
+        if not pairs:
+            return None
+
+    model, tokenizer = load_hf_model(settings["base_model"])
+    log_dir = resolve(settings["log_dir"])
+    os.makedirs(log_dir, exist_ok=True)
+    return train_distill(model, tokenizer, pairs, settings, resolve(settings["output_dir"]),
+                         settings["base_model"], os.path.join(log_dir, "distill_log.jsonl"))
 
 
 if __name__ == "__main__":
-    run_rl_tpo()
+    import argparse
+    parser = argparse.ArgumentParser(description="Distill TPO preference pairs into a LoRA adapter")
+    parser.add_argument("--project-root", default=r"D:\Research\RL_TPO")
+    parser.add_argument("--data", help="trajectory store dir or pairs JSONL (default: distill.data)")
+    parser.add_argument("--max-pairs", type=int)
+    args = parser.parse_args()
+    run_rl_tpo(args.project_root, args.data, args.max_pairs)
@@ -0,0 +1,453 @@
+# src/scoring.py - Reward scoring strategies for TPO_Engine.score_responses
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from models import OllamaRole
+from utils import spearman
+
+
+# Prompts are laid out static system block -> query -> candidate(s), so every
+# RM call for a query shares the same prefix and the server can reuse its KV cache.
+SCORE_SYSTEM = (
+    "Score the answer to the query from -10 to 10 (helpfulness, safety, correctness). "
+    'Reply ONLY with JSON: {"score": <number>}.'
+)
+LISTWISE_SYSTEM = (
+    "Score each numbered answer to the query from -10 to 10 (helpfulness, safety, "
+    "correctness). Judge each answer on its own merits. "
+    'Reply ONLY with JSON: {"scores": [<score of [1]>, <score of [2]>, ...]} in the same order.'
+)
+
+
+def score_prompt(query: str, resp: str) -> str:
+    return f"Query: {query}\n\nResponse: {resp}"
+
+
+def listwise_prompt(query: str, responses: List[str]) -> str:
+    answers = "\n\n".join(f"[{i + 1}] {resp}" for i, resp in enumerate(responses))
+    return f"Query: {query}\n\n{answers}\n\n({len(responses)} answers)"
+
+
+async def primed_gather(calls: List[Callable[[], Awaitable[Any]]], prime: bool = True) -> List[Any]:
+    """
+    Run calls that share a prompt prefix. With `prime`, the first runs alone so
+    the server prefills the shared prefix once; the rest then reuse it from the
+    KV cache (Ollama copies a cached prefix into other parallel slots) instead
+    of all prefilling it side by side.
+    """
+    if not prime or len(calls) < 2:
+        return list(await asyncio.gather(*(call() for call in calls)))
+    first = await calls[0]()
+    return [first] + list(await asyncio.gather(*(call() for call in calls[1:])))
+
+
+class PointwiseScorer:
+    """
+    One RM call per candidate (the original TPO scoring). With `prime`, the
+    async path scores the first candidate alone so the shared system + query
+    prefix is in the server's KV cache before the rest go out concurrently.
+    `seed` pins sampling for RM roles run at temperature > 0.
+    """
+
+    def __init__(self, rm: OllamaRole, prime: bool = False, seed: Optional[int] = None):
+        self.rm = rm
+        self.prime = prime
+        self.seed = seed
+
+    def score(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        return [self.rm.score(score_prompt(query, resp), SCORE_SYSTEM, seed=self.seed) for resp in responses]
+
+    async def ascore(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        calls = [lambda r=resp: self.rm.ascore(score_prompt(query, r), SCORE_SYSTEM, seed=self.seed)
+                 for resp in responses]
+        return await primed_gather(calls, self.prime)
+
+
+class ListwiseScorer:
+    """
+    All candidates of a step in one RM call, so the query is prefilled once
+    instead of N times. Candidate sets longer than `max_chars` are split into
+    chunks; a chunk whose score array cannot be parsed is re-scored pointwise.
+    """
+
+    def __init__(self, rm: OllamaRole, max_chars: int = 6000):
+        self.rm = rm
+        self.max_chars = max_chars
+        self.fallback = PointwiseScorer(rm)
+
+    def chunks(self, query: str, responses: List[str]) -> List[List[int]]:
+        budget = max(self.max_chars - len(query), 1)
+        chunks, current, used = [], [], 0
+        for i, resp in enumerate(responses):
+            if current and used + len(resp) > budget:
+                chunks.append(current)
+                current, used = [], 0
+            current.append(i)
+            used += len(resp)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def score(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        scores: List[Optional[float]] = [None] * len(responses)
+        for idx in self.chunks(query, responses):
+            batch = [responses[i] for i in idx]
+            out = self.rm.score_list(listwise_prompt(query, batch), len(batch), LISTWISE_SYSTEM)
+            if out is None:
+                out = self.fallback.score(query, batch)
+            for i, s in zip(idx, out):
+                scores[i] = s
+        return scores
+
+    async def ascore(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        async def one(batch: List[str]) -> List[Optional[float]]:
+            out = await self.rm.ascore_list(listwise_prompt(query, batch), len(batch), LISTWISE_SYSTEM)
+            if out is None:
+                out = await self.fallback.ascore(query, batch)
+            return out
+
+        idx_chunks = self.chunks(query, responses)
+        results = await asyncio.gather(
+            *(one([responses[i] for i in idx]) for idx in idx_chunks)
+        )
+        scores: List[Optional[float]] = [None] * len(responses)
+        for idx, out in zip(idx_chunks, results):
+            for i, s in zip(idx, out):
+                scores[i] = s
+        return scores
+
+
+def _argmax(scores: List[Optional[float]]) -> Optional[int]:
+    valid = [i for i, s in enumerate(scores) if s is not None]
+    return max(valid, key=lambda i: scores[i]) if valid else None
+
+
+def _argmin(scores: List[Optional[float]]) -> Optional[int]:
+    valid = [i for i, s in enumerate(scores) if s is not None]
+    return min(valid, key=lambda i: scores[i]) if valid else None
+
+
+class CascadeScorer:
+    """
+    Two-stage scoring: a cheap RM (e.g. the 3B consensus_rm) scores every
+    candidate, and only its `top_k` highest and `bottom_k` lowest, plus any
+    within `margin` of those cut-offs or left unscored, go on to the full RM,
+    since only the best and worst candidates drive the textual loss. Other
+    candidates keep their cheap score, shifted by the mean full-minus-cheap
+    offset of the promoted ones and kept strictly inside the promoted score
+    range (strictly below it when the promoted scores tie or only one parsed),
+    so they never displace the full RM's chosen pick. If no promoted score
+    parses, the cheap scores are used as they are.
+
+    With `audit`, the non-promoted candidates are also scored by the full RM
+    (scores returned are still the cascade's) and stats() reports how often
+    the cascade picked a different chosen or rejected candidate.
+    """
+
+    EPS = 0.01  # keeps non-promoted scores off the promoted extremes (the pool prefers the newest on ties)
+
+    def __init__(self, cheap: OllamaRole, rm: OllamaRole, top_k: int = 1, bottom_k: int = 1,
+                 margin: float = 0.0, audit: bool = False, prime: bool = False):
+        self.rm = rm
+        self.cheap = PointwiseScorer(cheap, prime, seed=0)
+        self.full = PointwiseScorer(rm, prime)
+        self.top_k = max(0, top_k)
+        self.bottom_k = max(0, bottom_k)
+        if self.top_k + self.bottom_k == 0:
+            raise ValueError("cascade needs top_k + bottom_k >= 1: nothing would reach the full RM")
+        self.margin = margin
+        self.audit = audit
+        self._lock = threading.Lock()
+        self.sets = self.candidates = self.cheap_calls = self.full_calls = 0
+        self.audited = self.chosen_changed = self.rejected_changed = 0
+
+    @classmethod
+    def from_config(cls, models: Any, cfg: Optional[Dict[str, Any]], prime: bool = False) -> "CascadeScorer":
+        """Build from the `cascade` section of tpo_config.yaml."""
+        cfg = cfg or {}
+        return cls(
+            getattr(models, cfg.get("cheap_role", "consensus_rm")),
+            getattr(models, cfg.get("role", "rm_primary")),
+            top_k=cfg.get("top_k", 1),
+            bottom_k=cfg.get("bottom_k", 1),
+            margin=cfg.get("margin", 0.0),
+            audit=cfg.get("audit", False),
+            prime=prime,
+        )
+
+    def promoted(self, cheap: List[Optional[float]]) -> List[int]:
+        """Indices the full RM must score, given the cheap scores."""
+        if len(cheap) <= self.top_k + self.bottom_k:
+            return list(range(len(cheap)))
+        known = sorted((i for i, s in enumerate(cheap) if s is not None), key=lambda i: cheap[i])
+        promote = {i for i, s in enumerate(cheap) if s is None}
+        if self.bottom_k and known:
+            cut = cheap[known[min(self.bottom_k, len(known)) - 1]] + self.margin
+            promote.update(i for i in known if cheap[i] <= cut)
+        if self.top_k and known:
+            cut = cheap[known[-min(self.top_k, len(known))]] - self.margin
+            promote.update(i for i in known if cheap[i] >= cut)
+        return sorted(promote)
+
+    def _merge(self, cheap: List[Optional[float]], idx: List[int],
+               full: List[Optional[float]]) -> List[Optional[float]]:
+        scores: List[Optional[float]] = [None] * len(cheap)
+        for i, s in zip(idx, full):
+            scores[i] = s
+        valid = [(cheap[i], s) for i, s in zip(idx, full) if s is not None and cheap[i] is not None]
+        if not valid:
+            # Nothing to calibrate against: the cheap scores are better than none
+            return [c if s is None else s for c, s in zip(cheap, scores)]
+        offset = sum(s - c for c, s in valid) / len(valid)
+        lo, hi = min(s for _, s in valid) + self.EPS, max(s for _, s in valid) - self.EPS
+        if lo > hi:
+            # Promoted scores tie (or one parsed): no room inside, stay below them
+            lo, hi = -float("inf"), min(s for _, s in valid) - self.EPS
+        for i, c in enumerate(cheap):
+            if i not in idx and c is not None:
+                scores[i] = max(lo, min(hi, c + offset))
+        return scores
+
+    def _record(self, n: int, cheap_calls: int, full_calls: int, scores: List[Optional[float]],
+                reference: Optional[List[Optional[float]]] = None) -> None:
+        with self._lock:
+            self.sets += 1
+            self.candidates += n
+            self.cheap_calls += cheap_calls
+            self.full_calls += full_calls
+            if reference is not None:
+                self.audited += 1
+                self.chosen_changed += _argmax(scores) != _argmax(reference)
+                self.rejected_changed += _argmin(scores) != _argmin(reference)
+
+    def _reference(self, idx: List[int], full: List[Optional[float]],
+                   rest: List[Optional[float]], n: int) -> List[Optional[float]]:
+        reference: List[Optional[float]] = [None] * n
+        others = [i for i in range(n) if i not in idx]
+        for i, s in list(zip(idx, full)) + list(zip(others, rest)):
+            reference[i] = s
+        return reference
+
+    def score(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        if len(responses) <= self.top_k + self.bottom_k:
+            full = self.full.score(query, responses)
+            self._record(len(responses), 0, len(responses), full)
+            return full
+        cheap = self.cheap.score(query, responses)
+        idx = self.promoted(cheap)
+        full = self.full.score(query, [responses[i] for i in idx])
+        scores = self._merge(cheap, idx, full)
+        reference = None
+        if self.audit:
+            rest = self.full.score(query, [r for i, r in enumerate(responses) if i not in idx])
+            reference = self._reference(idx, full, rest, len(responses))
+        self._record(len(responses), len(responses), len(idx), scores, reference)
+        return scores
+
+    # ---- Async path, split in its two passes so BatchTPO can run each over a
+    # whole batch with one model resident (see batch_engine.BatchTPO._score).
+
+    async def acheap(self, query: str, responses: List[str]) -> Optional[List[Optional[float]]]:
+        """Cheap-RM scores; None for a set small enough to go straight to the full RM."""
+        if len(responses) <= self.top_k + self.bottom_k:
+            return None
+        return await self.cheap.ascore(query, responses)
+
+    def to_promote(self, cheap: Optional[List[Optional[float]]], n: int) -> List[int]:
+        return list(range(n)) if cheap is None else self.promoted(cheap)
+
+    async def afull(self, query: str, responses: List[str],
+                    idx: List[int]) -> Tuple[List[Optional[float]], Optional[List[Optional[float]]]]:
+        """Full-RM scores of the promoted candidates, and (with `audit`) of the rest."""
+        promoted = self.full.ascore(query, [responses[i] for i in idx])
+        if not self.audit:
+            return await promoted, None
+        others = [r for i, r in enumerate(responses) if i not in idx]
+        full, rest = await asyncio.gather(promoted, self.full.ascore(query, others))
+        return full, rest
+
+    def combine(self, n: int, cheap: Optional[List[Optional[float]]], idx: List[int],
+                full: List[Optional[float]], rest: Optional[List[Optional[float]]] = None) -> List[Optional[float]]:
+        if cheap is None:
+            self._record(n, 0, n, full)
+            return full
+        scores = self._merge(cheap, idx, full)
+        reference = self._reference(idx, full, rest, n) if rest is not None else None
+        self._record(n, n, len(idx), scores, reference)
+        return scores
+
+    async def ascore(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        cheap = await self.acheap(query, responses)
+        idx = self.to_promote(cheap, len(responses))
+        full, rest = await self.afull(query, responses, idx)
+        return self.combine(len(responses), cheap, idx, full, rest)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sets": self.sets,
+            "candidates": self.candidates,
+            "cheap_calls": self.cheap_calls,
+            "full_calls": self.full_calls,
+            "full_calls_saved": self.candidates - self.full_calls,
+            "full_saved_frac": (self.candidates - self.full_calls) / self.candidates if self.candidates else 0.0,
+            "audited": self.audited,
+            "chosen_changed": self.chosen_changed / self.audited if self.audited else 0.0,
+            "rejected_changed": self.rejected_changed / self.audited if self.audited else 0.0,
+        }
+
+
+def consensus(scores: List[Optional[float]], quorum: int, tolerance: float) -> Optional[float]:
+    """Mean of the largest group of >= `quorum` scores spanning at most `tolerance`, else None."""
+    vals = sorted(s for s in scores if s is not None)
+    best: List[float] = []
+    lo = 0
+    for hi in range(len(vals)):
+        while vals[hi] - vals[lo] > tolerance:
+            lo += 1
+        if hi - lo + 1 >= max(quorum, len(best) + 1):
+            best = vals[lo:hi + 1]
+    return sum(best) / len(best) if best else None
+
+
+class ConsensusScorer:
+    """
+    maj@K scoring: up to `raters` RM calls per candidate, rater k sampling with
+    seed k (run the role at temperature > 0 so raters differ). The first
+    `quorum` raters go out together and more are only asked while no `quorum`
+    of the scores lie within `tolerance`, so candidates the raters agree on
+    cost `quorum` calls instead of `raters`. With `race`, all raters go out at
+    once and the ones still queued or running are cancelled when a quorum
+    forms (lower latency, no savings). The score is the mean of the
+    agreeing raters, or the median of all raters when none agree.
+
+    Doubles as the RL reward (reward / areward). stats() reports the
+    agreement rate and the calls saved against asking every rater. A raced
+    rater counts as a call once launched, answered or not: a cancelled one
+    may already have reached the server.
+    """
+
+    def __init__(self, rm: OllamaRole, raters: int = 3, quorum: int = 2, tolerance: float = 1.0,
+                 race: bool = False, prime: bool = False):
+        self.rm = rm
+        self.raters = max(1, raters)
+        self.quorum = max(1, min(quorum, self.raters))
+        self.tolerance = tolerance
+        self.race = race
+        self.prime = prime
+        self._lock = threading.Lock()
+        self.items = self.calls = self.answered = self.agreed = self.early = 0
+
+    @classmethod
+    def from_config(cls, models: Any, cfg: Optional[Dict[str, Any]], prime: bool = False,
+                    raters: Optional[int] = None) -> "ConsensusScorer":
+        """Build from the `consensus` section of tpo_config.yaml; `raters` overrides its count."""
+        cfg = cfg or {}
+        return cls(
+            getattr(models, cfg.get("role", "consensus_rm")),
+            raters=raters or cfg.get("raters", 3),
+            quorum=cfg.get("quorum", 2),
+            tolerance=cfg.get("tolerance", 1.0),
+            race=cfg.get("race", False),
+            prime=prime,
+        )
+
+    def _finish(self, scores: List[Optional[float]], launched: Optional[int] = None) -> Optional[float]:
+        agreed = consensus(scores, self.quorum, self.tolerance)
+        with self._lock:
+            self.items += 1
+            self.calls += len(scores) if launched is None else launched
+            self.answered += len(scores)
+            self.agreed += agreed is not None
+            self.early += len(scores) < self.raters
+        if agreed is not None:
+            return agreed
+        vals = sorted(s for s in scores if s is not None)
+        if not vals:
+            return None
+        mid = len(vals) // 2
+        return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2
+
+    def _settled(self, scores: List[Optional[float]]) -> bool:
+        return len(scores) >= self.raters or consensus(scores, self.quorum, self.tolerance) is not None
+
+    def reward(self, query: str, response: str) -> Optional[float]:
+        prompt = score_prompt(query, response)
+        scores = [self.rm.score(prompt, SCORE_SYSTEM, seed=k) for k in range(self.quorum)]
+        while not self._settled(scores):
+            scores.append(self.rm.score(prompt, SCORE_SYSTEM, seed=len(scores)))
+        return self._finish(scores)
+
+    async def areward(self, query: str, response: str) -> Optional[float]:
+        prompt = score_prompt(query, response)
+        if self.race:
+            return await self._arace(prompt)
+        scores = list(await asyncio.gather(
+            *(self.rm.ascore(prompt, SCORE_SYSTEM, seed=k) for k in range(self.quorum))
+        ))
+        while not self._settled(scores):
+            scores.append(await self.rm.ascore(prompt, SCORE_SYSTEM, seed=len(scores)))
+        return self._finish(scores)
+
+    async def _arace(self, prompt: str) -> Optional[float]:
+        pending = {asyncio.ensure_future(self.rm.ascore(prompt, SCORE_SYSTEM, seed=k))
+                   for k in range(self.raters)}
+        scores: List[Optional[float]] = []
+        try:
+            while pending and not self._settled(scores):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                scores.extend(task.result() for task in done)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return self._finish(scores, launched=self.raters)
+
+    def score(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        return [self.reward(query, resp) for resp in responses]
+
+    async def ascore(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        calls = [lambda r=resp: self.areward(query, r) for resp in responses]
+        return await primed_gather(calls, self.prime)
+
+    def stats(self) -> Dict[str, Any]:
+        full = self.items * self.raters
+        return {
+            "items": self.items,
+            "calls": self.calls,
+            "answered": self.answered,
+            "cancelled": self.calls - self.answered,
+            "calls_per_item": self.calls / self.items if self.items else 0.0,
+            "calls_saved": full - self.calls,
+            "saved_frac": (full - self.calls) / full if full else 0.0,
+            "agreement_rate": self.agreed / self.items if self.items else 0.0,
+            "early_rate": self.early / self.items if self.items else 0.0,
+        }
+
+
+def agreement(reference: List[List[Optional[float]]], candidate: List[List[Optional[float]]]) -> Dict[str, Any]:
+    """
+    Compare two scorers over the same candidate sets (one list per query).
+    Reports rank correlation, how often both pick the same chosen / rejected
+    candidate, and the mean absolute score difference.
+    """
+    rhos, top, bottom, diffs = [], 0, 0, []
+    n_sets = 0
+    for ref, cand in zip(reference, candidate):
+        pairs = [(r, c) for r, c in zip(ref, cand) if r is not None and c is not None]
+        if len(pairs) < 2:
+            continue
+        n_sets += 1
+        r_vals = [r for r, _ in pairs]
+        c_vals = [c for _, c in pairs]
+        rhos.append(spearman(r_vals, c_vals))
+        top += r_vals.index(max(r_vals)) == c_vals.index(max(c_vals))
+        bottom += r_vals.index(min(r_vals)) == c_vals.index(min(c_vals))
+        diffs.extend(abs(r - c) for r, c in pairs)
+    return {
+        "n_sets": n_sets,
+        "spearman": sum(rhos) / len(rhos) if rhos else 0.0,
+        "chosen_agreement": top / n_sets if n_sets else 0.0,
+        "rejected_agreement": bottom / n_sets if n_sets else 0.0,
+        "mean_abs_diff": sum(diffs) / len(diffs) if diffs else 0.0,
+    }
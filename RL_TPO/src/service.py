@@ -0,0 +1,333 @@
+# src/service.py - Long-running TPO service: one warm engine, bounded request queue, streamed progress
+"""
+    python src/main.py --mode serve                      # http://127.0.0.1:8765
+    python src/service.py --socket /tmp/rl_tpo.sock      # Unix socket instead of TCP
+
+    curl -N -d '{"query": "How do you get water in the desert?"}' http://127.0.0.1:8765/tpo
+    curl http://127.0.0.1:8765/stats
+
+POST /tpo takes {"query", "deadline_s"?, "token_budget"?, "stream"?} and streams
+NDJSON events (queued, started, step, done | error); with "stream": false it
+returns only the final result. A full queue answers 429 with Retry-After.
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from tpo_core import TPO_Engine
+from utils import percentile
+
+MAX_BODY_BYTES = 1 << 20
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class TPOJob:
+    """One queued TPO request; progress events are pushed to `events`."""
+
+    def __init__(self, job_id: int, query: str, deadline_s: Optional[float] = None,
+                 token_budget: Optional[int] = None):
+        self.id = job_id
+        self.query = query
+        self.deadline_s = deadline_s
+        self.token_budget = token_budget
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.enqueued = time.perf_counter()
+        self.started: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancelled = False
+
+    def emit(self, event: str, **data: Any) -> None:
+        self.events.put_nowait(dict(data, event=event, job_id=self.id))
+
+    def cancel(self) -> None:
+        """Client went away: skip the job if still queued, else stop its run."""
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+class TPOService:
+    """
+    Keeps one TPO_Engine (and its warm Ollama roles) alive and runs incoming
+    queries through `workers` concurrent arun_tpo loops. At most `max_queue`
+    requests wait for a worker; beyond that requests are rejected at once
+    rather than queued without bound (admission control).
+    """
+
+    def __init__(self, engine: TPO_Engine, workers: int = 2, max_queue: int = 16,
+                 warm: bool = True, keep_alive: Optional[str] = "30m"):
+        self.engine = engine
+        self.workers = max(1, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self.warm = warm
+        self.keep_alive = keep_alive
+        self.queue: Optional[asyncio.Queue] = None
+        self._ids = itertools.count(1)
+        self._tasks: List[asyncio.Task] = []
+        self.started_at = time.time()
+        self.in_flight = 0
+        self.counts = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "cancelled": 0}
+        self.queue_wait_s: Deque[float] = deque(maxlen=1000)
+        self.latency_s: Deque[float] = deque(maxlen=1000)
+
+    @classmethod
+    def from_config(cls, engine: TPO_Engine) -> "TPOService":
+        cfg = engine.tpo_cfg.get("service", {}) or {}
+        return cls(engine, cfg.get("workers", 2), cfg.get("max_queue", 16),
+                   cfg.get("warm", True), cfg.get("keep_alive", "30m"))
+
+    def _tpo_roles(self):
+        m = self.engine.models
+        roles = [m.policy, getattr(m, self.engine.score_role), m.loss_critic, m.gradient_gen]
+        if self.engine.diversity is not None:
+            roles.append(self.engine.diversity.embedder)
+        if self.engine.gradient_cache is not None:
+            roles.append(self.engine.gradient_cache.embedder)
+        return roles
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue(self.max_queue)
+        for role in self._tpo_roles():
+            if role.keep_alive is None and self.keep_alive is not None:
+                role.keep_alive = self.keep_alive  # keep models resident between requests
+        if self.warm:
+            for role in {r.tag: r for r in self._tpo_roles()}.values():
+                start = time.perf_counter()
+                try:
+                    await asyncio.to_thread(role.warm)
+                    print(f"🔥 Warmed {role.tag} in {time.perf_counter() - start:.1f}s")
+                except Exception as e:
+                    print(f"[WARN] Could not warm {role.tag}: {e}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, query: str, deadline_s: Optional[float] = None,
+               token_budget: Optional[int] = None) -> TPOJob:
+        """Queue a query; raises asyncio.QueueFull when the queue is at capacity."""
+        job = TPOJob(next(self._ids), query, deadline_s, token_budget)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counts["rejected"] += 1
+            raise
+        self.counts["submitted"] += 1
+        job.emit("queued", position=self.queue.qsize())
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.cancelled:
+                    self.counts["cancelled"] += 1
+                    continue
+                await self._run(job)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: TPOJob) -> None:
+        job.started = time.perf_counter()
+        wait = job.started - job.enqueued
+        self.queue_wait_s.append(wait)
+        self.in_flight += 1
+        job.emit("started", queue_wait_s=wait)
+
+        def progress(p: Dict[str, Any]) -> None:
+            job.emit("step", **p)
+
+        job.task = asyncio.create_task(self.engine.arun_tpo_budgeted(
+            job.query, job.deadline_s, job.token_budget, progress=progress
+        ))
+        try:
+            # wait() does not raise if the job task is cancelled by its client
+            await asyncio.wait([job.task])
+        except asyncio.CancelledError:
+            job.task.cancel()
+            raise
+        finally:
+            self.in_flight -= 1
+
+        if job.task.cancelled():
+            self.counts["cancelled"] += 1
+        elif job.task.exception() is not None:
+            self.counts["failed"] += 1
+            e = job.task.exception()
+            job.emit("error", error=f"{type(e).__name__}: {e}")
+        else:
+            latency = time.perf_counter() - job.enqueued
+            self.latency_s.append(latency)
+            self.counts["completed"] += 1
+            job.emit("done", result=job.task.result(), latency_s=latency)
+
+    def stats(self) -> Dict[str, Any]:
+        waits, lats = list(self.queue_wait_s), list(self.latency_s)
+        stats = {
+            "uptime_s": time.time() - self.started_at,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "workers": self.workers,
+            **self.counts,
+            "queue_wait_p50_s": percentile(waits, 50),
+            "queue_wait_p90_s": percentile(waits, 90),
+            "latency_p50_s": percentile(lats, 50),
+            "latency_p90_s": percentile(lats, 90),
+            "latency_p99_s": percentile(lats, 99),
+            "llm_calls": self.engine.models.n_calls,
+        }
+        if self.engine.gradient_cache is not None:
+            stats["gradient_cache"] = self.engine.gradient_cache.stats()
+        return stats
+
+    # ---- HTTP/1.1 front end (one request per connection)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+            except ValueError as e:
+                await self._send_json(writer, 413 if "too large" in str(e) else 400, {"error": str(e)})
+                return
+            if path == "/health":
+                await self._send_json(writer, 200, {"status": "ok"})
+            elif path == "/stats":
+                await self._send_json(writer, 200, self.stats())
+            elif path == "/tpo":
+                if method != "POST":
+                    await self._send_json(writer, 405, {"error": "use POST"})
+                else:
+                    await self._handle_tpo(writer, body)
+            else:
+                await self._send_json(writer, 404, {"error": f"no route {path}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            raise ValueError("malformed request line")
+        method, path = request_line[0].upper(), request_line[1].split("?")[0]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_BYTES:
+            raise ValueError("request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path, body
+
+    async def _handle_tpo(self, writer: asyncio.StreamWriter, body: bytes) -> None:
+        try:
+            req = json.loads(body or b"{}")
+            query = req["query"]
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError("query must be a non-empty string")
+        except (ValueError, KeyError, TypeError) as e:
+            await self._send_json(writer, 400, {"error": f"bad request: {e}"})
+            return
+
+        try:
+            job = self.submit(query, req.get("deadline_s"), req.get("token_budget"))
+        except asyncio.QueueFull:
+            await self._send_json(writer, 429, {"error": "queue full", **self.stats()},
+                                  {"Retry-After": str(self._retry_after())})
+            return
+
+        stream = req.get("stream", True)
+        try:
+            if stream:
+                writer.write(self._head(200, "application/x-ndjson"))
+            while True:
+                event = await job.events.get()
+                final = event["event"] in ("done", "error")
+                if stream:
+                    writer.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                    await writer.drain()
+                if final:
+                    break
+            if not stream:
+                code = 200 if event["event"] == "done" else 500
+                await self._send_json(writer, code, event)
+        except (ConnectionError, asyncio.CancelledError):
+            job.cancel()
+            raise
+
+    def _retry_after(self) -> int:
+        """Rough seconds until a queue slot frees up."""
+        per_job = percentile(list(self.latency_s), 50) or 30.0
+        return max(1, int(per_job * self.queue.qsize() / self.workers))
+
+    @staticmethod
+    def _head(code: int, content_type: str, extra: Optional[Dict[str, str]] = None,
+              length: Optional[int] = None) -> bytes:
+        lines = [f"HTTP/1.1 {code} {STATUS_TEXT.get(code, '')}",
+                 f"Content-Type: {content_type}", "Connection: close"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        lines += [f"{k}: {v}" for k, v in (extra or {}).items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send_json(self, writer: asyncio.StreamWriter, code: int, payload: Dict[str, Any],
+                         extra: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(self._head(code, "application/json", extra, len(data)) + data)
+        await writer.drain()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765,
+                    socket_path: Optional[str] = None) -> None:
+        await self.start()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            where = f"unix:{socket_path}"
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            where = "http://{}:{}".format(*server.sockets[0].getsockname()[:2])
+        print(f"🚀 TPO service on {where} (workers={self.workers}, max_queue={self.max_queue})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def run_service(engine: TPO_Engine, host: Optional[str] = None, port: Optional[int] = None,
+                socket_path: Optional[str] = None) -> None:
+    """Blocking entry point; unset host/port come from the `service` section of tpo_config.yaml."""
+    cfg = engine.tpo_cfg.get("service", {}) or {}
+    service = TPOService.from_config(engine)
+    try:
+        asyncio.run(service.serve(host or cfg.get("host", "127.0.0.1"),
+                                  port or cfg.get("port", 8765), socket_path))
+    except KeyboardInterrupt:
+        print("\n👋 Service stopped")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="RL-TPO++ service")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    args = parser.parse_args()
+    run_service(TPO_Engine(), args.host, args.port, args.socket)
+
+if __name__ == "__main__":
+    main()
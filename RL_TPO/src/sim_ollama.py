@@ -0,0 +1,462 @@
+# src/sim_ollama.py - Local stand-in for an Ollama server (tests / benchmarks)
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Union
+
+Reply = Union[str, Callable[[str, List[Dict[str, str]]], str]]
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # bursts of concurrent clients; the default 5 drops SYNs
+
+
+class SimulatedFailure(Exception):
+    """Injected server error (answered with HTTP 500)."""
+
+
+class SimOllamaServer:
+    """
+    HTTP server speaking the non-streaming Ollama /api/chat protocol, with a
+    simple cost model so TPO performance can be measured without real models.
+
+    Per request: wait for one of `parallel` slots (0 = unlimited), load the
+    model if it is not resident (`load_time_s`, a float or {tag: seconds};
+    at most `max_loaded_models` stay resident, 0 = unlimited; /api/ps reports
+    `model_size_gb`, likewise per tag), then sleep
+    latency_s + prompt_tokens / prefill_tokens_per_s + output_tokens / tokens_per_s,
+    scaled by a lognormal(0, jitter) factor drawn from a seeded RNG.
+
+    With `prefix_cache`, each model keeps the token lists of its last
+    `kv_slots` prompts (tokens = words, plus one marker per message); a new
+    prompt only prefills the part after its longest common prefix with one of
+    them, and prompt_eval_count reports just that part, as Ollama does. A
+    prompt enters the cache once its prefill is done, so identical requests
+    sent side by side all pay the full prefill.
+
+    Replies are `reply` (a string or a function (model, messages) -> str), or
+    with reply=None deterministic canned text of `output_tokens` words, where
+    sampled requests (temperature > 0, no seed) get a distinct reply per
+    repetition of the same prompt, like real sampling. Requests with a
+    {"score"} / {"scores"} JSON schema in `format` always get a stable score
+    derived from the prompt text; with `score_noise`, sampled {"score"}
+    requests add a uniform +-score_noise offset drawn per seed (or per
+    request when unseeded), so repeated raters disagree like sampled RMs.
+
+    /api/embed returns hashed bag-of-words vectors (`embed_dim` wide), so
+    texts sharing most words get a high cosine similarity; it is charged
+    like a prefill of the inputs' words.
+
+    Faults for resilience tests: a request stalls for `stall_s` extra
+    seconds with probability `stall_rate` (a hung generation; stop() ends
+    it), or fails with HTTP 500 with probability `error_rate`. Both can be
+    changed while the server runs.
+    """
+
+    def __init__(
+        self,
+        reply: Optional[Reply] = "ok",
+        latency_s: float = 0.0,
+        port: int = 0,
+        jitter: float = 0.0,
+        tokens_per_s: Optional[float] = None,
+        prefill_tokens_per_s: Optional[float] = None,
+        load_time_s: Union[float, Dict[str, float]] = 0.0,
+        model_size_gb: Union[float, Dict[str, float]] = 0.0,
+        max_loaded_models: int = 0,
+        parallel: int = 0,
+        output_tokens: int = 32,
+        seed: int = 0,
+        prefix_cache: bool = True,
+        kv_slots: int = 4,
+        score_noise: float = 0.0,
+        embed_dim: int = 64,
+        stall_rate: float = 0.0,
+        stall_s: float = 30.0,
+        error_rate: float = 0.0,
+    ):
+        self.reply = reply
+        self.latency_s = latency_s
+        self.jitter = jitter
+        self.tokens_per_s = tokens_per_s
+        self.prefill_tokens_per_s = prefill_tokens_per_s
+        self.load_time_s = load_time_s
+        self.model_size_gb = model_size_gb
+        self.max_loaded_models = max_loaded_models
+        self.output_tokens = output_tokens
+        self.prefix_cache = prefix_cache
+        self.kv_slots = max(1, kv_slots)
+        self.score_noise = score_noise
+        self.embed_dim = embed_dim
+        self.stall_rate = stall_rate
+        self.stall_s = stall_s
+        self.error_rate = error_rate
+
+        self.requests = 0
+        self.model_loads = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+        self.stalls = 0
+        self.errors = 0
+        self.per_model: Counter = Counter()
+        self.calls: List[Dict[str, Any]] = []
+
+        self._rng = random.Random(seed)
+        self._fault_rng = random.Random(seed + 1)
+        self._stopped = threading.Event()
+        self._seen: Counter = Counter()
+        self._loaded: "OrderedDict[str, None]" = OrderedDict()
+        self._kv: Dict[str, List[List[str]]] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(parallel) if parallel > 0 else None
+
+        self._httpd = _HTTPServer(("127.0.0.1", port), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "SimOllamaServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "SimOllamaServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "model_loads": self.model_loads,
+            "max_in_flight": self.max_in_flight,
+            "prefill_tokens": self.prefill_tokens,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+            "stalls": self.stalls,
+            "errors": self.errors,
+            "per_model": dict(self.per_model),
+        }
+
+    # ---- cost model
+
+    def _load(self, model: str) -> float:
+        """Make `model` resident; returns the simulated load time paid."""
+        with self._load_lock:
+            if model in self._loaded:
+                self._loaded.move_to_end(model)
+                return 0.0
+            penalty = (
+                self.load_time_s.get(model, 0.0)
+                if isinstance(self.load_time_s, dict) else self.load_time_s
+            )
+            time.sleep(penalty)
+            self._loaded[model] = None
+            if self.max_loaded_models and len(self._loaded) > self.max_loaded_models:
+                self._loaded.popitem(last=False)
+            with self._lock:
+                self.model_loads += 1
+            return penalty
+
+    def _size_bytes(self, model: str) -> int:
+        gb = self.model_size_gb.get(model, 0.0) if isinstance(self.model_size_gb, dict) else self.model_size_gb
+        return int(gb * 1024 ** 3)
+
+    def _unload(self, model: str) -> None:
+        with self._load_lock:
+            self._loaded.pop(model, None)
+        with self._lock:
+            self._kv.pop(model, None)
+
+    @staticmethod
+    def _tokens(messages: List[Dict[str, str]]) -> List[str]:
+        tokens = []
+        for m in messages:
+            tokens.append(f"<{m.get('role', 'user')}>")
+            tokens.extend(m.get("content", "").split())
+        return tokens
+
+    def _cached_prefix(self, model: str, tokens: List[str]) -> int:
+        best = 0
+        with self._lock:
+            for cached in self._kv.get(model, []):
+                n = 0
+                for a, b in zip(cached, tokens):
+                    if a != b:
+                        break
+                    n += 1
+                best = max(best, n)
+        return min(best, len(tokens) - 1)  # the last prompt token is always evaluated
+
+    def _remember(self, model: str, tokens: List[str]) -> None:
+        with self._lock:
+            slots = self._kv.setdefault(model, [])
+            slots.append(tokens)
+            if len(slots) > self.kv_slots:
+                slots.pop(0)
+
+    def _factor(self) -> float:
+        if not self.jitter:
+            return 1.0
+        with self._lock:
+            return self._rng.lognormvariate(0.0, self.jitter)
+
+    # ---- canned outputs
+
+    @staticmethod
+    def _digest(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _score_from(digest: str) -> float:
+        return round(int(digest[:8], 16) / 0xFFFFFFFF * 20 - 10, 1)
+
+    def _content(self, body: Dict[str, Any]) -> str:
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        options = body.get("options") or {}
+        fmt = body.get("format")
+
+        if isinstance(fmt, dict):
+            props = fmt.get("properties", {})
+            if "scores" in props:
+                n = props["scores"].get("minItems", 1)
+                base = self._digest(model, messages)
+                return json.dumps({"scores": [
+                    self._score_from(self._digest(base, i)) for i in range(n)
+                ]})
+            if "score" in props:
+                score = self._score_from(self._digest(model, messages))
+                if self.score_noise and options.get("temperature", 0.8) > 0:
+                    if options.get("seed") is None:
+                        with self._lock:
+                            u = self._rng.random()
+                    else:
+                        u = int(self._digest(model, messages, options["seed"])[:8], 16) / 0xFFFFFFFF
+                    score = min(10.0, max(-10.0, round(score + self.score_noise * (2 * u - 1), 1)))
+                return json.dumps({"score": score})
+        if self.reply is not None:
+            return self.reply(model, messages) if callable(self.reply) else self.reply
+
+        key = self._digest(model, messages, options.get("seed"))
+        deterministic = options.get("temperature", 0.8) == 0 or options.get("seed") is not None
+        with self._lock:
+            rep = 0 if deterministic else self._seen[key]
+            self._seen[key] += 1
+        tag = self._digest(key, rep)[:12]
+        n_tokens = min(self.output_tokens, options.get("num_predict") or self.output_tokens)
+        return " ".join([f"sim-{tag}"] + ["lorem"] * max(n_tokens - 1, 0))
+
+    def _vector(self, text: str) -> List[float]:
+        vec = [0.0] * self.embed_dim
+        for word in text.lower().split():
+            h = int(self._digest(word)[:8], 16)
+            vec[h % self.embed_dim] += 1.0 if h & 0x100 else -1.0
+        norm = sum(v * v for v in vec) ** 0.5 or 1.0
+        return [v / norm for v in vec]
+
+    def _inject_fault(self) -> None:
+        with self._lock:
+            u = self._fault_rng.random()
+            if u < self.error_rate:
+                self.errors += 1
+                raise SimulatedFailure("simulated server error")
+            stall = u < self.error_rate + self.stall_rate
+            if stall:
+                self.stalls += 1
+        if stall:
+            self._stopped.wait(self.stall_s)
+
+    # ---- request handling
+
+    def _embed(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        model = body.get("model", "")
+        texts = body.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        with self._lock:
+            self.requests += 1
+            self.per_model[model] += 1
+            self.calls.append(body)
+        if body.get("keep_alive") in (0, "0", "0s") and not texts:
+            self._unload(model)
+            return {"model": model, "embeddings": []}
+        self._inject_fault()
+
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            load_s = self._load(model)
+            n_tokens = sum(len(t.split()) for t in texts)
+            prefill_s = n_tokens / self.prefill_tokens_per_s if self.prefill_tokens_per_s else 0.0
+            elapsed = (self.latency_s + prefill_s) * self._factor() if texts else 0.0
+            time.sleep(elapsed)
+            with self._lock:
+                self.prefill_tokens += n_tokens
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        return {
+            "model": model,
+            "embeddings": [self._vector(t) for t in texts],
+            "total_duration": int((load_s + elapsed) * 1e9),
+            "load_duration": int(load_s * 1e9),
+            "prompt_eval_count": n_tokens,
+        }
+
+    def _chat(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        with self._lock:
+            self.requests += 1
+            self.per_model[model] += 1
+            self.calls.append(body)
+
+        if not messages:
+            # Load / unload request (keep_alive=0 evicts)
+            if body.get("keep_alive") in (0, "0", "0s"):
+                self._unload(model)
+                return self._response(model, "", 0, 0, 0.0, 0.0, 0.0, done_reason="unload")
+            load_s = self._load(model)
+            return self._response(model, "", 0, 0, load_s, 0.0, 0.0, done_reason="load")
+        self._inject_fault()
+
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            load_s = self._load(model)
+            content = self._content(body)
+            tokens = self._tokens(messages)
+            reused = self._cached_prefix(model, tokens) if self.prefix_cache else 0
+            prompt_tokens = len(tokens) - reused
+            with self._lock:
+                self.prefill_tokens += prompt_tokens
+                self.prefill_tokens_saved += reused
+            out_tokens = len(content.split())
+            factor = self._factor()
+            prefill_s = prompt_tokens / self.prefill_tokens_per_s if self.prefill_tokens_per_s else 0.0
+            decode_s = out_tokens / self.tokens_per_s if self.tokens_per_s else 0.0
+            time.sleep((self.latency_s + prefill_s) * factor)
+            if self.prefix_cache:
+                self._remember(model, tokens)
+            time.sleep(decode_s * factor)
+            if body.get("keep_alive") in (0, "0", "0s"):
+                self._unload(model)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            if self._slots is not None:
+                self._slots.release()
+        return self._response(model, content, prompt_tokens, out_tokens,
+                              load_s, prefill_s * factor, decode_s * factor)
+
+    @staticmethod
+    def _response(model: str, content: str, prompt_tokens: int, out_tokens: int,
+                  load_s: float, prefill_s: float, decode_s: float,
+                  done_reason: str = "stop") -> Dict[str, Any]:
+        ns = lambda s: int(s * 1e9)  # noqa: E731
+        return {
+            "model": model,
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": done_reason,
+            "total_duration": ns(load_s + prefill_s + decode_s),
+            "load_duration": ns(load_s),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": ns(prefill_s),
+            "eval_count": out_tokens,
+            "eval_duration": ns(decode_s),
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like ollama serve
+            disable_nagle_algorithm = True  # headers and body are separate writes
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _send(self, code: int, payload: Dict[str, Any]) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                if self.path == "/api/version":
+                    self._send(200, {"version": "0.0.0-sim"})
+                elif self.path == "/api/tags":
+                    self._send(200, {"models": []})
+                elif self.path == "/api/ps":
+                    self._send(200, {"models": [
+                        {"name": m, "model": m, "size": server._size_bytes(m), "size_vram": 0}
+                        for m in list(server._loaded)
+                    ]})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                try:
+                    if self.path == "/api/chat":
+                        self._send(200, server._chat(body))
+                    elif self.path == "/api/embed":
+                        self._send(200, server._embed(body))
+                    else:
+                        self._send(404, {"error": "not found"})
+                except SimulatedFailure as e:
+                    self._send(500, {"error": str(e)})
+                except OSError:
+                    pass  # client gave up (timeout / hedge loser) and closed the connection
+
+        return Handler
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulated Ollama server")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-s", type=float, default=200.0)
+    parser.add_argument("--load-time", type=float, default=0.0)
+    parser.add_argument("--parallel", type=int, default=4)
+    args = parser.parse_args()
+
+    srv = SimOllamaServer(latency_s=args.latency, port=args.port, tokens_per_s=args.tokens_per_s,
+                          load_time_s=args.load_time, max_loaded_models=1 if args.load_time else 0,
+                          parallel=args.parallel)
+    print(f"Simulated Ollama at {srv.url} (Ctrl+C to stop)")
+    srv.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,593 @@
 # src/tpo_core.py - FIXED (KeyError fix)
-from typing import List, Tuple, Dict, Any
+import asyncio
+import json
+import time
+from typing import Callable, List, Tuple, Dict, Any, Optional, Union
 from pathlib import Path
 
-from models import get_models
+from models import TPO_Models, get_models, track_usage
+from budget import TPOBudget
+from candidate_pool import CandidatePool
 from config_loader import load_all_configs
+from diversity import DiversityFilter
+from gradient_cache import GradientCache
+from scoring import (CascadeScorer, ConsensusScorer, PointwiseScorer, ListwiseScorer, agreement,
+                     primed_gather)
+from tracing import Tracer, span, summary_table
 
 
 class TPO_Engine:
-    def __init__(self, project_root: str = r"D:\Research\RL_TPO"):
-        self.configs = load_all_configs(project_root)
+    # Prefix-stable layout: static system block -> query -> variable tail. Sampling
+    # and updates share the policy system block and start with the query, and all
+    # RM / critic prompts of a query start the same way, so the server reuses the
+    # prefix from its KV cache instead of prefilling it on every call.
+    POLICY_SYSTEM = (
+        "You are a helpful, honest assistant. Answer clearly and safely. "
+        "If revision instructions follow the question, apply them to your answer."
+    )
+    SAMPLE_SYSTEM = POLICY_SYSTEM
+    UPDATE_SYSTEM = POLICY_SYSTEM
+    LOSS_SYSTEM = (
+        "You compare two answers to the same query. Explain why the chosen answer "
+        "is better than the rejected one and suggest improvements for the chosen answer."
+    )
+    GRADIENT_SYSTEM = "Turn the critique into 3-6 concise bullet-point instructions to improve the answer."
+
+    def __init__(self, project_root: str = r"D:\Research\RL_TPO",
+                 configs: Optional[Dict[str, Dict[str, Any]]] = None,
+                 models: Optional[TPO_Models] = None):
+        self.configs = configs or load_all_configs(project_root)
         self.tpo_cfg = self.configs["tpo_config.yaml"]
-        self.models = get_models()
+        self.models = models or get_models()
         
         # FIXED: safer config access with defaults
         self.n_samples = self.tpo_cfg.get("n_samples", 5)
         self.n_steps = self.tpo_cfg.get("n_steps", 2)
         self.max_cache_size = self.tpo_cfg.get("max_cache_size", 50)
+        self.score_mode = self.tpo_cfg.get("score_mode", "pointwise")
+        self.prefix_priming = self.tpo_cfg.get("prefix_priming", True)
+        self.sample_seed = self.tpo_cfg.get("sample_seed")
+        self.scorer = self._build_scorer(self.score_mode)
+        self.score_role = self.scorer.rm.name  # role that scores (BatchTPO's score stage)
+        self.diversity = DiversityFilter.from_config(self.models, self.tpo_cfg.get("diversity"))
+        self.gradient_cache = GradientCache.from_config(self.models, self.tpo_cfg.get("gradient_cache"))
+        self.budget_cfg = self.tpo_cfg.get("budget", {}) or {}
+        self.tracer = Tracer.from_config(self.tpo_cfg.get("tracing"), project_root)
+
+    def _build_scorer(self, mode: str):
+        rm = self.models.rm_primary
+        if mode == "pointwise":
+            return PointwiseScorer(rm, prime=self.prefix_priming)
+        if mode == "listwise":
+            return ListwiseScorer(rm, max_chars=self.tpo_cfg.get("listwise_max_chars", 6000))
+        if mode == "consensus":
+            return ConsensusScorer.from_config(self.models, self.tpo_cfg.get("consensus"), self.prefix_priming)
+        if mode == "cascade":
+            return CascadeScorer.from_config(self.models, self.tpo_cfg.get("cascade"), self.prefix_priming)
+        raise ValueError(f"Unknown score_mode: {mode}")
+
+    def _add_scored(self, pool: CandidatePool, responses: List[str],
+                    scores: List[Optional[float]], step: int, **meta) -> int:
+        """Add scored responses to the pool, dropping the ones the RM failed to score."""
+        added = 0
+        for resp, score in zip(responses, scores):
+            if score is not None:
+                pool.add(resp, score, step, **meta)
+                added += 1
+        if added < len(responses):
+            print(f"[WARN] {len(responses) - added} unparsable RM scores dropped")
+        return added
+
+    @staticmethod
+    def _log_candidates(traj: Optional[Dict[str, Any]], responses: List[str],
+                        scores: List[Optional[float]], step: int) -> None:
+        if traj is not None:
+            traj["candidates"].extend(
+                {"text": resp, "score": score, "step": step} for resp, score in zip(responses, scores)
+            )
+
+    @staticmethod
+    def _log_step(traj: Optional[Dict[str, Any]], step: int, chosen: str, chosen_score: float,
+                  rejected: str, rejected_score: float, loss: str, gradient: str) -> None:
+        if traj is not None:
+            traj["steps"].append({
+                "step": step,
+                "chosen": chosen,
+                "chosen_score": chosen_score,
+                "rejected": rejected,
+                "rejected_score": rejected_score,
+                "loss": loss,
+                "gradient": gradient,
+            })
+
+    @staticmethod
+    def _log_history(history: Optional[List[Dict[str, Any]]], pool: CandidatePool, responses: List[str],
+                     scores: List[Optional[float]], step: int, budget: TPOBudget) -> None:
+        if history is not None:
+            history.append({
+                "step": step,
+                "candidates": [{"text": r, "score": s} for r, s in zip(responses, scores)],
+                "best_response": pool.best.text,
+                "best_score": pool.best.score,
+                "elapsed_s": budget.elapsed(),
+            })
+
+    def _loss_prompt(self, query: str, chosen: str, rejected: str) -> str:
+        return f"Query: {query}\n\nChosen (better): {chosen}\n\nRejected (worse): {rejected}"
+
+    def _gradient_prompt(self, loss_text: str, prior: Optional[str] = None) -> str:
+        if prior:
+            return f"Critique: {loss_text}\n\nInstructions that improved a similar query:\n{prior}"
+        return f"Critique: {loss_text}"
+
+    def _update_prompt(self, query: str, gradient: str) -> str:
+        return f"{query}\n\nRevision instructions:\n{gradient}\n\nImproved answer:"
+
+    def _seed(self, i: int) -> Optional[int]:
+        """Per-sample seed (`sample_seed` + i): reproducible, cacheable candidates."""
+        return None if self.sample_seed is None else self.sample_seed + i
 
     def sample_candidates(self, query: str) -> List[str]:
-        system = "You are a helpful, honest assistant. Answer clearly and safely."
         responses = []
-        for _ in range(self.n_samples):
-            responses.append(self.models.policy.generate(query, system))
+        with span("sample", n=self.n_samples):
+            for i in range(self.n_samples):
+                responses.append(self.models.policy.generate(query, self.POLICY_SYSTEM, self._seed(i)))
         return responses
 
-    def score_responses(self, query: str, responses: List[str]) -> List[float]:
-        scores = []
-        for resp in responses:
-            prompt = (
-                "Score this answer from -10 to 10 (helpfulness, safety, correctness):\n\n"
-                f"Query: {query}\n\nResponse: {resp}\n\n"
-                "Reply ONLY with a number."
-            )
-            out = self.models.rm_primary.generate(prompt)
-            try:
-                score = float(out.split()[0])
-            except:
-                score = 0.0
-            scores.append(score)
-        return scores
+    def score_responses(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        """RM score per response (see `score_mode`); None where the RM output could not be parsed."""
+        with span("score", n=len(responses), mode=self.score_mode):
+            return self.scorer.score(query, responses)
+
+    def prune_candidates(self, pool: CandidatePool, responses: List[str]) -> List[str]:
+        """Exact repeats, then (with `diversity` enabled) near-duplicates, never reach the RM."""
+        responses = pool.dedup(responses)
+        if self.diversity is None or not responses:
+            return responses
+        with span("prune", n=len(responses)):
+            return self.diversity.prune(responses, pool.embeddings)
 
     def compute_textual_loss(self, query: str, chosen: str, rejected: str) -> str:
-        prompt = (
-            f"Query: {query}\n\nChosen (better): {chosen}\n\nRejected (worse): {rejected}\n\n"
-            "Explain why chosen > rejected. Suggest improvements for chosen."
-        )
-        return self.models.loss_critic.generate(prompt)
+        with span("loss"):
+            return self.models.loss_critic.generate(self._loss_prompt(query, chosen, rejected), self.LOSS_SYSTEM)
+
+    def compute_textual_gradient(self, loss_text: str, prior: Optional[str] = None) -> str:
+        with span("gradient"):
+            return self.models.gradient_gen.generate(self._gradient_prompt(loss_text, prior), self.GRADIENT_SYSTEM)
 
-    def compute_textual_gradient(self, loss_text: str) -> str:
-        prompt = f"Critique: {loss_text}\n\n3-6 bullet instructions to improve."
-        return self.models.gradient_gen.generate(prompt)
+    def lookup_gradient(self, query: str) -> Optional[Dict[str, Any]]:
+        """Cached gradient match for the query (see gradient_cache.py); None with the cache off."""
+        if self.gradient_cache is None:
+            return None
+        with span("gradient_cache"):
+            return self.gradient_cache.lookup(query)
+
+    @staticmethod
+    def _cached_gradient(cached: Optional[Dict[str, Any]], step: int, reuse: bool) -> Optional[str]:
+        """The cached gradient to reuse (reuse=True) or warm-start from; first iteration only."""
+        if step or cached is None or cached["reuse"] != reuse:
+            return None
+        return cached["gradient"]
+
+    def _remember_gradient(self, cached: Optional[Dict[str, Any]], gradient: str,
+                           chosen_score: float, new_scores: List[Optional[float]]) -> None:
+        scored = [s for s in new_scores if s is not None]
+        if cached is not None and scored:
+            self.gradient_cache.add(cached, gradient, max(scored) - chosen_score)
+
+    @staticmethod
+    def _cache_outcome(cached: Dict[str, Any]) -> str:
+        if cached["gradient"] is None:
+            return "miss"
+        return "reuse" if cached["reuse"] else "warm_start"
 
     def update_responses(self, query: str, gradient: str) -> List[str]:
-        system = "Improve your answer using these instructions."
-        prompt = f"Query: {query}\n\nInstructions: {gradient}\n\nImproved answer:"
+        prompt = self._update_prompt(query, gradient)
         responses = []
-        for _ in range(self.n_samples):
-            responses.append(self.models.policy.generate(prompt, system))
+        with span("update", n=self.n_samples):
+            for i in range(self.n_samples):
+                responses.append(self.models.policy.generate(prompt, self.POLICY_SYSTEM, self._seed(i)))
         return responses
 
-    def run_tpo(self, query: str) -> Tuple[str, float]:
-        print(f"Running TPO: N={self.n_samples}, D={self.n_steps}")
-        cache: List[Tuple[str, float]] = []
-        
-        # Initial sampling
-        print("Step 0: Initial sampling...")
-        responses = self.sample_candidates(query)
-        scores = self.score_responses(query, responses)
-        cache.extend(list(zip(responses, scores)))
-        print(f"Initial avg score: {sum(s for _,s in cache)/len(cache):.2f}")
-
-        # TPO iterations
-        for step in range(self.n_steps):
+    # ---- Async twins: the N samples / N scores of a step are in flight together,
+    # bounded by each role's `concurrency` limit in tpo_config.yaml. With
+    # `prefix_priming` the first of them goes alone (see scoring.primed_gather).
+
+    async def asample_candidates(self, query: str) -> List[str]:
+        policy = self.models.policy
+        with span("sample", n=self.n_samples):
+            return await primed_gather([
+                lambda i=i: policy.agenerate(query, self.POLICY_SYSTEM, self._seed(i))
+                for i in range(self.n_samples)
+            ], self.prefix_priming)
+
+    async def ascore_responses(self, query: str, responses: List[str]) -> List[Optional[float]]:
+        with span("score", n=len(responses), mode=self.score_mode):
+            return await self.scorer.ascore(query, responses)
+
+    async def aprune_candidates(self, pool: CandidatePool, responses: List[str]) -> List[str]:
+        responses = pool.dedup(responses)
+        if self.diversity is None or not responses:
+            return responses
+        with span("prune", n=len(responses)):
+            return await self.diversity.aprune(responses, pool.embeddings)
+
+    async def acompute_textual_loss(self, query: str, chosen: str, rejected: str) -> str:
+        with span("loss"):
+            return await self.models.loss_critic.agenerate(
+                self._loss_prompt(query, chosen, rejected), self.LOSS_SYSTEM
+            )
+
+    async def acompute_textual_gradient(self, loss_text: str, prior: Optional[str] = None) -> str:
+        with span("gradient"):
+            return await self.models.gradient_gen.agenerate(
+                self._gradient_prompt(loss_text, prior), self.GRADIENT_SYSTEM
+            )
+
+    async def alookup_gradient(self, query: str) -> Optional[Dict[str, Any]]:
+        if self.gradient_cache is None:
+            return None
+        with span("gradient_cache"):
+            return await self.gradient_cache.alookup(query)
+
+    async def aupdate_responses(self, query: str, gradient: str) -> List[str]:
+        policy = self.models.policy
+        prompt = self._update_prompt(query, gradient)
+        with span("update", n=self.n_samples):
+            return await primed_gather([
+                lambda i=i: policy.agenerate(prompt, self.POLICY_SYSTEM, self._seed(i))
+                for i in range(self.n_samples)
+            ], self.prefix_priming)
+
+    def calibrate_listwise(self, queries: List[str]) -> Dict[str, Any]:
+        """
+        Score the same sampled candidates pointwise and listwise and report how
+        well they agree (see scoring.agreement), plus RM calls used by each.
+        """
+        pointwise = PointwiseScorer(self.models.rm_primary)
+        listwise = self._build_scorer("listwise")
+        rm = self.models.rm_primary
+        ref, cand = [], []
+        calls = {"pointwise": 0, "listwise": 0}
+        for q in queries:
+            responses = self.sample_candidates(q)
+            before = rm.n_calls
+            ref.append(pointwise.score(q, responses))
+            calls["pointwise"] += rm.n_calls - before
+            before = rm.n_calls
+            cand.append(listwise.score(q, responses))
+            calls["listwise"] += rm.n_calls - before
+        report = agreement(ref, cand)
+        report["rm_calls"] = calls
+        return report
+
+    def calibrate_cascade(self, queries: List[str]) -> Dict[str, Any]:
+        """
+        Run the cascade in audit mode on freshly sampled candidates: how often
+        it changes the chosen / rejected pick versus full RM scoring, and the
+        full-RM calls it saves.
+        """
+        cascade = CascadeScorer.from_config(self.models, dict(self.tpo_cfg.get("cascade") or {}, audit=True))
+        for q in queries:
+            cascade.score(q, self.sample_candidates(q))
+        return cascade.stats()
+
+    def _new_budget(self, usage, deadline_s=None, token_budget=None) -> TPOBudget:
+        return TPOBudget.from_config(
+            self.budget_cfg, usage, deadline_s=deadline_s, token_budget=token_budget
+        )
+
+    def _result(self, pool: CandidatePool, stop_reason: str, steps_run: int,
+                budget: TPOBudget, usage, run_span=None) -> Dict[str, Any]:
+        return {
+            "response": pool.best.text,
+            "score": pool.best.score,
+            "stop_reason": stop_reason,
+            "steps_run": steps_run,
+            "elapsed_s": budget.elapsed(),
+            "llm_calls": usage.calls,
+            "tokens": usage.total_tokens,
+            "prefill_tokens": usage.prompt_tokens,
+            "prefill_saved": usage.prefill_saved,
+            "duplicates_skipped": pool.duplicates,
+            "trace_id": run_span.trace_id if run_span is not None else None,
+        }
+
+    def _report_progress(self, progress, pool: CandidatePool, step: int, budget: TPOBudget) -> None:
+        if progress is not None:
+            progress({
+                "step": step,
+                "best_score": pool.best.score,
+                "worst_score": pool.worst.score,
+                "best_response": pool.best.text,
+                "candidates": len(pool),
+                "elapsed_s": budget.elapsed(),
+            })
+
+    def _print_trace(self, run_span) -> None:
+        if self.tracer.summary:
+            print("\n📈 Cost by stage / role:")
+            print(summary_table(run_span))
+
+    # ---- Per-step bookkeeping shared by run_tpo_budgeted and its async twin,
+    # which differ only in how they await the LLM stages.
+
+    def _take_initial(self, pool: CandidatePool, traj, hist, responses: List[str],
+                      scores: List[Optional[float]], gen_s: float, budget: TPOBudget, progress) -> None:
+        """Step 0: the initial candidates are the fallback answer, so none scoring is fatal."""
+        self._add_scored(pool, responses, scores, 0, gen_latency_s=gen_s)
+        self._log_candidates(traj, responses, scores, 0)
+        if not pool:
+            raise RuntimeError("Reward model returned no parsable scores")
+        self._log_history(hist, pool, responses, scores, 0, budget)
+        print(f"Initial avg score: {pool.mean_score():.2f}")
+        self._report_progress(progress, pool, 0, budget)
+
+    def _open_step(self, pool: CandidatePool, step: int,
+                   budget: TPOBudget) -> Tuple[Optional[str], Tuple[str, float, str, float]]:
+        """(stop reason or None, (chosen, score, rejected, score)) for iteration `step` (0-based)."""
+        pair = (pool.best.text, pool.best.score, pool.worst.text, pool.worst.score)
+        reason = budget.converged(pair[1], pair[1], pair[3]) or budget.exhausted()
+        if not reason:
             print(f"\n--- Iteration {step+1}/{self.n_steps} ---")
-            cache.sort(key=lambda x: x[1])
-            if len(cache) > self.max_cache_size:
-                cache = cache[-self.max_cache_size:]
-
-            rejected, r_score = cache[0]
-            chosen, c_score = cache[-1]
-            print(f"Chosen score: {c_score:.2f}, Rejected: {r_score:.2f}")
-
-            loss_text = self.compute_textual_loss(query, chosen, rejected)
-            grad_text = self.compute_textual_gradient(loss_text)
-            
-            print("Textual gradient preview:", grad_text[:100] + "...")
-            
-            new_responses = self.update_responses(query, grad_text)
-            new_scores = self.score_responses(query, new_responses)
-            cache.extend(list(zip(new_responses, new_scores)))
+            print(f"Chosen score: {pair[1]:.2f}, Rejected: {pair[3]:.2f}")
+        return reason, pair
+
+    def _take_step(self, pool: CandidatePool, traj, hist, cached: Optional[Dict[str, Any]], step: int,
+                   pair: Tuple[str, float, str, float], loss_text: Optional[str], grad_text: str,
+                   responses: List[str], scores: List[Optional[float]], gen_s: float,
+                   budget: TPOBudget) -> None:
+        """Fold the scored updates of iteration `step` (0-based) into the pool, gradient cache and logs."""
+        chosen, c_score, rejected, r_score = pair
+        self._remember_gradient(cached, grad_text, c_score, scores)
+        self._add_scored(pool, responses, scores, step + 1, gradient_id=step, gen_latency_s=gen_s)
+        self._log_candidates(traj, responses, scores, step + 1)
+        self._log_history(hist, pool, responses, scores, step + 1, budget)
+        self._log_step(traj, step + 1, chosen, c_score, rejected, r_score, loss_text, grad_text)
+
+    def _finish_run(self, pool: CandidatePool, stop_reason: str, steps_run: int, budget: TPOBudget,
+                    usage, run_span, traj, hist, cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        result = self._result(pool, stop_reason, steps_run, budget, usage, run_span)
+        if traj is not None:
+            result["trajectory"] = traj
+        if hist is not None:
+            result["history"] = hist
+        if cached is not None:
+            result["gradient_cache"] = self._cache_outcome(cached)
+        return result
+
+    def run_tpo(self, query: str, history: bool = False) -> Union[Tuple[str, float], Dict[str, Any]]:
+        """(best response, score); with `history`, the run_tpo_budgeted result including "history"."""
+        result = self.run_tpo_budgeted(query, history=history)
+        return result if history else (result["response"], result["score"])
+
+    def run_tpo_budgeted(
+        self,
+        query: str,
+        deadline_s: Optional[float] = None,
+        token_budget: Optional[int] = None,
+        progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        trajectory: bool = False,
+        history: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Anytime TPO: up to n_steps iterations, stopping early on the limits in
+        the `budget` section of tpo_config.yaml (or the arguments here). Budgets
+        are checked between stages, so the best candidate scored so far is
+        always returned, together with `stop_reason` and cost counters.
+        `progress`, if given, receives the best-so-far after every step. With
+        `trajectory`, the result also holds the whole run under "trajectory":
+        every candidate with its score and step, and each step's chosen /
+        rejected pair, textual loss and gradient (see trajectory_store.py).
+        With `history`, "history" lists per step (0 = initial sampling) the
+        new candidates and their scores, the best-so-far response and score,
+        and the elapsed time, so one run yields the baseline (step 0) and
+        the result at every depth D=0..n_steps.
+        """
+        print(f"Running TPO: N={self.n_samples}, D={self.n_steps}")
+        pool = CandidatePool(self.max_cache_size)
+        traj = {"candidates": [], "steps": []} if trajectory else None
+        hist: Optional[List[Dict[str, Any]]] = [] if history else None
+
+        with self.tracer.span("run", query=query[:200], mode="sync") as run_span, \
+                track_usage() as usage:
+            budget = self._new_budget(usage, deadline_s, token_budget)
+
+            # Initial sampling (always completed: it provides the fallback answer)
+            print("Step 0: Initial sampling...")
+            with span("step", "step", step=0):
+                t0 = time.perf_counter()
+                responses = self.prune_candidates(pool, self.sample_candidates(query))
+                gen_s = time.perf_counter() - t0
+                scores = self.score_responses(query, responses)
+            self._take_initial(pool, traj, hist, responses, scores, gen_s, budget, progress)
+
+            # TPO iterations (the first may reuse a cached gradient of a similar query)
+            cached = self.lookup_gradient(query) if self.n_steps else None
+            stop_reason, steps_run = "completed", 0
+            for step in range(self.n_steps):
+                reason, pair = self._open_step(pool, step, budget)
+                if reason:
+                    stop_reason = reason
+                    break
+                chosen, _, rejected, _ = pair
+
+                with span("step", "step", step=step + 1):
+                    loss_text, grad_text = None, self._cached_gradient(cached, step, reuse=True)
+                    if grad_text is None:
+                        loss_text = self.compute_textual_loss(query, chosen, rejected)
+                        reason = budget.exhausted()
+                        if reason:
+                            stop_reason = reason
+                            break
+                        grad_text = self.compute_textual_gradient(
+                            loss_text, self._cached_gradient(cached, step, reuse=False)
+                        )
+                        reason = budget.exhausted()
+                        if reason:
+                            stop_reason = reason
+                            break
+
+                    print("Textual gradient preview:", grad_text[:100] + "...")
+
+                    t0 = time.perf_counter()
+                    new_responses = self.prune_candidates(pool, self.update_responses(query, grad_text))
+                    gen_s = time.perf_counter() - t0
+                    new_scores = self.score_responses(query, new_responses)
+                    self._take_step(pool, traj, hist, cached, step, pair, loss_text, grad_text,
+                                    new_responses, new_scores, gen_s, budget)
+                    steps_run += 1
+                self._report_progress(progress, pool, step + 1, budget)
+            run_span.attrs.update(stop_reason=stop_reason, steps_run=steps_run)
 
         # Best response
-        cache.sort(key=lambda x: x[1])
-        best_resp, best_score = cache[-1]
-        print(f"\n✅ TPO complete. Final avg score: {sum(s for _,s in cache)/len(cache):.2f}")
-        return best_resp, best_score
+        result = self._finish_run(pool, stop_reason, steps_run, budget, usage, run_span, traj, hist, cached)
+        print(f"\n✅ TPO complete ({stop_reason}). Final avg score: {pool.mean_score():.2f}")
+        self._print_trace(run_span)
+        return result
+
+    async def arun_tpo(self, query: str, history: bool = False) -> Union[Tuple[str, float], Dict[str, Any]]:
+        """Async twin of run_tpo(): same loop, concurrent samples and scores."""
+        result = await self.arun_tpo_budgeted(query, history=history)
+        return result if history else (result["response"], result["score"])
+
+    async def _within(self, budget: TPOBudget, coro):
+        """Await a stage, giving up (returns None) when the deadline passes."""
+        remaining = budget.remaining()
+        if remaining is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, timeout=remaining)
+        except asyncio.TimeoutError:
+            return None
+
+    async def arun_tpo_budgeted(
+        self,
+        query: str,
+        deadline_s: Optional[float] = None,
+        token_budget: Optional[int] = None,
+        progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        trajectory: bool = False,
+        history: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Async twin of run_tpo_budgeted(). The deadline is enforced inside
+        stages too: an iteration still running at the deadline is cancelled and
+        the best candidate from completed steps is returned.
+        """
+        print(f"Running async TPO: N={self.n_samples}, D={self.n_steps}")
+        pool = CandidatePool(self.max_cache_size)
+        traj = {"candidates": [], "steps": []} if trajectory else None
+        hist: Optional[List[Dict[str, Any]]] = [] if history else None
+
+        with self.tracer.span("run", query=query[:200], mode="async") as run_span, \
+                track_usage() as usage:
+            budget = self._new_budget(usage, deadline_s, token_budget)
+
+            print("Step 0: Initial sampling...")
+            with span("step", "step", step=0):
+                t0 = time.perf_counter()
+                responses = await self.aprune_candidates(pool, await self.asample_candidates(query))
+                gen_s = time.perf_counter() - t0
+                scores = await self.ascore_responses(query, responses)
+            self._take_initial(pool, traj, hist, responses, scores, gen_s, budget, progress)
+
+            cached = await self.alookup_gradient(query) if self.n_steps else None
+            stop_reason, steps_run = "completed", 0
+            for step in range(self.n_steps):
+                reason, pair = self._open_step(pool, step, budget)
+                if reason:
+                    stop_reason = reason
+                    break
+                chosen, _, rejected, _ = pair
+
+                with span("step", "step", step=step + 1):
+                    loss_text, grad_text = None, self._cached_gradient(cached, step, reuse=True)
+                    if grad_text is None:
+                        loss_text = await self._within(budget, self.acompute_textual_loss(query, chosen, rejected))
+                        if loss_text is None or budget.exhausted():
+                            stop_reason = budget.exhausted() or "deadline"
+                            break
+                        grad_text = await self._within(budget, self.acompute_textual_gradient(
+                            loss_text, self._cached_gradient(cached, step, reuse=False)
+                        ))
+                        if grad_text is None or budget.exhausted():
+                            stop_reason = budget.exhausted() or "deadline"
+                            break
+
+                    print("Textual gradient preview:", grad_text[:100] + "...")
+
+                    t0 = time.perf_counter()
+                    new_responses = await self._within(budget, self.aupdate_responses(query, grad_text))
+                    if new_responses is None:
+                        stop_reason = "deadline"
+                        break
+                    new_responses = await self.aprune_candidates(pool, new_responses)
+                    gen_s = time.perf_counter() - t0
+                    new_scores = await self._within(budget, self.ascore_responses(query, new_responses))
+                    if new_scores is None:
+                        stop_reason = "deadline"
+                        break
+                    self._take_step(pool, traj, hist, cached, step, pair, loss_text, grad_text,
+                                    new_responses, new_scores, gen_s, budget)
+                    steps_run += 1
+                self._report_progress(progress, pool, step + 1, budget)
+            run_span.attrs.update(stop_reason=stop_reason, steps_run=steps_run)
+
+        result = self._finish_run(pool, stop_reason, steps_run, budget, usage, run_span, traj, hist, cached)
+        print(f"\n✅ Async TPO complete ({stop_reason}). Final avg score: {pool.mean_score():.2f}")
+        self._print_trace(run_span)
+        return result
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--query", type=str, required=True)
+    parser.add_argument("--query", type=str)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Run samples/scores concurrently (see `concurrency` in tpo_config.yaml)")
+    parser.add_argument("--deadline", type=float, help="wall-clock budget in seconds")
+    parser.add_argument("--token-budget", type=int, help="total prompt+completion tokens")
+    parser.add_argument("--calibrate-listwise", metavar="PROMPTS_TXT",
+                        help="Compare listwise vs pointwise RM scores on these prompts and exit")
+    parser.add_argument("--calibrate-cascade", metavar="PROMPTS_TXT",
+                        help="Measure how often cascade scoring changes the chosen/rejected pick and exit")
+    parser.add_argument("--trace", metavar="JSONL", help="write spans to this trace file")
     args = parser.parse_args()
 
     engine = TPO_Engine()
-    best_resp, best_score = engine.run_tpo(args.query)
+    if args.trace:
+        engine.tracer = Tracer(args.trace, engine.tracer.hooks, engine.tracer.summary)
+    if args.calibrate_listwise:
+        with open(args.calibrate_listwise, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        print(json.dumps(engine.calibrate_listwise(queries), indent=2))
+        return
+    if args.calibrate_cascade:
+        with open(args.calibrate_cascade, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        print(json.dumps(engine.calibrate_cascade(queries), indent=2))
+        return
+    if not args.query:
+        parser.error("--query is required")
+    if args.use_async:
+        result = asyncio.run(engine.arun_tpo_budgeted(args.query, args.deadline, args.token_budget))
+    else:
+        result = engine.run_tpo_budgeted(args.query, args.deadline, args.token_budget)
+    best_resp, best_score = result["response"], result["score"]
     
     print("\n" + "="*50)
     print("FINAL TPO ANSWER:")
     print(best_resp)
     print(f"\nFINAL SCORE: {best_score:.3f}")
+    print(f"Stopped: {result['stop_reason']} after {result['steps_run']} steps, "
+          f"{result['elapsed_s']:.1f}s, {result['tokens']} tokens")
+    if isinstance(engine.scorer, (ConsensusScorer, CascadeScorer)):
+        print(f"Scoring ({engine.score_mode}): {engine.scorer.stats()}")
+    if engine.diversity is not None:
+        print(f"Diversity pruning: {engine.diversity.stats()}")
+    if engine.gradient_cache is not None:
+        print(f"Gradient cache: {engine.gradient_cache.stats()}")
     print("="*50)
 
 
@@ -0,0 +1,243 @@
+# src/tracing.py - Spans for TPO runs / steps / stages / LLM calls (JSONL export + hooks)
+import importlib
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from utils import JsonlAppender
+
+# Per-span totals over the LLM calls made inside it
+COUNTERS = (
+    "calls", "cache_hits", "prompt_tokens", "completion_tokens",
+    "load_s", "prefill_s", "decode_s", "queue_s", "latency_s", "prefill_saved",
+)
+
+Hook = Callable[[Dict[str, Any]], None]
+
+
+def _zero() -> Dict[str, float]:
+    return dict.fromkeys(COUNTERS, 0)
+
+
+def _accumulate(into: Dict[str, float], counters: Dict[str, float]) -> None:
+    for key, value in counters.items():
+        into[key] = into.get(key, 0) + value
+
+
+class Span:
+    """
+    One timed unit of work: kind "run" (a TPO query), "step", "stage"
+    (sample/score/loss/gradient/update) or "llm" (one server call). Totals of
+    the LLM calls below a span are rolled up into it, split by role; run spans
+    also keep totals per stage name for the summary table.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, kind: str,
+                 parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.attrs = attrs
+        self.span_id = tracer.new_id()
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.duration_s: Optional[float] = None
+        self.totals = _zero()
+        self.by_role: Dict[str, Dict[str, float]] = {}
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def ancestors(self) -> Iterator["Span"]:
+        span = self.parent
+        while span is not None:
+            yield span
+            span = span.parent
+
+    def _add(self, role: str, counters: Dict[str, float]) -> None:
+        _accumulate(self.totals, counters)
+        _accumulate(self.by_role.setdefault(role, _zero()), counters)
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "kind": self.kind,
+            "name": self.name,
+            "start": self.start,
+            "duration_s": self.duration_s,
+            "attrs": self.attrs,
+            "totals": self.totals,
+        }
+        if self.kind != "llm":
+            record["by_role"] = self.by_role
+        if self.stages:
+            record["stages"] = self.stages
+        return record
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("tpo_span", default=None)
+
+
+class Tracer:
+    """
+    Creates root spans and ships finished ones to a JSONL file (`path`) and
+    to hooks: callables receiving each finished span as a dict, e.g. to
+    forward metrics to a collector. Hook errors are reported, never raised.
+    """
+
+    def __init__(self, path: Optional[str] = None, hooks: Optional[List[Hook]] = None,
+                 summary: bool = True, record_calls: bool = True):
+        self.path = path
+        self.hooks: List[Hook] = list(hooks or [])
+        self.summary = summary
+        self.record_calls = record_calls
+        self._ids = itertools.count(1)
+        self._prefix = f"{os.getpid():x}-{int(time.time() * 1000):x}"
+        self._lock = threading.Lock()
+        self._writer: Optional[JsonlAppender] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._writer = JsonlAppender(path)
+
+    @classmethod
+    def from_config(cls, cfg: Optional[Dict[str, Any]], project_root: str = ".") -> "Tracer":
+        """Build from the `tracing` section of tpo_config.yaml."""
+        cfg = cfg or {}
+        path = cfg.get("path")
+        if path and not os.path.isabs(path):
+            path = os.path.join(project_root, path)
+        hooks = [load_hook(spec) for spec in cfg.get("hooks") or []]
+        return cls(path, hooks, cfg.get("summary", True), cfg.get("record_calls", True))
+
+    def new_id(self) -> str:
+        return f"{self._prefix}-{next(self._ids)}"
+
+    def add_hook(self, hook: Hook) -> None:
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "run", **attrs: Any) -> Iterator[Span]:
+        """Open a span (nested under the current one, if any) for this context."""
+        parent = _current_span.get()
+        span = Span(self, name, kind, parent, attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        span.duration_s = time.perf_counter() - span._t0
+        if span.kind == "stage":
+            stage = dict(span.totals, count=1, wall_s=span.duration_s)
+            with self._lock:
+                for run in span.ancestors():
+                    if run.kind == "run":
+                        _accumulate(run.stages.setdefault(span.name, {}), stage)
+        self.emit(span)
+
+    def _record(self, parent: Span, role: str, model: str, counters: Dict[str, float]) -> None:
+        with self._lock:
+            parent._add(role, counters)
+            for span in parent.ancestors():
+                span._add(role, counters)
+        if self.record_calls:
+            llm = Span(self, "llm", "llm", parent, {"role": role, "model": model})
+            llm.totals = counters
+            llm.duration_s = counters["queue_s"] + counters["latency_s"]
+            self.emit(llm)
+
+    def emit(self, span: Span) -> None:
+        if self._writer is None and not self.hooks:
+            return
+        record = span.to_dict()
+        if self._writer is not None:
+            self._writer.write(record)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                print(f"[WARN] tracing hook {getattr(hook, '__name__', hook)!r} failed: {e}")
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+@contextmanager
+def span(name: str, kind: str = "stage", **attrs: Any) -> Iterator[Optional[Span]]:
+    """Child span of the current one; a no-op (yields None) outside any traced run."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with parent.tracer.span(name, kind, **attrs) as child:
+        yield child
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def record_call(role: str, model: str, resp: Any = None, latency_s: float = 0.0,
+                queue_s: float = 0.0, cached: bool = False, prefill_saved: int = 0) -> None:
+    """
+    Attribute one OllamaRole call to the current span: tokens in/out and the
+    server's load / prefill / decode durations (reported in ns), plus the
+    client-side latency, time spent waiting for a concurrency slot and prompt
+    tokens served from the server's KV cache (see OllamaRole._prefill_saved).
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return
+    counters = _zero()
+    counters["queue_s"] = queue_s
+    counters["latency_s"] = latency_s
+    if cached:
+        counters["cache_hits"] = 1
+    else:
+        counters["calls"] = 1
+        counters["prompt_tokens"] = resp.get("prompt_eval_count") or 0
+        counters["completion_tokens"] = resp.get("eval_count") or 0
+        counters["load_s"] = (resp.get("load_duration") or 0) / 1e9
+        counters["prefill_s"] = (resp.get("prompt_eval_duration") or 0) / 1e9
+        counters["decode_s"] = (resp.get("eval_duration") or 0) / 1e9
+        counters["prefill_saved"] = prefill_saved
+    parent.tracer._record(parent, role, model, counters)
+
+
+def load_hook(spec: str) -> Hook:
+    """Resolve a "package.module:function" hook spec."""
+    module, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"Hook spec must look like 'module:function', got {spec!r}")
+    return getattr(importlib.import_module(module), attr)
+
+
+def summary_table(run: Span) -> str:
+    """Cost breakdown of a finished run span, by stage and by role."""
+    cols = ("calls", "prompt_tokens", "prefill_saved", "completion_tokens", "prefill_s", "decode_s", "load_s")
+    header = "{:14s}" + (f"{'calls':>7s}{'tok_in':>9s}{'kv_reuse':>10s}{'tok_out':>9s}"
+                         f"{'prefill_s':>11s}{'decode_s':>10s}{'load_s':>8s}")
+
+    def row(label: str, c: Dict[str, float], extra: str = "") -> str:
+        calls, tin, saved, tout, pre, dec, load = (c.get(k, 0) for k in cols)
+        return f"{label:14s}{calls:7.0f}{tin:9.0f}{saved:10.0f}{tout:9.0f}{pre:11.2f}{dec:10.2f}{load:8.2f}{extra}"
+
+    lines = [header.format("stage") + f"{'wall_s':>9s}"]
+    for name, c in run.stages.items():
+        lines.append(row(name, c, f"{c.get('wall_s', 0):9.2f}"))
+    lines.append(row("total", run.totals, f"{run.duration_s or 0:9.2f}"))
+    lines.append("")
+    lines.append(header.format("role"))
+    for role, c in sorted(run.by_role.items()):
+        lines.append(row(role, c))
+    return "\n".join(lines)
@@ -0,0 +1,370 @@
+# src/trajectory_store.py - Compressed, sharded, indexed store for full TPO trajectories
+"""
+Layout of a store directory:
+
+    manifest.json        format / version / per-shard record and byte counts
+    shard-00000.dat      zlib-compressed JSON records, back to back
+    shard-00000.idx      one fixed-size entry per record: offset, length, query key
+
+Each record is compressed on its own, so any record can be read by seeking
+to its index entry; readers memory-map both files and never parse what they
+do not return. Data is written (and fsynced) before its index entry, so a
+crash leaves at most an unindexed tail that the next writer truncates.
+
+    python src/trajectory_store.py info data/trajectories
+    python src/trajectory_store.py compact data/trajectories
+    python src/trajectory_store.py import data/tpo_trajectories.jsonl data/trajectories
+"""
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import random
+import shutil
+import struct
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+FORMAT = "tpo-trajectories"
+VERSION = 1
+ENTRY = struct.Struct("<QI8s")  # offset, compressed length, query key
+DEFAULT_SHARD_BYTES = 64 * 1024 * 1024
+
+
+def query_key(query: str) -> bytes:
+    return hashlib.blake2b(query.encode("utf-8"), digest_size=8).digest()
+
+
+def _shard_names(root: str) -> List[str]:
+    if not os.path.isdir(root):
+        return []
+    return sorted(f[:-4] for f in os.listdir(root) if f.startswith("shard-") and f.endswith(".idx"))
+
+
+def _recover(dat_path: str, idx_path: str) -> Tuple[int, int]:
+    """Drop torn index entries and unindexed data; returns (records, data bytes)."""
+    idx_size = os.path.getsize(idx_path)
+    n = idx_size // ENTRY.size
+    end = 0
+    with open(idx_path, "rb+") as f:
+        if idx_size != n * ENTRY.size:
+            f.truncate(n * ENTRY.size)
+        if n:
+            f.seek((n - 1) * ENTRY.size)
+            offset, length, _ = ENTRY.unpack(f.read(ENTRY.size))
+            end = offset + length
+    if os.path.exists(dat_path) and os.path.getsize(dat_path) != end:
+        with open(dat_path, "rb+") as f:
+            f.truncate(end)
+    return n, end
+
+
+class TrajectoryWriter:
+    """
+    Appends records to the last shard of `root`, starting a new shard once it
+    exceeds `shard_bytes`. Thread-safe; each record is fsynced, like
+    utils.JsonlAppender, so collection can be resumed after a crash.
+    """
+
+    def __init__(self, root: str, shard_bytes: int = DEFAULT_SHARD_BYTES, level: int = 6):
+        self.root = root
+        self.shard_bytes = shard_bytes
+        self.level = level
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._shards: Dict[str, Dict[str, int]] = {}
+        for name in _shard_names(root):
+            records, size = _recover(self._path(name, "dat"), self._path(name, "idx"))
+            self._shards[name] = {"records": records, "bytes": size}
+        if self._shards:
+            self._open(max(self._shards))
+        else:
+            self._new_shard()
+
+    def _path(self, name: str, ext: str) -> str:
+        return os.path.join(self.root, f"{name}.{ext}")
+
+    def _open(self, name: str) -> None:
+        self._name = name
+        self._dat = open(self._path(name, "dat"), "ab")
+        self._idx = open(self._path(name, "idx"), "ab")
+
+    def _new_shard(self) -> None:
+        name = f"shard-{len(self._shards):05d}"
+        self._shards[name] = {"records": 0, "bytes": 0}
+        self._open(name)
+
+    def _close_files(self) -> None:
+        self._dat.close()
+        self._idx.close()
+
+    def append(self, record: Dict[str, Any]) -> None:
+        data = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"), self.level)
+        self.append_raw(data, query_key(record.get("query", "")))
+
+    def append_raw(self, data: bytes, key: bytes) -> None:
+        """Append a compressed record and its query key, as TrajectoryReader.raw returns them."""
+        with self._lock:
+            shard = self._shards[self._name]
+            if shard["records"] and shard["bytes"] + len(data) > self.shard_bytes:
+                self._close_files()
+                self._write_manifest()
+                self._new_shard()
+                shard = self._shards[self._name]
+            self._dat.write(data)
+            self._dat.flush()
+            os.fsync(self._dat.fileno())
+            self._idx.write(ENTRY.pack(shard["bytes"], len(data), key))
+            self._idx.flush()
+            os.fsync(self._idx.fileno())
+            shard["records"] += 1
+            shard["bytes"] += len(data)
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            "format": FORMAT,
+            "version": VERSION,
+            "compression": "zlib",
+            "records": sum(s["records"] for s in self._shards.values()),
+            "shards": [dict(s, name=name) for name, s in sorted(self._shards.items())],
+        }
+        tmp = os.path.join(self.root, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, os.path.join(self.root, "manifest.json"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_files()
+            self._write_manifest()
+
+    def __enter__(self) -> "TrajectoryWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class _Shard:
+    def __init__(self, dat_path: str, idx_path: str):
+        self.n = os.path.getsize(idx_path) // ENTRY.size
+        self._files = []
+        self.idx = self._map(idx_path) if self.n else b""
+        self.dat = self._map(dat_path) if self.n else b""
+
+    def _map(self, path: str):
+        f = open(path, "rb")
+        self._files.append(f)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def entry(self, j: int) -> Tuple[int, int, bytes]:
+        return ENTRY.unpack_from(self.idx, j * ENTRY.size)
+
+    def raw(self, j: int) -> bytes:
+        offset, length, _ = self.entry(j)
+        return self.dat[offset:offset + length]
+
+    def close(self) -> None:
+        for m in (self.idx, self.dat):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+
+class TrajectoryReader:
+    """
+    Random access and streaming over a store: len(reader), reader[i], iteration
+    in write order or shuffled, and `query in reader` from the index alone.
+    Only index entries a writer finished are visible.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._shards = [
+            _Shard(os.path.join(root, f"{name}.dat"), os.path.join(root, f"{name}.idx"))
+            for name in _shard_names(root)
+        ]
+        self._starts = []
+        total = 0
+        for shard in self._shards:
+            self._starts.append(total)
+            total += shard.n
+        self._len = total
+        self._keys: Optional[set] = None
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _locate(self, i: int) -> Tuple[_Shard, int]:
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        s = bisect.bisect_right(self._starts, i) - 1
+        return self._shards[s], i - self._starts[s]
+
+    def raw(self, i: int) -> Tuple[bytes, bytes]:
+        """(compressed record, query key) without decoding."""
+        shard, j = self._locate(i)
+        return shard.raw(j), shard.entry(j)[2]
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        shard, j = self._locate(i)
+        return json.loads(zlib.decompress(shard.raw(j)))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for shard in self._shards:
+            for j in range(shard.n):
+                yield json.loads(zlib.decompress(shard.raw(j)))
+
+    def shuffled(self, seed: int = 0) -> Iterator[Dict[str, Any]]:
+        order = list(range(self._len))
+        random.Random(seed).shuffle(order)
+        for i in order:
+            yield self[i]
+
+    def keys(self) -> Iterator[bytes]:
+        for shard in self._shards:
+            for j in range(shard.n):
+                yield shard.entry(j)[2]
+
+    def __contains__(self, query: str) -> bool:
+        if self._keys is None:
+            self._keys = set(self.keys())
+        return query_key(query) in self._keys
+
+    def pairs(self, min_margin: float = 0.0) -> Iterator[Dict[str, Any]]:
+        """
+        Preference pairs for distillation: each step's chosen / rejected pair,
+        plus the best vs worst scored candidate of the whole run.
+        """
+        for rec in self:
+            traj = rec.get("trajectory") or {}
+            seen = set()
+            candidates = [
+                (s["chosen"], s["chosen_score"], s["rejected"], s["rejected_score"])
+                for s in traj.get("steps", [])
+            ]
+            scored = [c for c in traj.get("candidates", []) if c.get("score") is not None]
+            if len(scored) > 1:
+                best = max(scored, key=lambda c: c["score"])
+                worst = min(scored, key=lambda c: c["score"])
+                candidates.append((best["text"], best["score"], worst["text"], worst["score"]))
+            for chosen, c_score, rejected, r_score in candidates:
+                margin = c_score - r_score
+                if chosen == rejected or margin < min_margin or (chosen, rejected) in seen:
+                    continue
+                seen.add((chosen, rejected))
+                yield {"prompt": rec["query"], "chosen": chosen, "rejected": rejected,
+                       "chosen_score": c_score, "rejected_score": r_score, "margin": margin}
+
+    def close(self) -> None:
+        for shard in self._shards:
+            shard.close()
+
+    def __enter__(self) -> "TrajectoryReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def store_info(root: str) -> Dict[str, Any]:
+    with TrajectoryReader(root) as reader:
+        keys = list(reader.keys())
+        shards = [{"records": s.n, "bytes": len(s.dat)} for s in reader._shards]
+    return {
+        "records": len(keys),
+        "unique_queries": len(set(keys)),
+        "shards": len(shards),
+        "bytes": sum(s["bytes"] for s in shards),
+    }
+
+
+def compact(root: str, out: Optional[str] = None, shard_bytes: int = DEFAULT_SHARD_BYTES,
+            dedup: bool = True) -> Dict[str, Any]:
+    """
+    Rewrite a store into full shards. With `dedup`, only the latest record per
+    query is kept (resumed or re-run collections append duplicates). Records
+    are copied compressed, never decoded. Without `out` the store is replaced.
+    """
+    target = out or root.rstrip("/\\") + ".compacting"
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    before = store_info(root)
+    with TrajectoryReader(root) as reader:
+        if dedup:
+            latest = {key: i for i, key in enumerate(reader.keys())}
+            keep = sorted(latest.values())
+        else:
+            keep = range(len(reader))
+        with TrajectoryWriter(target, shard_bytes) as writer:
+            for i in keep:
+                writer.append_raw(*reader.raw(i))
+    if out is None:
+        old = root.rstrip("/\\") + ".old"
+        os.replace(root, old)
+        os.replace(target, root)
+        shutil.rmtree(old)
+    after = store_info(out or root)
+    return {"records_in": before["records"], "records_out": after["records"],
+            "shards_in": before["shards"], "shards_out": after["shards"],
+            "bytes_in": before["bytes"], "bytes_out": after["bytes"]}
+
+
+def import_jsonl(path: str, root: str, shard_bytes: int = DEFAULT_SHARD_BYTES) -> int:
+    """Append the records of a flat JSONL file (e.g. older collections) to a store."""
+    n = 0
+    with TrajectoryWriter(root, shard_bytes) as writer, open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                writer.append(json.loads(line))
+                n += 1
+            except ValueError:
+                continue  # torn line from an interrupted run
+    return n
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="TPO trajectory store tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("info", help="record / shard counts")
+    p.add_argument("store")
+    p = sub.add_parser("compact", help="rewrite into full shards, dropping duplicate queries")
+    p.add_argument("store")
+    p.add_argument("--out", help="write here instead of replacing the store")
+    p.add_argument("--shard-mb", type=int, default=64)
+    p.add_argument("--keep-duplicates", action="store_true")
+    p = sub.add_parser("import", help="append a flat JSONL file to a store")
+    p.add_argument("jsonl")
+    p.add_argument("store")
+    p = sub.add_parser("pairs", help="write chosen/rejected pairs as JSONL")
+    p.add_argument("store")
+    p.add_argument("output")
+    p.add_argument("--min-margin", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.cmd == "info":
+        print(json.dumps(store_info(args.store), indent=2))
+    elif args.cmd == "compact":
+        stats = compact(args.store, args.out, args.shard_mb * 1024 * 1024, not args.keep_duplicates)
+        print(f"✅ Compacted {stats['records_in']} -> {stats['records_out']} records, "
+              f"{stats['shards_in']} -> {stats['shards_out']} shards, "
+              f"{stats['bytes_in'] / 1e6:.1f} -> {stats['bytes_out'] / 1e6:.1f} MB")
+    elif args.cmd == "import":
+        print(f"✅ Imported {import_jsonl(args.jsonl, args.store)} records into {args.store}")
+    elif args.cmd == "pairs":
+        n = 0
+        with TrajectoryReader(args.store) as reader, open(args.output, "w", encoding="utf-8") as f:
+            for pair in reader.pairs(args.min_margin):
+                f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+                n += 1
+        print(f"✅ Wrote {n} preference pairs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
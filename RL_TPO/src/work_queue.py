@@ -0,0 +1,568 @@
+# src/work_queue.py - Lease-based shared work queue for collecting trajectories on many machines
+"""
+Coordinator-free: every worker talks to one SQLite file on shared storage.
+
+    <root>/queue.sqlite    prompts (tasks), leases, workers and queue settings
+    <root>/parts/<worker>/ trajectory store each worker appends its records to
+
+A worker leases a batch of pending prompts, heartbeats the lease while it
+runs TPO on them, writes each record to its own part store (fsynced) and
+then marks the task done. A lease that stops heartbeating (crashed or cut
+off machine) expires after `lease_s` and its unfinished prompts go back to
+pending, up to `max_attempts` leases per prompt. The first worker to finish
+a prompt wins; a late duplicate is ignored, and `merge` copies exactly one
+record per finished prompt, in prompt order, into the final dataset.
+
+Every write is one short transaction under SQLite's file lock, so the
+shared filesystem must support POSIX locks (local disk, or NFSv4 / SMB with
+locking on). Lease times are wall-clock, so keep `lease_s` well above the
+clock skew between machines.
+
+    python src/work_queue.py init data/queue --prompts data/prompts.txt
+    python src/work_queue.py worker data/queue     # on each machine, as many as fit
+    python src/work_queue.py status data/queue
+    python src/work_queue.py merge data/queue data/trajectories
+"""
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from trajectory_store import TrajectoryReader, TrajectoryWriter, query_key
+
+DB_NAME = "queue.sqlite"
+PARTS_DIR = "parts"
+DEFAULTS = {"lease_s": 300.0, "batch_size": 4, "max_attempts": 3}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    query TEXT NOT NULL,
+    key BLOB NOT NULL UNIQUE,
+    state TEXT NOT NULL DEFAULT 'pending',  -- pending / leased / done / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_id INTEGER,
+    worker TEXT,
+    finished_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, attempts, id);
+CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (lease_id);
+CREATE TABLE IF NOT EXISTS leases (
+    id INTEGER PRIMARY KEY,
+    worker TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    acquired_at REAL NOT NULL,
+    heartbeat_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'active'  -- active / closed / expired
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    started_at REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Lease:
+    """A batch of (task id, query) held by one worker until `expires_at`."""
+
+    def __init__(self, lease_id: int, worker: str, tasks: List[Tuple[int, str]], expires_at: float):
+        self.id = lease_id
+        self.worker = worker
+        self.tasks = tasks
+        self.expires_at = expires_at
+
+
+class WorkQueue:
+    """
+    The queue in `root` (created by init()). Opens a short-lived connection
+    per operation, so one instance can be shared by a worker's threads.
+    """
+
+    def __init__(self, root: str, busy_timeout_s: float = 60.0):
+        self.root = root
+        self.path = os.path.join(root, DB_NAME)
+        self.busy_timeout_s = busy_timeout_s
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"No work queue in {root} (create it with `work_queue.py init`)")
+        with self._db() as db:
+            settings = dict(db.execute("SELECT key, value FROM meta").fetchall())
+        self.lease_s = float(settings.get("lease_s", DEFAULTS["lease_s"]))
+        self.batch_size = int(settings.get("batch_size", DEFAULTS["batch_size"]))
+        self.max_attempts = int(settings.get("max_attempts", DEFAULTS["max_attempts"]))
+
+    @classmethod
+    def init(cls, root: str, prompts: List[str], **settings: Any) -> "WorkQueue":
+        """
+        Create the queue (or open an existing one) and add the prompts not in
+        it yet; given settings (lease_s, batch_size, max_attempts) are stored
+        for every worker.
+        """
+        os.makedirs(os.path.join(root, PARTS_DIR), exist_ok=True)
+        conn = sqlite3.connect(os.path.join(root, DB_NAME), timeout=60.0)
+        try:
+            conn.executescript(SCHEMA)
+            for key, default in DEFAULTS.items():
+                value = settings.get(key)
+                if value is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+                else:
+                    conn.execute("INSERT OR IGNORE INTO meta VALUES (?, ?)", (key, str(default)))
+            conn.commit()
+        finally:
+            conn.close()
+        queue = cls(root)
+        queue.enqueue(prompts)
+        return queue
+
+    @contextmanager
+    def _db(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        """One transaction; write=True takes the write lock up front (BEGIN IMMEDIATE)."""
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_s, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def enqueue(self, prompts: List[str]) -> int:
+        """Add prompts; ones already queued (same query key) are skipped. Returns the number added."""
+        with self._db(write=True) as db:
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO tasks (query, key) VALUES (?, ?)",
+                           [(q, query_key(q)) for q in prompts])
+            return db.total_changes - before
+
+    def part_path(self, worker: str) -> str:
+        return os.path.join(self.root, PARTS_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", worker))
+
+    def register(self, worker: str) -> None:
+        now = time.time()
+        with self._db(write=True) as db:
+            db.execute(
+                "INSERT INTO workers (worker, host, pid, started_at, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (worker) DO UPDATE SET host = excluded.host, pid = excluded.pid, "
+                "last_seen = excluded.last_seen",
+                (worker, socket.gethostname(), os.getpid(), now, now),
+            )
+
+    def _reclaim(self, db: sqlite3.Connection, now: float) -> int:
+        """Expire leases past their deadline; their unfinished tasks go back to pending (or failed)."""
+        expired = [r[0] for r in db.execute(
+            "SELECT id FROM leases WHERE state = 'active' AND expires_at < ?", (now,))]
+        if not expired:
+            return 0
+        marks = ",".join("?" * len(expired))
+        db.execute(f"UPDATE leases SET state = 'expired' WHERE id IN ({marks})", expired)
+        cur = db.execute(
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            f"lease_id = NULL, error = 'lease expired' WHERE state = 'leased' AND lease_id IN ({marks})",
+            [self.max_attempts] + expired,
+        )
+        return cur.rowcount
+
+    def lease(self, worker: str, n: Optional[int] = None) -> Optional[Lease]:
+        """Up to `n` (default batch_size) pending prompts, least attempted first; None if none are pending."""
+        now = time.time()
+        with self._db(write=True) as db:
+            self._reclaim(db, now)
+            rows = db.execute(
+                "SELECT id, query FROM tasks WHERE state = 'pending' ORDER BY attempts, id LIMIT ?",
+                (n or self.batch_size,),
+            ).fetchall()
+            db.execute("UPDATE workers SET last_seen = ? WHERE worker = ?", (now, worker))
+            if not rows:
+                return None
+            lease_id = db.execute(
+                "INSERT INTO leases (worker, size, acquired_at, heartbeat_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (worker, len(rows), now, now, now + self.lease_s),
+            ).lastrowid
+            db.executemany(
+                "UPDATE tasks SET state = 'leased', lease_id = ?, worker = ?, attempts = attempts + 1 WHERE id = ?",
+                [(lease_id, worker, task_id) for task_id, _ in rows],
+            )
+        return Lease(lease_id, worker, rows, now + self.lease_s)
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Extend the lease by lease_s; False once it has expired (its tasks may be re-leased)."""
+        now = time.time()
+        with self._db(write=True) as db:
+            cur = db.execute(
+                "UPDATE leases SET heartbeat_at = ?, expires_at = ? WHERE id = ? AND state = 'active'",
+                (now, now + self.lease_s, lease.id),
+            )
+            db.execute("UPDATE workers SET last_seen = ? WHERE worker = ?", (now, lease.worker))
+        if cur.rowcount:
+            lease.expires_at = now + self.lease_s
+        return bool(cur.rowcount)
+
+    def complete(self, lease: Lease, task_id: int) -> bool:
+        """
+        Mark a task done by this lease's worker. Accepted even if the lease
+        has expired, as long as nobody finished the task first; False for a
+        duplicate, whose record merge() then ignores.
+        """
+        now = time.time()
+        with self._db(write=True) as db:
+            cur = db.execute(
+                "UPDATE tasks SET state = 'done', worker = ?, finished_at = ?, lease_id = NULL, error = NULL "
+                "WHERE id = ? AND state != 'done'",
+                (lease.worker, now, task_id),
+            )
+            if cur.rowcount:
+                db.execute("UPDATE workers SET done = done + 1, last_seen = ? WHERE worker = ?",
+                           (now, lease.worker))
+        return bool(cur.rowcount)
+
+    def fail(self, lease: Lease, task_id: int, error: str) -> None:
+        """Give a task back (or mark it failed after max_attempts leases)."""
+        now = time.time()
+        with self._db(write=True) as db:
+            cur = db.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_id = NULL, error = ? WHERE id = ? AND state = 'leased' AND lease_id = ?",
+                (self.max_attempts, error[:500], task_id, lease.id),
+            )
+            if cur.rowcount:  # not when the lease expired and the task moved on
+                db.execute("UPDATE workers SET failed = failed + 1, last_seen = ? WHERE worker = ?",
+                           (now, lease.worker))
+
+    def release(self, lease: Lease) -> int:
+        """
+        Close the lease. Tasks still leased (the worker was stopped before
+        it got to them) go back to pending without using up an attempt;
+        tasks that were run and failed must go through fail() first.
+        """
+        with self._db(write=True) as db:
+            cur = db.execute(
+                "UPDATE tasks SET state = 'pending', lease_id = NULL, attempts = attempts - 1 "
+                "WHERE state = 'leased' AND lease_id = ?",
+                (lease.id,),
+            )
+            db.execute("UPDATE leases SET state = 'closed' WHERE id = ? AND state = 'active'", (lease.id,))
+        return cur.rowcount
+
+    def outstanding(self) -> int:
+        """Tasks pending or leased anywhere (0 = the queue is drained)."""
+        with self._db() as db:
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def done_tasks(self) -> List[Tuple[bytes, str]]:
+        """(query key, worker that finished it) of every done task, in prompt order."""
+        with self._db() as db:
+            return [(bytes(k), w) for k, w in
+                    db.execute("SELECT key, worker FROM tasks WHERE state = 'done' ORDER BY id")]
+
+    def status(self, window_s: float = 600.0) -> Dict[str, Any]:
+        """
+        Task counts, global throughput and ETA, and per worker its totals,
+        rate over the last `window_s`, active leases and heartbeat age.
+        """
+        now = time.time()
+        since = now - window_s
+        with self._db() as db:
+            counts = dict(db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+            recent = dict(db.execute(
+                "SELECT worker, COUNT(*) FROM tasks WHERE state = 'done' AND finished_at >= ? GROUP BY worker",
+                (since,)).fetchall())
+            leases = dict(db.execute(
+                "SELECT worker, COUNT(*) FROM leases WHERE state = 'active' GROUP BY worker").fetchall())
+            overdue = db.execute(
+                "SELECT COUNT(*) FROM leases WHERE state = 'active' AND expires_at < ?", (now,)).fetchone()[0]
+            rows = db.execute(
+                "SELECT worker, host, pid, started_at, last_seen, done, failed FROM workers ORDER BY worker"
+            ).fetchall()
+        workers = []
+        for worker, host, pid, started_at, last_seen, done, failed in rows:
+            span_s = max(min(window_s, now - started_at), 1e-9)
+            workers.append({
+                "worker": worker, "host": host, "pid": pid,
+                "done": done, "failed": failed,
+                "active_leases": leases.get(worker, 0),
+                "prompts_per_min": 60 * recent.get(worker, 0) / span_s,
+                "last_seen_s": now - last_seen,
+            })
+        first_start = min((r[3] for r in rows), default=now)
+        rate = 60 * sum(recent.values()) / max(min(window_s, now - first_start), 1e-9)
+        remaining = counts.get("pending", 0) + counts.get("leased", 0)
+        return {
+            "tasks": sum(counts.values()),
+            "done": counts.get("done", 0),
+            "pending": counts.get("pending", 0),
+            "leased": counts.get("leased", 0),
+            "failed": counts.get("failed", 0),
+            "overdue_leases": overdue,  # expired, reclaimed by the next lease() call
+            "window_s": window_s,
+            "prompts_per_min": rate,
+            "eta_min": remaining / rate if rate else None,
+            "workers": workers,
+        }
+
+
+class Heartbeat:
+    """Keeps a lease alive from a background thread while its batch runs."""
+
+    def __init__(self, queue: WorkQueue, lease: Lease, interval_s: Optional[float] = None):
+        self.queue = queue
+        self.lease = lease
+        self.interval_s = interval_s or queue.lease_s / 3
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            try:
+                if not self.queue.heartbeat(self.lease):
+                    print(f"[WARN] Lease {self.lease.id} expired; finished prompts are still committed")
+                    return
+            except sqlite3.Error as e:
+                print(f"[WARN] Heartbeat failed: {e}")  # retried next interval, before the lease runs out
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _run_lease(engine, lease: Lease, threads: int, batch: Any) -> Iterator[Tuple[int, Optional[Dict], str]]:
+    """(task id, record or None, error) per leased prompt, as they finish."""
+    from collect_tpo_trajectories import batch_record, tpo_record
+
+    if batch is not None:
+        results = batch.run([q for _, q in lease.tasks])
+        for (task_id, _), res in zip(lease.tasks, results):
+            if "error" in res:
+                yield task_id, None, res["error"]
+            else:
+                yield task_id, batch_record(res, True), ""
+        return
+
+    def run_one(task: Tuple[int, str]) -> Tuple[int, Optional[Dict], str]:
+        try:
+            return task[0], tpo_record(engine, task[1], True), ""
+        except Exception as e:
+            return task[0], None, f"{type(e).__name__}: {e}"
+
+    if threads <= 1:
+        for task in lease.tasks:
+            yield run_one(task)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for fut in as_completed([pool.submit(run_one, t) for t in lease.tasks]):
+            yield fut.result()
+
+
+def run_worker(engine, root: str, worker_id: Optional[str] = None, threads: int = 1,
+               batch_size: int = 0, unload_between_stages: bool = False,
+               max_batches: Optional[int] = None, poll_s: float = 10.0) -> Dict[str, Any]:
+    """
+    Lease and run batches until the queue is drained (or `max_batches`).
+    `threads` > 1 runs a batch's prompts concurrently on the engine; with
+    batch_size > 0 leases that many prompts and runs them stage by stage
+    through BatchTPO instead (see collect_tpo_trajectories). While other
+    workers still hold leases this one polls every `poll_s`, in case they
+    expire. Returns this worker's counts.
+    """
+    queue = WorkQueue(root)
+    worker = worker_id or default_worker_id()
+    queue.register(worker)
+    batch = None
+    if batch_size > 0:
+        from batch_engine import BatchTPO
+        batch = BatchTPO(engine, unload_between_stages=unload_between_stages, trajectory=True)
+    writer = TrajectoryWriter(queue.part_path(worker))
+    counts = {"batches": 0, "done": 0, "duplicates": 0, "failed": 0}
+    start = time.time()
+    try:
+        while max_batches is None or counts["batches"] < max_batches:
+            lease = queue.lease(worker, batch_size or None)
+            if lease is None:
+                if not queue.outstanding():
+                    break
+                time.sleep(poll_s)
+                continue
+            counts["batches"] += 1
+            with Heartbeat(queue, lease):
+                finished = set()
+                try:
+                    for task_id, record, error in _run_lease(engine, lease, threads, batch):
+                        finished.add(task_id)
+                        if record is None:
+                            print(f"[WARN] Task {task_id} failed: {error}")
+                            queue.fail(lease, task_id, error)
+                            counts["failed"] += 1
+                            continue
+                        writer.append(record)  # fsynced before the task is marked done
+                        if queue.complete(lease, task_id):
+                            counts["done"] += 1
+                        else:
+                            counts["duplicates"] += 1
+                except Exception as e:
+                    # The whole batch failed (e.g. the engine itself): every prompt not
+                    # finished uses up an attempt, so a poison batch ends up `failed`
+                    error = f"{type(e).__name__}: {e}"
+                    print(f"[WARN] Lease {lease.id} failed: {error}")
+                    for task_id, _ in lease.tasks:
+                        if task_id not in finished:
+                            queue.fail(lease, task_id, error)
+                            counts["failed"] += 1
+                finally:
+                    queue.release(lease)
+            minutes = max(time.time() - start, 1e-9) / 60
+            print(f"[{worker}] {counts['done']} done, {counts['failed']} failed | "
+                  f"{counts['done'] / minutes:.2f} prompts/min")
+    finally:
+        writer.close()
+    return counts
+
+
+def merge(root: str, output: str) -> Dict[str, int]:
+    """
+    Copy one record per done task into `output` (a trajectory store, or a
+    flat JSONL file of query / response / reward), in prompt order. The
+    finishing worker's record is preferred; prompts already in `output` are
+    skipped, so merging again after more work only adds what is new.
+    """
+    from collect_tpo_trajectories import is_store, load_done_queries
+    from utils import JsonlAppender
+
+    queue = WorkQueue(root)
+    done = queue.done_tasks()
+    finisher = dict(done)
+    parts_dir = os.path.join(root, PARTS_DIR)
+    readers = {name: TrajectoryReader(os.path.join(parts_dir, name)) for name in sorted(os.listdir(parts_dir))}
+    store = is_store(output)
+    if store:
+        if os.path.isdir(output):
+            with TrajectoryReader(output) as existing:
+                present = set(existing.keys())
+        else:
+            present = set()
+        writer = TrajectoryWriter(output)
+    else:
+        present = {query_key(q) for q in load_done_queries(output)}
+        writer = JsonlAppender(output)
+    stats = {"merged": 0, "already_present": 0, "duplicates_dropped": 0, "missing": 0}
+    try:
+        chosen: Dict[bytes, Tuple[TrajectoryReader, int]] = {}
+        for name, reader in readers.items():
+            for i, key in enumerate(reader.keys()):
+                if key not in finisher:
+                    continue
+                if key in chosen:
+                    stats["duplicates_dropped"] += 1
+                    if queue.part_path(finisher[key]) != os.path.join(parts_dir, name):
+                        continue
+                chosen[key] = (reader, i)
+        for key, _ in done:
+            if key in present:
+                stats["already_present"] += 1
+            elif key not in chosen:
+                stats["missing"] += 1
+            else:
+                reader, i = chosen[key]
+                if store:
+                    writer.append_raw(*reader.raw(i))
+                else:
+                    record = reader[i]
+                    writer.write({"query": record["query"], "response": record["response"],
+                                  "reward": record["reward"]})
+                present.add(key)
+                stats["merged"] += 1
+    finally:
+        writer.close()
+        for reader in readers.values():
+            reader.close()
+    return stats
+
+
+def print_status(status: Dict[str, Any]) -> None:
+    eta = f"{status['eta_min'] / 60:.1f} h" if status["eta_min"] is not None else "-"
+    print(f"📋 {status['done']}/{status['tasks']} done ({status['failed']} failed, {status['leased']} leased, "
+          f"{status['pending']} pending) | {status['prompts_per_min']:.2f} prompts/min over the last "
+          f"{status['window_s'] / 60:.0f} min | ETA {eta}")
+    print(f"{'worker':<28}{'done':>7}{'failed':>8}{'leases':>8}{'rate/min':>10}{'last_seen':>11}")
+    for w in status["workers"]:
+        print(f"{w['worker']:<28}{w['done']:>7}{w['failed']:>8}{w['active_leases']:>8}"
+              f"{w['prompts_per_min']:>10.2f}{w['last_seen_s']:>10.0f}s")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Shared work queue for collecting TPO trajectories")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("init", help="create the queue / add prompts not queued yet")
+    p.add_argument("queue")
+    p.add_argument("--prompts", default=os.path.join("data", "prompts.txt"))
+    p.add_argument("--limit", type=int, help="only the first N prompts (e.g. n_trajectories in rl_config.yaml)")
+    p.add_argument("--lease-s", type=float, help=f"lease timeout (default {DEFAULTS['lease_s']:.0f})")
+    p.add_argument("--batch-size", type=int, help=f"prompts per lease (default {DEFAULTS['batch_size']})")
+    p.add_argument("--max-attempts", type=int, help=f"leases per prompt (default {DEFAULTS['max_attempts']})")
+    p = sub.add_parser("worker", help="lease and run prompts until the queue is drained")
+    p.add_argument("queue")
+    p.add_argument("--worker-id", help="default <hostname>-<pid>")
+    p.add_argument("--threads", type=int, default=1, help="prompts of a lease processed concurrently")
+    p.add_argument("--batch-size", type=int, default=0,
+                   help="lease this many prompts and run them stage by stage (BatchTPO)")
+    p.add_argument("--unload-between-stages", action="store_true")
+    p.add_argument("--max-batches", type=int)
+    p = sub.add_parser("status", help="progress, global throughput and per-worker rates")
+    p.add_argument("queue")
+    p.add_argument("--window-min", type=float, default=10.0)
+    p.add_argument("--json", action="store_true")
+    p = sub.add_parser("merge", help="write one record per finished prompt to a store or JSONL")
+    p.add_argument("queue")
+    p.add_argument("output")
+    args = parser.parse_args()
+
+    if args.cmd == "init":
+        from collect_tpo_trajectories import load_prompts_from_txt
+        prompts = load_prompts_from_txt(args.prompts)[:args.limit]
+        queue = WorkQueue.init(args.queue, prompts, lease_s=args.lease_s, batch_size=args.batch_size,
+                               max_attempts=args.max_attempts)
+        print(f"✅ {args.queue}: {queue.status()['tasks']} prompts queued "
+              f"(lease {queue.lease_s:.0f}s, batch {queue.batch_size}, max attempts {queue.max_attempts})")
+    elif args.cmd == "worker":
+        from tpo_core import TPO_Engine
+        counts = run_worker(TPO_Engine(), args.queue, args.worker_id, args.threads, args.batch_size,
+                            args.unload_between_stages, args.max_batches)
+        print(f"✅ Worker finished: {counts}")
+    elif args.cmd == "status":
+        status = WorkQueue(args.queue).status(args.window_min * 60)
+        if args.json:
+            print(json.dumps(status, indent=2))
+        else:
+            print_status(status)
+    elif args.cmd == "merge":
+        stats = merge(args.queue, args.output)
+        print(f"✅ Merged {stats['merged']} records into {args.output} ({stats['already_present']} already there, "
+              f"{stats['duplicates_dropped']} duplicates dropped, {stats['missing']} missing)")
+
+
+if __name__ == "__main__":
+    main()
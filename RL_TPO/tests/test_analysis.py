@@ -0,0 +1,67 @@
+# tests/test_analysis.py - Paired bootstrap statistics and per-step curves
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from analysis import PairedScores, StepCurves, bootstrap_means, read_new_records  # noqa: E402
+
+
+def test_paired_bootstrap_matches_normal_theory_and_is_fast(tmp_path):
+    rng = np.random.default_rng(0)
+    base = rng.normal(5.0, 1.0, 1000)
+    tpo = base + rng.normal(0.3, 0.8, 1000)
+    path = tmp_path / "hh.results.jsonl"
+    with open(path, "w") as f:
+        for i, (b, t) in enumerate(zip(base, tpo)):
+            f.write(json.dumps({"id": i, "baseline_score": b, "tpo_score": t}) + "\n")
+        f.write(json.dumps({"id": 1000, "error": "timeout"}) + "\n")
+        f.write('{"id": 1001, "baseline_sc')  # still being written
+
+    paired = PairedScores()
+    records, offset = read_new_records(str(path))
+    assert paired.update(records) == 1000
+    # A resumed run re-reads a record: the id is counted once
+    assert not paired.add({"id": 3, "baseline_score": None, "tpo_score": 1.0})
+    paired.add({"id": 3, "baseline_score": base[3], "tpo_score": tpo[3]})
+
+    start = time.perf_counter()
+    s = paired.summary(n_boot=10000)
+    assert time.perf_counter() - start < 1.0
+    delta = tpo - base
+    se = delta.std(ddof=1) / np.sqrt(len(delta))
+    assert s["n"] == 1000 and abs(s["delta_mean"] - delta.mean()) < 1e-9
+    lo, hi = s["delta_ci"]
+    assert abs(lo - (delta.mean() - 1.96 * se)) < 0.3 * se and abs(hi - (delta.mean() + 1.96 * se)) < 0.3 * se
+    assert s["p_value"] < 0.001 and 0.5 < s["win_rate"] < 1.0
+    json.dumps(s)  # plain numbers only
+
+    # Only lines completed since the last read are returned
+    with open(path, "a") as f:
+        f.write('ore": 4.0, "tpo_score": 6.0}\n')
+    records, _ = read_new_records(str(path), offset)
+    assert records == [{"id": 1001, "baseline_score": 4.0, "tpo_score": 6.0}]
+
+    # Columns resampled together stay paired
+    boot = bootstrap_means(np.column_stack([base, base]), 200, seed=1)
+    assert np.allclose(boot[:, 0], boot[:, 1])
+
+
+def test_step_curves_carry_best_forward_after_early_stop():
+    def run(*steps):
+        return {"trajectory": {"candidates": [
+            {"step": s, "score": x} for s, scores in enumerate(steps) for x in scores
+        ]}}
+
+    curves = StepCurves()
+    curves.update([run([3.0, 5.0], [4.0], [7.0]), run([6.0], [None]), {"error": "x"}])
+    s = curves.summary(n_boot=500)
+    assert s["n"] == 2 and s["steps"] == [0, 1, 2]
+    assert s["best_so_far"] == [5.5, 5.5, 6.5]
+    assert s["gain_over_step0"] == [0.0, 0.0, 1.0]
+    assert s["runs_reaching_step"] == [2, 1, 1]
+    assert s["step_mean"] == [5.0, 4.0, 7.0]
@@ -0,0 +1,59 @@
+# tests/test_autotune.py - Host autotuner against a simulated Ollama server
+import copy
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+pytest.importorskip("ollama")
+
+from autotune import AutoTuner, HostProbe, model_family, write_overlay  # noqa: E402
+from config_loader import load_all_configs  # noqa: E402
+from sim_ollama import SimOllamaServer  # noqa: E402
+
+SIZES = {
+    "llama3.1:8b-instruct-q4_K_M": 4.5,
+    "llama3.1:8b-instruct-q5_K_M": 5.5,
+    "llama3.1:8b-instruct-q4_0": 4.6,
+    "qwen2.5:7b-instruct-q4_K_M": 4.4,
+}
+
+
+def test_autotune_plans_sharing_and_writes_overlay(tmp_path):
+    configs = copy.deepcopy(load_all_configs(ROOT, overlay=False))
+    assert model_family("llama3.1:8b-instruct-q4_K_M") == "llama3.1:8b-instruct"
+
+    with SimOllamaServer(reply=None, latency_s=0.2, tokens_per_s=2000, parallel=2,
+                         load_time_s=0.05, model_size_gb=SIZES) as srv:
+        tuner = AutoTuner(configs, HostProbe(srv.url, num_predict=16), memory_gb=10.0,
+                          threads=[2], contexts=[2048, 4096], concurrency=[1, 2, 4])
+        report = tuner.run(share=True)
+
+    # Four distinct tags (19 GB) cannot stay resident under 10 GB: every stage swaps
+    current = report["current"]
+    assert current["feasible"] and not current["resident"] and current["swap_s_per_prompt"] > 0
+    # The three llama3.1 roles sharing one quantization fit next to qwen and swap nothing
+    best = report["suggestions"][0]
+    assert sorted(best["roles"]) == ["gradient_gen", "policy", "rm_primary"]
+    assert best["resident"] and best["prompts_per_min"] > current["prompts_per_min"]
+    plan = report["plan"]
+    assert plan["resident"] and len(plan["settings"]) == 2
+    # The server runs two requests at a time, so more in flight buys nothing
+    assert plan["concurrency"]["policy"] == 2 and plan["concurrency"]["loss_critic"] == 1
+    # The critique prompt holds two full answers: it needs the larger context
+    assert plan["settings"]["qwen2.5:7b-instruct-q4_K_M"]["num_ctx"] == 4096
+
+    root = tmp_path / "proj"
+    shutil.copytree(os.path.join(ROOT, "config"), root / "config")
+    write_overlay(str(root / "config" / "tuned.yaml"), report["overlay"], report)
+    tuned = load_all_configs(str(root))
+    models = tuned["models.yaml"]["models"]
+    assert models["policy"]["tag"] == models["rm_primary"]["tag"] == best["tag"]
+    assert models["loss_critic"]["num_ctx"] == 4096 and models["policy"]["keep_alive"] == "30m"
+    assert models["policy"]["temperature"] == configs["models.yaml"]["models"]["policy"]["temperature"]
+    assert tuned["tpo_config.yaml"]["concurrency"]["policy"] == 2
+    assert tuned["tpo_config.yaml"]["n_samples"] == configs["tpo_config.yaml"]["n_samples"]
+    assert load_all_configs(str(root), overlay=False) == load_all_configs(ROOT, overlay=False)
@@ -0,0 +1,82 @@
+# tests/test_budget.py - Anytime TPO: budget limits, convergence checks and reported stop reasons
+import asyncio
+import hashlib
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+pytest.importorskip("ollama")
+
+import models  # noqa: E402
+from budget import TPOBudget  # noqa: E402
+from models import TPO_Models, Usage  # noqa: E402
+from tpo_core import TPO_Engine  # noqa: E402
+
+
+def test_budget_stop_reasons():
+    usage = Usage()
+    assert TPOBudget(usage).exhausted() is None and TPOBudget(usage).remaining() is None
+    assert TPOBudget(usage, deadline_s=0.0).exhausted() == "deadline"
+    usage.prompt_tokens, usage.completion_tokens = 60, 40
+    assert TPOBudget(usage, token_budget=100).exhausted() == "token_budget"
+    assert TPOBudget(usage, token_budget=101).exhausted() is None
+
+    assert TPOBudget(usage, target_score=9.0).converged(9.0, 9.0, 1.0) == "target_score"
+    assert TPOBudget(usage, target_score=9.0).converged(8.9, 8.9, 1.0) is None
+    assert TPOBudget(usage, min_gap=0.5).converged(5.0, 5.0, 4.6) == "small_gap"
+    assert TPOBudget(usage, min_gap=0.5).converged(5.0, 5.0, 4.0) is None
+    plateau = TPOBudget(usage, patience=2, min_improvement=0.5)
+    assert [plateau.converged(b, b, 0.0) for b in (5.0, 6.0, 6.2, 6.4)] == [None, None, None, "plateau"]
+    # Config values are the defaults; explicit per-call limits override them
+    budget = TPOBudget.from_config({"deadline_s": 30, "min_improvement": None}, usage, deadline_s=5)
+    assert budget.deadline_s == 5 and budget.min_improvement == 0.0
+
+
+def _offline_engine(monkeypatch) -> TPO_Engine:
+    """TPO_Engine whose roles answer locally: a stable score per prompt, distinct text per call."""
+    m = TPO_Models(ROOT)
+    monkeypatch.setattr(models, "models", m)
+    for role in m.roles().values():
+        def chat(messages, options, fmt=None, role=role):
+            role.n_calls += 1
+            models._record_usage({"prompt_eval_count": 10, "eval_count": 5})
+            prompt = messages[-1]["content"]
+            if fmt is not None:
+                return json.dumps({"score": int(hashlib.sha256(prompt.encode()).hexdigest()[:4], 16) % 19 - 9})
+            return f"{role.tag} reply {role.n_calls} to {prompt[:40]}"
+
+        async def achat(messages, options, fmt=None, chat=chat):
+            return chat(messages, options, fmt)
+
+        role._chat, role._achat = chat, achat
+    return TPO_Engine(ROOT)
+
+
+def test_run_tpo_budgeted_reports_stop_reason(monkeypatch):
+    engine = _offline_engine(monkeypatch)
+    n, d = engine.n_samples, engine.n_steps
+    result = engine.run_tpo_budgeted("How do tides work?", token_budget=1)
+    assert (result["stop_reason"], result["steps_run"], result["llm_calls"]) == ("token_budget", 0, 2 * n)
+    result = engine.run_tpo_budgeted("How do tides work?", deadline_s=1e-6)
+    assert (result["stop_reason"], result["steps_run"]) == ("deadline", 0)
+    result = asyncio.run(engine.arun_tpo_budgeted("How do tides work?", deadline_s=1e-6))
+    assert (result["stop_reason"], result["steps_run"]) == ("deadline", 0)
+    engine.budget_cfg = {"target_score": -100.0}
+    result = engine.run_tpo_budgeted("How do tides work?")
+    assert (result["stop_reason"], result["steps_run"]) == ("target_score", 0)
+    engine.budget_cfg = {"min_gap": 1000.0}
+    assert engine.run_tpo_budgeted("How do tides work?")["stop_reason"] == "small_gap"
+    engine.budget_cfg = {"patience": 1, "min_improvement": 1000.0}
+    result = engine.run_tpo_budgeted("How do tides work?")
+    assert (result["stop_reason"], result["steps_run"]) == ("plateau", 1)
+    assert result["response"] and result["score"] is not None
+    engine.budget_cfg = {}
+    result = engine.run_tpo_budgeted("How do tides work?")
+    assert (result["stop_reason"], result["steps_run"]) == ("completed", d)
+    assert result["tokens"] == 15 * result["llm_calls"]
+    result = asyncio.run(engine.arun_tpo_budgeted("How do tides work?"))
+    assert (result["stop_reason"], result["steps_run"]) == ("completed", d)
@@ -0,0 +1,68 @@
+# tests/test_cache.py - Response cache: hits / misses, LRU eviction, what gets cached
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from cache import ResponseCache  # noqa: E402
+
+
+def test_response_cache_hits_and_lru_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=30)
+    key = ResponseCache.make_key("m", [{"role": "user", "content": "hi"}], {"temperature": 0.0})
+    assert key != ResponseCache.make_key("m", [{"role": "user", "content": "hi"}], {"temperature": 0.1})
+    assert cache.get(key) is None
+    cache.put(key, "a" * 10)
+    assert cache.get(key) == "a" * 10
+
+    cache.put("b", "b" * 10)
+    time.sleep(0.01)
+    cache.get(key)  # key is now more recently used than "b"
+    time.sleep(0.01)
+    cache.put("c", "c" * 15)  # 35 bytes > 30: evict the least recently used
+    assert cache.get("b") is None and cache.get(key) == "a" * 10 and cache.get("c") == "c" * 15
+    cache.put("huge", "x" * 31)  # larger than the cap: never stored
+    assert cache.get("huge") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (4, 3, 1)
+    assert (stats["entries"], stats["bytes"]) == (2, 25)
+    cache.close()
+    # Persistent: a new instance (or process) sees the same entries
+    reopened = ResponseCache(str(tmp_path / "responses.sqlite"), max_bytes=30)
+    assert reopened.get("c") == "c" * 15
+    reopened.close()
+
+
+def test_sampled_calls_are_not_cached(tmp_path):
+    pytest.importorskip("ollama")
+    from client_pool import ClientPool, Endpoint
+    from models import OllamaRole
+    from sim_ollama import SimOllamaServer
+
+    replies = iter(range(100))
+    with SimOllamaServer(reply=lambda model, messages: f"reply {next(replies)}") as srv:
+        pool = ClientPool([Endpoint("sim", srv.url)])
+        cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+
+        def role(**config):
+            return OllamaRole(dict({"tag": "sim"}, **config), cache=cache, pool=pool)
+
+        sampled, seeded = role(temperature=0.7), role(temperature=0.7, seed=7)
+        greedy = role(temperature=0.0)
+        # temperature > 0 without a seed: every call reaches the server, replies differ
+        assert sampled.generate("Tell me a story") != sampled.generate("Tell me a story")
+        assert srv.requests == 2
+        # Pinned seed or temperature 0: the repeat is served from the cache
+        assert seeded.generate("Tell me a story") == seeded.generate("Tell me a story")
+        assert greedy.generate("Tell me a story") == greedy.generate("Tell me a story")
+        assert srv.requests == 4 and cache.stats()["hits"] == 2
+        # Policies override the default
+        always, never = role(temperature=0.7, cache="always"), role(temperature=0.0, cache="never")
+        assert always.generate("Again") == always.generate("Again")
+        never.generate("Again"), never.generate("Again")
+        assert srv.requests == 7
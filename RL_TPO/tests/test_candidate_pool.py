@@ -0,0 +1,32 @@
+# tests/test_candidate_pool.py - Bounded, deduplicating candidate pool of a TPO run
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from candidate_pool import CandidatePool  # noqa: E402
+
+
+def test_candidate_pool_dedup_eviction_and_selection():
+    pool = CandidatePool(capacity=3)
+    assert pool.dedup(["An answer.", "an   ANSWER. ", "Other", "Other"]) == ["An answer.", "Other"]
+    assert pool.dedup(["other", "new"]) == ["new"] and pool.duplicates == 3
+    with pytest.raises(IndexError):
+        pool.best
+
+    for i, score in enumerate([4.0, 9.0, 1.0, 6.0, 0.5, 7.0]):
+        pool.add(f"c{i}", score, step=i, source="test")
+    # Capacity 3: each insert beyond it evicts the lowest score
+    assert len(pool) == 3 and pool.evicted == 3
+    assert sorted(c.score for c in pool) == [6.0, 7.0, 9.0]
+    assert (pool.best.text, pool.worst.text) == ("c1", "c3")
+    assert [c.text for c in pool.top(2)] == ["c1", "c5"] and pool.bottom(1)[0].meta == {"source": "test"}
+    assert pool.mean_score() == pytest.approx(22.0 / 3)
+
+    # Ties: the newest is chosen and the oldest rejected, so they differ
+    tied = CandidatePool(capacity=2)
+    for text in ("a", "b", "c"):
+        tied.add(text, 5.0)
+    assert (tied.best.text, tied.worst.text, len(tied)) == ("c", "b", 2)
@@ -0,0 +1,75 @@
+# tests/test_collect.py - Trajectory collection: resume and ordered output with parallel workers
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+pytest.importorskip("ollama")
+
+from collect_tpo_trajectories import collect_tpo_trajectories  # noqa: E402
+
+
+class _Models:
+    n_calls = 0
+
+
+class _Engine:
+    """Stands in for TPO_Engine: answers each query, `slow` ones after a delay."""
+
+    def __init__(self, slow=()):
+        self.models = _Models()
+        self.slow = set(slow)
+        self._lock = threading.Lock()
+
+    def run_tpo(self, query):
+        if query in self.slow:
+            time.sleep(0.5)
+        with self._lock:
+            self.models.n_calls += 3
+        return f"answer to {query}", float(len(query))
+
+
+def _queries(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["query"] for line in f]
+
+
+def test_collect_resumes_and_skips_collected_prompts(tmp_path):
+    prompts = ["Why is the sky blue?", "How do vaccines work?", "What is entropy?", "Why is the sky blue?"]
+    out = str(tmp_path / "trajectories.jsonl")
+    with open(out, "w", encoding="utf-8") as f:  # a previous run that crashed mid-write
+        f.write(json.dumps({"query": prompts[0], "response": "kept", "reward": 1.0}) + "\n")
+        f.write('{"query": "How do vacc')
+    engine = _Engine()
+    with pytest.raises(FileExistsError):
+        collect_tpo_trajectories(engine, prompts, out)
+    summary = collect_tpo_trajectories(engine, prompts, out, resume=True)
+
+    # The collected prompt and the repeat are skipped; the torn line is dropped
+    assert (summary["written"], summary["skipped"], summary["failed"]) == (2, 2, 0)
+    assert summary["llm_calls"] == 6
+    with open(out, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["query"] for r in records] == prompts[:3] and records[0]["response"] == "kept"
+    again = collect_tpo_trajectories(engine, prompts, out, resume=True)
+    assert (again["written"], again["skipped"], again["llm_calls"]) == (0, 4, 0)
+    # overwrite starts from scratch
+    assert collect_tpo_trajectories(engine, prompts, out, overwrite=True)["written"] == 3
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_collect_with_workers_keeps_prompt_order(tmp_path, ordered):
+    prompts = [f"Question number {i}?" for i in range(6)]
+    out = str(tmp_path / "trajectories.jsonl")
+    engine = _Engine(slow=prompts[:1])  # the first prompt finishes last
+    summary = collect_tpo_trajectories(engine, prompts, out, workers=3, ordered=ordered)
+
+    assert (summary["written"], summary["failed"]) == (6, 0)
+    queries = _queries(out)
+    assert sorted(queries) == sorted(prompts)
+    assert (queries == prompts) == ordered and (queries[-1] == prompts[0]) != ordered
@@ -0,0 +1,89 @@
+# tests/test_rl_core.py - Preference distillation: packing, cached reference log-probs, tiny CPU run
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from rl_core import distill_settings, pack_sequences, token_batches  # noqa: E402
+
+
+def test_packing_fills_rows_without_splitting_sequences():
+    lengths = [90, 10, 60, 40, 35, 30, 5, 80]
+    rows = pack_sequences(lengths, 100)
+    assert sorted(i for row in rows for i in row) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in row) <= 100 for row in rows)
+    assert len(rows) == 4  # 350 tokens in 4 rows instead of 8 padded to 90
+    assert token_batches([3, 3, 3, 9, 1], 6) == [[0, 1], [2], [3], [4]]
+
+
+class ByteTokenizer:
+    eos_token_id = 0
+
+    def encode(self, text, add_special_tokens=False):
+        return [b % 255 + 1 for b in text.encode("utf-8")]
+
+
+def _tiny_model(torch):
+    class TinyAttention(torch.nn.Module):
+        """One attention layer that honours a 4D additive mask / 2D padding mask and position_ids."""
+
+        def __init__(self, vocab=256, dim=32, max_pos=128):
+            super().__init__()
+            self.embed = torch.nn.Embedding(vocab, dim)
+            self.pos = torch.nn.Embedding(max_pos, dim)
+            self.q_proj, self.k_proj, self.v_proj, self.o_proj = (torch.nn.Linear(dim, dim) for _ in range(4))
+            self.lm_head = torch.nn.Linear(dim, vocab)
+
+        def forward(self, input_ids, attention_mask=None, position_ids=None, **kwargs):
+            n = input_ids.shape[1]
+            if position_ids is None:
+                position_ids = torch.arange(n).expand_as(input_ids)
+            h = self.embed(input_ids) + self.pos(position_ids)
+            if attention_mask.dim() == 2:
+                allowed = torch.ones(n, n, dtype=torch.bool).tril() & attention_mask[:, None, :].bool()
+                allowed = allowed | torch.eye(n, dtype=torch.bool)
+                attention_mask = torch.zeros(allowed.shape).masked_fill(~allowed, float("-inf"))[:, None]
+            att = self.q_proj(h) @ self.k_proj(h).transpose(1, 2) / h.shape[-1] ** 0.5
+            att = (att + attention_mask[:, 0]).softmax(-1)
+            return self.lm_head(h + self.o_proj(att @ self.v_proj(h)))
+
+    torch.manual_seed(0)
+    return TinyAttention()
+
+
+def test_distill_runs_on_cpu_and_reuses_reference_logps(tmp_path):
+    torch = pytest.importorskip("torch")
+    from rl_core import encode_pairs, sequence_logps, train_distill
+
+    model = _tiny_model(torch)
+    tok = ByteTokenizer()
+    pairs = [{"prompt": f"q{i}?", "chosen": "yes, because " + "x" * (i % 5),
+              "rejected": "no" + "!" * (i % 3)} for i in range(12)]
+
+    # Packed rows give the same log-probs as one padded sequence per row
+    seqs = encode_pairs(pairs, tok, 64)
+    with torch.no_grad():
+        packed, packed_cells = sequence_logps(model, seqs, 64, pack=True)
+        padded, padded_cells = sequence_logps(model, seqs, 64, pack=False)
+    assert torch.allclose(packed, padded, atol=1e-4)
+    assert packed_cells < padded_cells
+
+    settings = distill_settings({
+        "learning_rate": "1e-2", "beta_kl": 0.5, "ppo_batch_size": 4, "ppo_epochs": 3,
+        "lora_rank": 4, "lora_alpha": 8, "checkpoint_interval": 10,
+        "distill": {"max_seq_len": 64, "micro_batch_tokens": 48, "log_every": 100},
+    })
+    out = str(tmp_path / "ckpt")
+    summary = train_distill(model, tok, pairs, settings, out, "tiny", str(tmp_path / "log.jsonl"))
+    assert summary["steps"] == 9 and summary["samples"] == 36
+    assert summary["samples_per_s"] > 0 and 0 < summary["pack_efficiency"] <= 1
+    assert not summary["ref_cache_hit"]
+    assert summary["final_reward_acc"] == 1.0
+    assert len(summary["checkpoints"]) == 3 and os.path.exists(summary["adapter"])
+
+    # A second run over the same data loads the frozen model's log-probs from disk
+    again = train_distill(_tiny_model(torch), tok, pairs, dict(settings, epochs=1), out, "tiny")
+    assert again["ref_cache_hit"]
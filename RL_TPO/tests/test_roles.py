@@ -0,0 +1,222 @@
+# tests/test_roles.py - OllamaRole + client pool against local stand-in servers
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+pytest.importorskip("ollama")
+
+from client_pool import ClientPool, Endpoint, ResiliencePolicy, build_client_pools  # noqa: E402
+from models import OllamaRole  # noqa: E402
+from sim_ollama import SimOllamaServer  # noqa: E402
+
+
+def _role(pool: ClientPool, max_concurrency: int = 8) -> OllamaRole:
+    return OllamaRole({"tag": "sim", "temperature": 0.7}, max_concurrency, pool=pool)
+
+
+def test_requests_spread_over_replicas():
+    with SimOllamaServer(latency_s=0.05) as a, SimOllamaServer(latency_s=0.05) as b:
+        role = _role(ClientPool([Endpoint("a", a.url), Endpoint("b", b.url)]))
+
+        async def run():
+            return await asyncio.gather(*(role.agenerate("hi") for _ in range(8)))
+
+        assert asyncio.run(run()) == ["ok"] * 8
+        assert a.requests + b.requests == 8
+        assert a.requests >= 3 and b.requests >= 3
+
+
+def test_endpoint_concurrency_cap():
+    with SimOllamaServer(latency_s=0.05) as srv:
+        role = _role(ClientPool([Endpoint("only", srv.url, max_concurrency=2)]))
+
+        async def run():
+            await asyncio.gather(*(role.agenerate("hi") for _ in range(6)))
+
+        asyncio.run(run())
+        assert srv.requests == 6
+        assert srv.max_in_flight <= 2
+
+
+def test_sync_generate_reuses_pool():
+    with SimOllamaServer(reply=lambda model, messages: messages[-1]["content"].upper()) as srv:
+        role = _role(ClientPool([Endpoint("only", srv.url)]))
+        assert role.generate("abc") == "ABC"
+        assert role.generate("def", system="be terse") == "DEF"
+        assert role.n_calls == 2
+
+
+def test_build_client_pools_routes_roles():
+    cfg = {
+        "endpoints": {
+            "box_a": {"host": "http://10.0.0.1:11434", "max_concurrency": 2},
+            "box_b": {"host": "http://10.0.0.2:11434"},
+        },
+        "models": {
+            "policy": {"tag": "p", "hosts": ["box_a", "box_b"]},
+            "rm_primary": {"tag": "r", "hosts": ["box_b"]},
+            "loss_critic": {"tag": "c", "resilience": {"retries": 1}},
+        },
+        "resilience": {"timeout_s": 60, "retries": 3},
+    }
+    pools = build_client_pools(cfg)
+    assert [e.name for e in pools["policy"].endpoints] == ["box_a", "box_b"]
+    assert [e.name for e in pools["rm_primary"].endpoints] == ["box_b"]
+    assert len(pools["loss_critic"].endpoints) == 2
+    # Shared endpoint objects, so per-server caps hold across roles
+    assert pools["policy"].endpoints[1] is pools["rm_primary"].endpoints[0]
+    # Role resilience keys override the top-level defaults
+    assert (pools["policy"].policy.retries, pools["policy"].policy.timeout_s) == (3, 60)
+    assert (pools["loss_critic"].policy.retries, pools["loss_critic"].policy.timeout_s) == (1, 60)
+
+    cfg["models"]["rm_primary"]["hosts"] = ["box_c"]
+    with pytest.raises(KeyError):
+        build_client_pools(cfg)
+
+
+def test_shared_endpoint_counts_requests_of_every_pool():
+    with SimOllamaServer(latency_s=0.01) as srv:
+        shared = Endpoint("shared", srv.url, max_concurrency=4)
+        roles = [_role(ClientPool([shared])) for _ in range(2)]
+
+        async def run():
+            await asyncio.gather(*(role.agenerate(f"q{i}") for i in range(20) for role in roles))
+
+        asyncio.run(run())
+        threads = [threading.Thread(target=lambda r=role: [r.generate("hi") for _ in range(10)])
+                   for role in roles for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert (shared.requests, shared.outstanding) == (80, 0) and srv.requests == 80
+
+
+def test_stalled_call_times_out_and_retries_elsewhere():
+    with SimOllamaServer(stall_rate=1.0, stall_s=10) as a, SimOllamaServer() as b:
+        pool = ClientPool([Endpoint("a", a.url), Endpoint("b", b.url)],
+                          ResiliencePolicy(timeout_s=0.3, retries=1, backoff_s=0.01))
+        role = _role(pool)
+        start = time.perf_counter()
+        assert role.generate("hi") == "ok"  # first try goes to a and stalls
+        assert asyncio.run(role.agenerate("hi")) == "ok"
+        assert time.perf_counter() - start < 3
+        assert a.stalls >= 1 and b.requests == 2
+        assert pool.timeouts == pool.retries == a.stalls
+
+
+def test_hedged_request_beats_stalled_replica():
+    with SimOllamaServer(latency_s=0.02) as a, SimOllamaServer(latency_s=0.02) as b:
+        pool = ClientPool([Endpoint("a", a.url), Endpoint("b", b.url)],
+                          ResiliencePolicy(hedge=True, hedge_min_samples=5))
+        role = _role(pool)
+
+        async def run(n):
+            return await asyncio.gather(*(role.agenerate(f"q{i}") for i in range(n)))
+
+        asyncio.run(run(8))  # latency history for the p95 hedge delay
+        assert pool.hedges == 0 and pool.resilience_stats()["hedge_after_s"] is not None
+        a.stall_rate, a.stall_s = 1.0, 10
+        start = time.perf_counter()
+        assert asyncio.run(run(4)) == ["ok"] * 4
+        assert role.generate("sync") == "ok"
+        assert time.perf_counter() - start < 2
+        # Every call that landed on `a` was answered by its duplicate on `b`
+        assert a.stalls >= 1 and pool.hedges >= pool.hedge_wins >= 1
+
+
+def test_circuit_breaker_takes_failing_replica_out_of_rotation():
+    with SimOllamaServer(error_rate=1.0) as a, SimOllamaServer() as b:
+        bad = Endpoint("a", a.url, breaker_failures=2, breaker_cooldown_s=60)
+        pool = ClientPool([bad, Endpoint("b", b.url)], ResiliencePolicy(retries=2, backoff_s=0.01))
+        role = _role(pool)
+        for i in range(6):
+            assert role.generate(f"q{i}") == "ok"
+        assert a.errors == 2 and b.requests == 6
+        assert pool.stats()["a"]["breaker_open"] and bad.trips == 1
+
+
+def test_timed_out_attempt_counts_one_failure():
+    with SimOllamaServer(stall_rate=1.0, stall_s=10) as srv:
+        ep = Endpoint("a", srv.url, timeout_s=0.3)  # ends the abandoned attempt later
+        role = _role(ClientPool([ep], ResiliencePolicy(timeout_s=0.2)))
+        with pytest.raises(TimeoutError):
+            role.generate("hi")
+        assert ep.failures == 1
+        deadline = time.monotonic() + 5
+        while ep.outstanding and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The stalled attempt has since failed on its own; the deadline already counted it
+        assert ep.outstanding == 0 and ep.failures == 1
+
+
+def test_abandoned_sync_attempt_frees_its_slot_at_the_deadline():
+    with SimOllamaServer(stall_rate=1.0, stall_s=10) as srv:
+        ep = Endpoint("a", srv.url)  # no HTTP timeout of its own
+        role = _role(ClientPool([ep], ResiliencePolicy(timeout_s=0.2)))
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            role.generate("hi")
+        while ep.outstanding and time.monotonic() - start < 5:
+            time.sleep(0.02)
+        assert ep.outstanding == 0 and time.monotonic() - start < 1.5
+        assert ep.failures == 1
+
+
+def test_queue_time_behind_concurrency_cap_is_not_a_timeout():
+    with SimOllamaServer(latency_s=0.15) as srv:
+        ep = Endpoint("a", srv.url, max_concurrency=1)
+        pool = ClientPool([ep], ResiliencePolicy(timeout_s=0.3))
+        role = _role(pool)
+
+        async def run():
+            return await asyncio.gather(*(role.agenerate(f"q{i}") for i in range(4)))
+
+        # Each call waits up to 0.45s for the one slot but is served in 0.15s
+        assert asyncio.run(run()) == ["ok"] * 4
+        threads = [threading.Thread(target=role.generate, args=(f"s{i}",)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert pool.timeouts == 0 and ep.failures == 0 and srv.requests == 8
+    assert max(pool._latencies) < 0.3
+
+
+def test_score_parses_schema_json_then_falls_back_to_first_number():
+    replies = {
+        "json": '{"score": 7.5}',
+        "preamble": "Sure! I would rate this answer 6.5 out of 10.",
+        "negative": "-3",
+        "words": "This answer is quite good.",
+        "range": "Score: 42",
+        "broken": '{"score": "high"}',
+        "nan": '{"score": NaN}',
+    }
+    requests = []
+
+    def chat(messages, options, fmt=None):  # a server that ignores `format`
+        requests.append((options, fmt))
+        return replies[messages[-1]["content"]]
+
+    async def achat(messages, options, fmt=None):
+        return chat(messages, options, fmt)
+
+    role = OllamaRole({"tag": "sim", "temperature": 0.0, "score_max_tokens": 8})
+    role._chat, role._achat = chat, achat
+    assert role.score("json") == 7.5 and role.score("preamble") == 6.5
+    assert asyncio.run(role.ascore("negative")) == -3.0
+    assert role.score_failures == 0
+    # Nothing parsable, or out of [lo, hi]: None and a counted failure, never 0.0
+    assert [role.score(p) for p in ("words", "range", "broken", "nan")] == [None] * 4
+    assert role.score_failures == 4
+    assert role.score("range", lo=0, hi=100) == 42.0 and role.score_failures == 4
+
+    options, fmt = requests[0]
+    assert options["num_predict"] == 8
+    assert fmt["properties"]["score"]["type"] == "number"
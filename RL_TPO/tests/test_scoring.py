@@ -0,0 +1,86 @@
+# tests/test_scoring.py - Reward scorers: listwise chunking, pointwise fallback, calibration
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+pytest.importorskip("ollama")
+
+from models import OllamaRole  # noqa: E402
+from scoring import ListwiseScorer, PointwiseScorer, agreement  # noqa: E402
+
+QUERY = "Why is the sky blue?"
+TRUTH = {"alpha " * 6: 4.0, "bravo " * 6: -2.0, "charlie " * 5: 7.5, "delta " * 16: 1.0, "echo": 0.5}
+
+
+def _rm(chunk_offset: float = 0.0):
+    """
+    rm_primary whose server scores each answer by TRUTH. Listwise calls add
+    `chunk_offset` per call already made, like an RM whose scale drifts between
+    prompts; a prompt mentioning "garbled" gets an empty score array back.
+    """
+    role = OllamaRole({"tag": "sim", "temperature": 0.0})
+    role.sent = []
+
+    def chat(messages, options, fmt=None):
+        prompt = messages[-1]["content"]
+        listwise = "scores" in fmt["properties"]
+        role.sent.append("list" if listwise else "point")
+        if listwise:
+            if "garbled" in prompt:
+                return json.dumps({"scores": []})
+            shown = sorted((t for t in TRUTH if t in prompt), key=prompt.index)
+            shift = chunk_offset * (role.sent.count("list") - 1)
+            return json.dumps({"scores": [TRUTH[t] + shift for t in shown]})
+        return json.dumps({"score": next((s for t, s in TRUTH.items() if t in prompt), 3.0)})
+
+    async def achat(messages, options, fmt=None):
+        return chat(messages, options, fmt)
+
+    role._chat, role._achat = chat, achat
+    return role
+
+
+def test_listwise_scoring_chunks_and_falls_back_to_pointwise():
+    responses = list(TRUTH)
+    rm = _rm()
+    listwise = ListwiseScorer(rm, max_chars=len(QUERY) + 90)
+    # Greedy chunks under the char budget; an oversized answer gets a chunk of its own
+    assert listwise.chunks(QUERY, responses) == [[0, 1], [2], [3], [4]]
+    assert ListwiseScorer(rm).chunks(QUERY, responses) == [[0, 1, 2, 3, 4]]
+
+    assert listwise.score(QUERY, responses) == list(TRUTH.values())
+    assert rm.sent == ["list"] * 4 and rm.score_failures == 0
+    assert asyncio.run(listwise.ascore(QUERY, responses)) == list(TRUTH.values())
+
+    # A malformed array is a parse failure; only that chunk is re-scored pointwise
+    garbled = ["garbled " + "f" * 30, "alpha " * 6, "charlie " * 5]
+    rm.sent.clear()
+    scores = listwise.score(QUERY, garbled)
+    assert rm.sent == ["list", "point", "point", "list"] and rm.score_failures == 1
+    assert scores == [3.0, 4.0, 7.5]
+    assert asyncio.run(listwise.ascore(QUERY, garbled)) == scores and rm.score_failures == 2
+
+
+def test_listwise_calibration_across_chunks():
+    responses = list(TRUTH)
+    reference = PointwiseScorer(_rm()).score(QUERY, responses)
+    assert reference == list(TRUTH.values())
+
+    # One call or several chunks: a consistent RM agrees with pointwise scoring exactly
+    for max_chars in (6000, len(QUERY) + 90):
+        listwise = ListwiseScorer(_rm(), max_chars=max_chars)
+        report = agreement([reference], [listwise.score(QUERY, responses)])
+        assert report == {"n_sets": 1, "spearman": 1.0, "chosen_agreement": 1.0,
+                          "rejected_agreement": 1.0, "mean_abs_diff": 0.0}
+
+    # A scale that drifts between chunks shows up as rank disagreement
+    drifting = ListwiseScorer(_rm(chunk_offset=2.0), max_chars=len(QUERY) + 90)
+    scores = drifting.score(QUERY, responses)
+    assert scores == [4.0, -2.0, 9.5, 5.0, 6.5]
+    report = agreement([reference], [scores])
+    assert report["spearman"] < 1.0 and report["chosen_agreement"] == 1.0
+    assert report["mean_abs_diff"] == pytest.approx((0 + 0 + 2 + 4 + 6) / 5)
@@ -0,0 +1,419 @@
+# tests/test_tpo.py - TPO loop cost and concurrency against the simulated Ollama server
+import asyncio
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+pytest.importorskip("ollama")
+
+import numpy as np  # noqa: E402
+from config_loader import load_all_configs  # noqa: E402
+from models import TPO_Models  # noqa: E402
+from sim_ollama import SimOllamaServer  # noqa: E402
+from tpo_core import TPO_Engine  # noqa: E402
+
+
+def _engine(url: str) -> TPO_Engine:
+    configs = copy.deepcopy(load_all_configs(ROOT))
+    configs["models.yaml"]["endpoints"] = {"sim": {"host": url, "max_concurrency": 16}}
+    configs["models.yaml"]["cache"] = {"enabled": False}
+    models = TPO_Models(ROOT, configs=configs)
+    return TPO_Engine(ROOT, configs=configs, models=models)
+
+
+def test_run_tpo_calls_per_prompt():
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        result = engine.run_tpo_budgeted("How do you get water in the desert?")
+        n, d = engine.n_samples, engine.n_steps
+        # sample N + score N, then per step: loss + gradient + update N + score N
+        expected = 2 * n + d * (2 + 2 * n)
+        assert result["llm_calls"] == expected
+        assert srv.requests == expected
+        assert result["stop_reason"] == "completed"
+        assert result["duplicates_skipped"] == 0
+
+
+def test_arun_tpo_concurrency_speedup():
+    prompts = [f"prompt {i}" for i in range(4)]
+    with SimOllamaServer(reply=None, latency_s=0.02, parallel=16) as srv:
+        engine = _engine(srv.url)
+
+        async def sequential():
+            for q in prompts:
+                await engine.arun_tpo_budgeted(q)
+
+        async def concurrent():
+            await asyncio.gather(*(engine.arun_tpo_budgeted(q) for q in prompts))
+
+        start = time.perf_counter()
+        asyncio.run(sequential())
+        seq_s = time.perf_counter() - start
+        start = time.perf_counter()
+        asyncio.run(concurrent())
+        conc_s = time.perf_counter() - start
+
+        assert seq_s / conc_s > 1.5
+
+
+def test_sim_parallel_slots_and_model_loads():
+    with SimOllamaServer(latency_s=0.05, parallel=2, load_time_s=0.01, max_loaded_models=1) as srv:
+        engine = _engine(srv.url)
+        policy, rm = engine.models.policy, engine.models.rm_primary
+
+        async def run():
+            await asyncio.gather(*(policy.agenerate("hi") for _ in range(6)))
+
+        asyncio.run(run())
+        assert srv.max_in_flight <= 2
+        assert srv.model_loads == 1
+
+        rm.generate("hi")          # evicts the policy model (one resident at a time)
+        policy.generate("hi")
+        assert srv.model_loads == 3
+
+
+def test_sim_scores_are_deterministic():
+    with SimOllamaServer(reply=None) as srv:
+        rm = _engine(srv.url).models.rm_primary
+        first = rm.score("Rate this answer: 42")
+        assert first is not None and -10 <= first <= 10
+        assert rm.score("Rate this answer: 42") == first
+
+
+def test_trace_spans_account_for_every_call(tmp_path):
+    from tracing import Tracer
+
+    with SimOllamaServer(reply=None, tokens_per_s=1000) as srv:
+        engine = _engine(srv.url)
+        spans = []
+        engine.tracer = Tracer(str(tmp_path / "trace.jsonl"), hooks=[spans.append])
+        result = engine.run_tpo_budgeted("How can I save electricity at home?")
+
+    run = next(s for s in spans if s["kind"] == "run")
+    assert run["trace_id"] == result["trace_id"]
+    assert run["totals"]["calls"] == result["llm_calls"]
+    assert run["totals"]["prompt_tokens"] + run["totals"]["completion_tokens"] == result["tokens"]
+    assert run["totals"]["decode_s"] > 0
+    assert set(run["stages"]) == {"sample", "score", "loss", "gradient", "update"}
+    assert sum(r["calls"] for r in run["by_role"].values()) == result["llm_calls"]
+    assert sum(s["kind"] == "llm" for s in spans) == result["llm_calls"]
+    assert sum(1 for _ in open(tmp_path / "trace.jsonl")) == len(spans)
+
+
+async def _http(port: int, method: str, path: str, payload=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    head, _, data = raw.partition(b"\r\n\r\n")
+    return int(head.split()[1]), data.decode()
+
+
+def test_service_streams_progress_and_rejects_when_full():
+    from service import TPOService
+
+    with SimOllamaServer(reply=None, latency_s=0.01) as srv:
+        service = TPOService(_engine(srv.url), workers=1, max_queue=1, warm=True)
+
+        async def run():
+            await service.start()
+            server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                first = asyncio.create_task(_http(port, "POST", "/tpo", {"query": "q1"}))
+                await asyncio.sleep(0.05)  # q1 running, q2 fills the queue, q3 is rejected
+                second = asyncio.create_task(_http(port, "POST", "/tpo", {"query": "q2", "stream": False}))
+                await asyncio.sleep(0.05)
+                rejected = await _http(port, "POST", "/tpo", {"query": "q3"})
+                bad = await _http(port, "POST", "/tpo", {"nope": 1})
+                results = await asyncio.gather(first, second)
+                stats = await _http(port, "GET", "/stats")
+            finally:
+                server.close()
+                await service.stop()
+            return results, rejected, bad, stats
+
+        (streamed, single), rejected, bad, stats = asyncio.run(run())
+
+    code, body = streamed
+    events = [json.loads(line) for line in body.splitlines()]
+    assert code == 200
+    assert [e["event"] for e in events] == ["queued", "started", "step", "step", "step", "done"]
+    assert events[-1]["result"]["response"] == events[-2]["best_response"]
+    assert single[0] == 200 and json.loads(single[1])["event"] == "done"
+    assert rejected[0] == 429
+    assert bad[0] == 400
+    stats = json.loads(stats[1])
+    assert stats["completed"] == 2 and stats["rejected"] == 1 and stats["queue_depth"] == 0
+    assert srv.model_loads >= 1
+
+
+def test_shared_prefix_layout_saves_prefill():
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        result = engine.run_tpo_budgeted("How do you get water in the desert? " * 10)
+
+    assert result["prefill_tokens"] == srv.prefill_tokens
+    # Repeated sample/update prompts are served from the KV cache...
+    assert result["prefill_saved"] > 0
+    # ...and the RM/critic prompts of one query share their prefix too
+    assert srv.prefill_tokens_saved > result["prefill_saved"]
+    assert srv.prefill_tokens < srv.prefill_tokens_saved
+
+
+def test_sample_seeds_make_candidates_reproducible():
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        engine.sample_seed = 7
+        first = engine.sample_candidates("Explain test-time preference optimization.")
+        again = engine.sample_candidates("Explain test-time preference optimization.")
+        seeds = [c["options"]["seed"] for c in srv.calls[-engine.n_samples:]]
+
+    assert first == again
+    assert len(set(first)) == engine.n_samples
+    assert seeds == list(range(7, 7 + engine.n_samples))
+
+
+def test_collect_into_trajectory_store(tmp_path):
+    from collect_tpo_trajectories import collect_tpo_trajectories
+    from trajectory_store import TrajectoryReader
+
+    prompts = ["Why is the sky blue?", "How do vaccines work?", "What is entropy?"]
+    root = str(tmp_path / "trajectories")
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        collect_tpo_trajectories(engine, prompts[:2], root)
+        summary = collect_tpo_trajectories(engine, prompts, root, resume=True, batch_size=2)
+
+    assert (summary["written"], summary["skipped"]) == (1, 2)
+    n, d = engine.n_samples, engine.n_steps
+    with TrajectoryReader(root) as reader:
+        assert [r["query"] for r in reader] == prompts
+        for record in reader:
+            traj = record["trajectory"]
+            assert len(traj["candidates"]) == n * (d + 1)
+            assert [s["step"] for s in traj["steps"]] == list(range(1, d + 1))
+            assert max(c["score"] for c in traj["candidates"]) == record["reward"]
+        assert len(list(reader.pairs())) >= len(prompts)
+
+
+def test_consensus_scorer_stops_early_when_raters_agree():
+    from scoring import ConsensusScorer, consensus
+
+    assert consensus([3.0, 3.5, 9.0], 2, 1.0) == 3.25
+    assert consensus([1.0, 5.0], 2, 1.0) is None
+    assert consensus([2.0, None, 2.4, 2.8], 2, 1.0) == 2.4
+
+    responses = [f"candidate {i}" for i in range(20)]
+    with SimOllamaServer(reply=None, score_noise=1.0) as srv:
+        engine = _engine(srv.url)
+        engine.models.consensus_rm.temperature = 0.7
+        engine.scorer = ConsensusScorer(engine.models.consensus_rm, raters=3, quorum=2, tolerance=1.0)
+        scores = engine.score_responses("Which answer is best?", responses)
+        sync_calls = srv.requests
+        race = ConsensusScorer(engine.models.consensus_rm, raters=3, quorum=2, tolerance=1.0, race=True)
+        raced = asyncio.run(race.ascore("Which answer is best?", responses))
+
+    stats = engine.scorer.stats()
+    assert all(s is not None for s in scores) and all(s is not None for s in raced)
+    assert stats["items"] == 20 and stats["calls"] == sync_calls
+    # Raters 1 and 2 land within +-1 of each other most of the time: far below 3 calls each
+    assert 0 < stats["calls_saved"] < 20 and stats["calls_per_item"] < 2.6
+    assert stats["early_rate"] == stats["calls_saved"] / 20
+    assert race.stats()["agreement_rate"] == 1.0
+    # Raced-out raters were launched: they count as calls, not savings
+    raced_stats = race.stats()
+    assert raced_stats["calls"] == 60 and raced_stats["calls_saved"] == 0
+    assert raced_stats["answered"] + raced_stats["cancelled"] == 60 and raced_stats["cancelled"] > 0
+
+
+def test_cascade_scoring_sends_only_extremes_to_full_rm():
+    from scoring import CascadeScorer
+
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        m = engine.models
+        engine.scorer = CascadeScorer(m.consensus_rm, m.rm_primary, top_k=1, bottom_k=1, audit=True)
+        result = engine.run_tpo_budgeted("How do tides work?")
+        full_calls = m.rm_primary.n_calls
+
+    stats = engine.scorer.stats()
+    n, d = engine.n_samples, engine.n_steps
+    assert stats["sets"] == d + 1 and stats["candidates"] == n * (d + 1)
+    assert stats["cheap_calls"] == n * (d + 1) and stats["full_calls"] == 2 * (d + 1)
+    assert stats["full_saved_frac"] == (n - 2) / n
+    # Audit re-scores the rest with the full RM; the cascade's own picks stand
+    assert full_calls == n * (d + 1)
+    assert stats["audited"] == d + 1 and 0 <= stats["chosen_changed"] <= 1
+    assert result["stop_reason"] == "completed"
+
+    cascade = CascadeScorer(m.consensus_rm, m.rm_primary, top_k=1, bottom_k=1, margin=1.0)
+    assert cascade.promoted([5.0, 1.0, 4.5, 2.5, 3.0]) == [0, 1, 2]
+    assert cascade.promoted([5.0, None, 3.5, 2.0, 3.5]) == [0, 1, 3]
+    scores = cascade._merge([5.0, 1.0, 3.0, 4.0], [0, 1], [8.0, 2.0])
+    assert scores[:2] == [8.0, 2.0] and 2.0 < scores[3] < 8.0 and scores[2] < scores[3]
+    # Tied promoted scores, or a single parsed one: the rest stay below the full RM's best
+    tied = cascade._merge([5.0, 4.0, 6.0, 7.0, 1.0], [0, 4], [8.0, 8.0])
+    assert tied[0] == tied[4] == 8.0 and max(tied[1:4]) < 8.0
+    single = cascade._merge([5.0, 4.0, 6.0, 7.0, 1.0], [0, 4], [8.0, None])
+    assert single[0] == 8.0 and single[4] is None and max(single[1:4]) < 8.0
+    # No full-RM score parsed: keep the cheap ones rather than none at all
+    assert cascade._merge([3.0, 5.0, 7.0, None], [0, 2, 3], [None, None, None]) == [3.0, 5.0, 7.0, None]
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        m = engine.models
+        engine.scorer = cascade = CascadeScorer(m.consensus_rm, m.rm_primary)
+        m.rm_primary.score = lambda *args, **kwargs: None  # every full-RM reply unparsable
+        cheap_only = cascade.score("How do tides work?", ["a", "b", "c", "d"])
+        assert cheap_only == cascade.cheap.score("How do tides work?", ["a", "b", "c", "d"])
+        assert all(s is not None for s in cheap_only)
+        assert engine.run_tpo_budgeted("How do tides work?")["stop_reason"] == "completed"
+    # top_k = bottom_k = 0 would promote nothing
+    with pytest.raises(ValueError):
+        CascadeScorer(m.consensus_rm, m.rm_primary, top_k=0, bottom_k=0)
+    with pytest.raises(ValueError):
+        CascadeScorer.from_config(m, {"top_k": 0, "bottom_k": 0})
+
+
+def test_diversity_filter_keeps_near_duplicates_from_rm():
+    from diversity import DiversityFilter, select_diverse
+
+    families = [
+        "tides rise and fall twice a day because the moon pulls on the oceans".split(),
+        "coastlines funnel water so some bays see much larger swings than open sea".split(),
+    ]
+    counter = itertools.count()
+
+    def reply(model, messages):
+        # Every policy answer is one of two phrasings plus a unique word
+        i = next(counter)
+        return " ".join(families[i % 2] + [f"variant{i}"])
+
+    for select_k, threshold in [(None, 0.85), (1, 0.99)]:
+        with SimOllamaServer(reply=reply) as srv:
+            engine = _engine(srv.url)
+            m = engine.models
+            engine.diversity = DiversityFilter(m.embedder, threshold=threshold, select_k=select_k)
+            result = engine.run_tpo_budgeted("How do tides work?")
+        n, d = engine.n_samples, engine.n_steps
+        n_sets = d + 1
+        stats = engine.diversity.stats()
+        assert result["stop_reason"] == "completed"
+        assert stats["seen"] == n * n_sets and stats["embed_calls"] == n_sets
+        assert stats["rm_calls_saved"] == n * n_sets - m.rm_primary.n_calls
+        if select_k is None:
+            # Only the first answer of each phrasing is scored, across all steps
+            assert m.rm_primary.n_calls == 2 and stats["duplicates"] == n * n_sets - 2
+        else:
+            assert m.rm_primary.n_calls == n_sets and stats["deselected"] == (n - 1) * n_sets
+
+    sim = [[1.0, 0.9, 0.1], [0.9, 1.0, 0.2], [0.1, 0.2, 1.0]]
+    assert select_diverse(np.array(sim), 2) == [0, 2]
+
+
+def test_evaluator_reuses_step0_samples_as_baseline(tmp_path):
+    from evaluator import Evaluator
+
+    dataset = tmp_path / "mini.jsonl"
+    dataset.write_text("".join(json.dumps({"id": str(i), "prompt": f"Question {i}?"}) + "\n" for i in range(2)))
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        evaluator = Evaluator(engine, out_dir=str(tmp_path / "eval"), concurrency=2)
+        summary = asyncio.run(evaluator.aevaluate_dataset(str(dataset)))
+        n, d = engine.n_samples, engine.n_steps
+        # Exactly one TPO run per example: no separate baseline sample / score
+        assert srv.requests == 2 * (2 * n + d * (2 + 2 * n))
+
+    with open(tmp_path / "eval" / "mini.results.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    for r in records:
+        assert len(r["step_scores"]) == d + 1 and len(r["step_scores"][0]) == n
+        assert r["baseline_score"] == r["step_scores"][0][0]
+        assert r["depth_scores"][0] == max(r["step_scores"][0]) and r["depth_scores"][-1] == r["tpo_score"]
+        assert r["depth_scores"] == sorted(r["depth_scores"])
+    assert summary["depth_curve"]["n"] == 2 and summary["depth_curve"]["steps"] == list(range(d + 1))
+
+
+def test_gradient_cache_reuses_gradients_of_similar_queries():
+    from gradient_cache import GradientCache
+
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        m = engine.models
+        n, d = engine.n_samples, engine.n_steps
+        cache = engine.gradient_cache = GradientCache(m.embedder, threshold=0.5, reuse_threshold=0.99,
+                                                      max_entries=2, min_gain=-100.0)
+
+        def run(query):
+            before = m.loss_critic.n_calls, m.gradient_gen.n_calls, m.policy.n_calls
+            result = engine.run_tpo_budgeted(query)
+            assert result["stop_reason"] == "completed" and m.policy.n_calls - before[2] == n * (d + 1)
+            return result["gradient_cache"], m.loss_critic.n_calls - before[0], m.gradient_gen.n_calls - before[1]
+
+        assert run("How do tides work?") == ("miss", d, d)
+        # Same intent: the first iteration's critic + gradient calls are skipped
+        assert run("how do tides work?") == ("reuse", d - 1, d - 1)
+        # Related query: its own gradient, warm-started from the cached one
+        assert run("How do tides work in winter?") == ("warm_start", d, d)
+        assert run("Why is the sky blue?") == ("miss", d, d)
+
+    stats = cache.stats()
+    assert (stats["lookups"], stats["hits"], stats["warm_starts"], stats["misses"]) == (4, 1, 1, 2)
+    assert stats["llm_calls_saved"] == 2 and stats["hit_rate"] == 0.5
+    # Full at the last insert: the least recently used entry (tides) made room
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert sorted(e["query"] for e in cache._entries) == ["How do tides work in winter?", "Why is the sky blue?"]
+
+
+
+def test_batch_tpo_splits_cascade_into_one_model_per_stage():
+    from batch_engine import BatchTPO
+    from scoring import CascadeScorer
+
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        m = engine.models
+        engine.scorer = CascadeScorer(m.consensus_rm, m.rm_primary, top_k=1, bottom_k=1)
+        batch = BatchTPO(engine)
+        results = batch.run(["How do tides work?", "Why is the sky blue?"])
+
+    assert all("error" not in r for r in results)
+    n, d = engine.n_samples, engine.n_steps
+    stages = [(s["stage"], s["tag"]) for s in batch.stage_log]
+    assert stages[1:3] == [("score_cheap", m.consensus_rm.tag), ("score", m.rm_primary.tag)]
+    assert len({tag for stage, tag in stages if stage == "score"}) == 1
+    assert m.rm_primary.n_calls == 2 * 2 * (d + 1) and m.consensus_rm.n_calls == 2 * n * (d + 1)
+    assert engine.scorer.stats()["sets"] == 2 * (d + 1)
+
+
+def test_batch_tpo_isolates_a_failing_prompt():
+    from batch_engine import BatchTPO
+
+    with SimOllamaServer(reply=None) as srv:
+        engine = _engine(srv.url)
+        loss = engine.acompute_textual_loss
+
+        async def flaky_loss(query, chosen, rejected):
+            if query == "poison":
+                raise TimeoutError("critic timed out")
+            return await loss(query, chosen, rejected)
+
+        engine.acompute_textual_loss = flaky_loss
+        batch = BatchTPO(engine, trajectory=True)
+        results = batch.run(["How do tides work?", "poison", "Why is the sky blue?"])
+
+    assert results[1] == {"query": "poison", "error": "TimeoutError: critic timed out"}
+    for r in (results[0], results[2]):
+        assert r["stop_reason"] == "completed" and r["steps_run"] == engine.n_steps
+    loss_stages = [s for s in batch.stage_log if s["stage"] == "loss"]
+    assert [(s["prompts"], s["failed"]) for s in loss_stages] == [(3, 1)] + [(2, 0)] * (engine.n_steps - 1)
@@ -0,0 +1,106 @@
+# tests/test_work_queue.py - Lease-based work queue: several worker processes against one store
+import contextlib
+import copy
+import io
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("ollama")
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from config_loader import load_all_configs  # noqa: E402
+from models import TPO_Models  # noqa: E402
+from sim_ollama import SimOllamaServer  # noqa: E402
+from tpo_core import TPO_Engine  # noqa: E402
+from trajectory_store import TrajectoryReader, TrajectoryWriter  # noqa: E402
+from work_queue import WorkQueue, merge, run_worker  # noqa: E402
+
+
+def _worker(url: str, queue_root: str, worker_id: str) -> None:
+    configs = copy.deepcopy(load_all_configs(ROOT))
+    configs["models.yaml"]["endpoints"] = {"sim": {"host": url, "max_concurrency": 16}}
+    configs["models.yaml"]["cache"] = {"enabled": False}
+    configs["tpo_config.yaml"]["tracing"] = {"summary": False}
+    engine = TPO_Engine(ROOT, configs=configs, models=TPO_Models(ROOT, configs=configs))
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_worker(engine, queue_root, worker_id, poll_s=0.1)
+
+
+def test_workers_share_queue_reclaim_expired_leases_and_merge(tmp_path):
+    prompts = [f"Question number {i}?" for i in range(12)]
+    root = str(tmp_path / "queue")
+    queue = WorkQueue.init(root, prompts + prompts[:3], lease_s=1.0, batch_size=2)
+    assert queue.status()["tasks"] == 12 and queue.enqueue(prompts[:1]) == 0
+
+    # A worker that leases a batch, writes one record and dies without heartbeating
+    queue.register("ghost")
+    ghost = queue.lease("ghost")
+    assert [q for _, q in ghost.tasks] == prompts[:2]
+    with TrajectoryWriter(queue.part_path("ghost")) as writer:
+        writer.append({"query": prompts[0], "response": "stale", "reward": 0.0, "trajectory": {}})
+
+    with SimOllamaServer(reply=None) as srv:
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=_worker, args=(srv.url, root, f"w{i}")) for i in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join(timeout=120)
+        assert [p.exitcode for p in procs] == [0, 0, 0]
+
+    # The ghost's lease expired and its prompts were re-leased; its late commit is a duplicate
+    assert not queue.complete(ghost, ghost.tasks[0][0])
+    status = queue.status()
+    assert (status["done"], status["pending"], status["leased"], status["failed"]) == (12, 0, 0, 0)
+    workers = {w["worker"]: w for w in status["workers"]}
+    assert workers["ghost"]["done"] == 0 and sum(w["done"] for w in workers.values()) == 12
+    assert sum(w["done"] > 0 for w in workers.values()) >= 2 and status["prompts_per_min"] > 0
+
+    out = str(tmp_path / "trajectories")
+    stats = merge(root, out)
+    assert (stats["merged"], stats["duplicates_dropped"], stats["missing"]) == (12, 1, 0)
+    with TrajectoryReader(out) as reader:
+        assert [r["query"] for r in reader] == prompts
+        assert all(r["response"] != "stale" and r["trajectory"]["candidates"] for r in reader)
+    # Merging again adds nothing; a JSONL output gets the flat records
+    assert merge(root, out)["already_present"] == 12
+    flat = str(tmp_path / "flat.jsonl")
+    assert merge(root, flat)["merged"] == 12
+    with open(flat) as f:
+        assert len(f.readlines()) == 12
+
+
+def test_failed_prompts_are_retried_then_marked_failed(tmp_path):
+    queue = WorkQueue.init(str(tmp_path / "queue"), ["a", "b"], batch_size=2, max_attempts=2)
+    queue.register("w")
+    for expected in (["a", "b"], ["b", "a"]):  # least attempted first
+        lease = queue.lease("w")
+        assert [q for _, q in lease.tasks] == expected
+        queue.fail(lease, dict((q, t) for t, q in lease.tasks)["a"], "boom")
+        assert queue.release(lease) == 1  # "b" goes back without using up an attempt
+    queue.fail(lease, dict((q, t) for t, q in lease.tasks)["a"], "late")  # no longer leased: ignored
+    assert [q for _, q in queue.lease("w").tasks] == ["b"]
+    status = queue.status()
+    assert (status["failed"], status["leased"], status["pending"]) == (1, 1, 0)
+    assert status["workers"][0]["failed"] == 2
+
+
+class _BrokenEngine:
+    def __getattr__(self, name):
+        raise RuntimeError("engine down")
+
+
+@pytest.mark.parametrize("batch_size", [0, 2])
+def test_worker_marks_prompts_failed_when_the_engine_always_raises(tmp_path, batch_size):
+    root = str(tmp_path / "queue")
+    queue = WorkQueue.init(root, ["a", "b", "c"], batch_size=2, max_attempts=2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        counts = run_worker(_BrokenEngine(), root, "w", batch_size=batch_size, poll_s=0.01)
+    status = queue.status()
+    assert (status["failed"], status["pending"], status["leased"], status["done"]) == (3, 0, 0, 0)
+    assert counts["failed"] == 6 and status["workers"][0]["failed"] == 6